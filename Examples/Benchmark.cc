@@ -58,11 +58,13 @@ class OptionParser {
         , writers(1)
         , totalWrites(1000)
         , timeout(parseNonNegativeDuration("30s"))
+        , phases(false)
     {
         while (true) {
             static struct option longOptions[] = {
                {"cluster",  required_argument, NULL, 'c'},
                {"help",  no_argument, NULL, 'h'},
+               {"phases",  no_argument, NULL, 257},
                {"size",  required_argument, NULL, 's'},
                {"threads",  required_argument, NULL, 't'},
                {"timeout",  required_argument, NULL, 'd'},
@@ -102,6 +104,9 @@ class OptionParser {
                 case 256:
                     logPolicy = optarg;
                     break;
+                case 257:
+                    phases = true;
+                    break;
                 case '?':
                 default:
                     // getopt_long already printed an error message.
@@ -145,6 +150,13 @@ class OptionParser {
             << "Print this usage information"
             << std::endl
 
+            << "  --phases                "
+            << "Find the leader before the first write, and"
+            << std::endl
+            << "                          "
+            << "print when each phase of the run ended"
+            << std::endl
+
             << "  --size <bytes>          "
             << "Size of value in each write [default: 1024]"
             << std::endl
@@ -190,8 +202,48 @@ class OptionParser {
     uint64_t writers;
     uint64_t totalWrites;
     uint64_t timeout;
+    bool phases;
+};
+
+/**
+ * When the phases of a run ended, shared by the writer threads. Times are in
+ * nanoseconds on the monotonic clock (see monotonicNanos()).
+ */
+struct Phases {
+    Phases()
+        : firstNanos(0)
+        , threadsWritten(0)
+        , steadyNanos(0)
+        , steady(false)
+        , steadyWrites(0)
+    {
+    }
+    /// When the first write of any thread completed.
+    std::atomic<uint64_t> firstNanos;
+    /// The number of threads that have completed a write.
+    std::atomic<uint64_t> threadsWritten;
+    /// When every thread had completed a write, so that connection setup and
+    /// leader discovery are over.
+    std::atomic<uint64_t> steadyNanos;
+    /// Set once steadyNanos is.
+    std::atomic<bool> steady;
+    /// The number of writes completed after steadyNanos.
+    std::atomic<uint64_t> steadyWrites;
 };
 
+/**
+ * Return the time on the monotonic clock in nanoseconds. Unlike timeNanos(),
+ * it does not jump when the system time is set, and it is the clock that the
+ * scripts time client runs with.
+ */
+uint64_t monotonicNanos()
+{
+    struct timespec now;
+    int r = clock_gettime(CLOCK_MONOTONIC, &now);
+    assert(r == 0);
+    return uint64_t(now.tv_sec) * 1000 * 1000 * 1000 + uint64_t(now.tv_nsec);
+}
+
 /**
  * The main function for a single client thread.
  * \param id
@@ -208,6 +260,8 @@ class OptionParser {
  *      When this becomes true, this thread should exit.
  * \param[out] writesDone
  *      The number of writes this thread has completed.
+ * \param[in,out] phases
+ *      When the phases of the run ended, updated as writes complete.
  */
 void
 writeThreadMain(uint64_t id,
@@ -216,7 +270,8 @@ writeThreadMain(uint64_t id,
                 const std::string& key,
                 const std::string& value,
                 std::atomic<bool>& exit,
-                uint64_t& writesDone)
+                uint64_t& writesDone,
+                Phases& phases)
 {
     uint64_t numWrites = options.totalWrites / options.writers;
     // assign any odd leftover writes in a balanced way
@@ -227,6 +282,17 @@ writeThreadMain(uint64_t id,
             break;
         tree.writeEx(key, value);
         writesDone = i + 1;
+        if (phases.steady) {
+            ++phases.steadyWrites;
+        } else if (i == 0) {
+            uint64_t now = monotonicNanos();
+            uint64_t none = 0;
+            phases.firstNanos.compare_exchange_strong(none, now);
+            if (++phases.threadsWritten == options.writers) {
+                phases.steadyNanos = now;
+                phases.steady = true;
+            }
+        }
     }
 }
 
@@ -268,6 +334,7 @@ timerThreadMain(uint64_t timeout, std::atomic<bool>& exit)
 int
 main(int argc, char** argv)
 {
+    uint64_t mainNanos = monotonicNanos();
     try {
 
         OptionParser options(argc, argv);
@@ -276,6 +343,13 @@ main(int argc, char** argv)
                 options.logPolicy));
         Cluster cluster = Cluster(options.cluster);
         Tree tree = cluster.getTree();
+        uint64_t connectedNanos = 0;
+        if (options.phases) {
+            // Connect and find the leader before the clock starts, so that
+            // the first write times only the write.
+            cluster.getConfiguration();
+            connectedNanos = monotonicNanos();
+        }
 
         std::string key("/bench");
         std::string value(options.size, 'v');
@@ -285,18 +359,21 @@ main(int argc, char** argv)
         std::vector<uint64_t> writesDonePerThread(options.writers);
         uint64_t totalWritesDone = 0;
         std::vector<std::thread> threads;
+        Phases phases;
         std::thread timer(timerThreadMain, options.timeout, std::ref(exit));
         for (uint64_t i = 0; i < options.writers; ++i) {
             threads.emplace_back(writeThreadMain, i, std::ref(options),
                                  tree, std::ref(key), std::ref(value),
                                  std::ref(exit),
-                                 std::ref(writesDonePerThread.at(i)));
+                                 std::ref(writesDonePerThread.at(i)),
+                                 std::ref(phases));
         }
         for (uint64_t i = 0; i < options.writers; ++i) {
             threads.at(i).join();
             totalWritesDone += writesDonePerThread.at(i);
         }
         uint64_t endNanos = timeNanos();
+        uint64_t endMonotonicNanos = monotonicNanos();
         exit = true;
         timer.join();
 
@@ -307,6 +384,16 @@ main(int argc, char** argv)
                   << totalWritesDone
                   << " objects"
                   << std::endl;
+        if (options.phases) {
+            std::cout << "Phases:"
+                      << " main=" << mainNanos
+                      << " connected=" << connectedNanos
+                      << " first=" << phases.firstNanos
+                      << " steady=" << phases.steadyNanos
+                      << " end=" << endMonotonicNanos
+                      << " steadyWrites=" << phases.steadyWrites
+                      << std::endl;
+        }
         return 0;
 
     } catch (const LogCabin::Client::Exception& e) {
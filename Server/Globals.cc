@@ -171,7 +171,10 @@ Globals::init()
             NOTICE("Serving on %s",
                    address.toString().c_str());
         }
-        raft->serverAddresses = listenAddressesStr;
+        // Other servers and clients are given advertiseAddresses instead, if
+        // set (e.g. a proxy in front of this server).
+        raft->serverAddresses =
+            config.read<std::string>("advertiseAddresses", listenAddressesStr);
         raft->init();
     }
 
@@ -6,13 +6,21 @@ main function.
 from __future__ import print_function
 
 import subprocess
+import threading
+import os
 import random
+import tempfile
 import time
 import sys
-import re
 
-from localconfig import hosts
-from common import Sandbox, sh
+from common import Sandbox, AsyncSandbox, sh, spawn, gather, freePorts, hosts, loopback_hosts, \
+    host_attributes
+from netfaults import NETWORKS
+from timing import ClientTiming
+from logtail import LogIndex
+from events import EventBus
+import rpc
+import serverstats
 
 def run_shell_command(command):
     """
@@ -34,13 +42,52 @@ class TestFramework(object):
         snapshotMinLogSize = 67108864,
         snapshotRatio = 4,
         snapshotWatchdogMilliseconds = 10000,
-        electionTimeoutMilliseconds = 500
+        electionTimeoutMilliseconds = 500,
+        heartbeatPeriodMilliseconds = None,
+        rpcFailureBackoffMilliseconds = None,
+        raftDebug = None,
+        serverConfig = None,
+        serverOverrides = None,
+        hostOverrides = None,
+        capture_lines = None,
+        local_servers = None,
+        run_id = None,
+        port = None,
+        cluster_hosts = None,
+        storageModule = None,
+        storagePath = None,
+        storageSegmentBytes = None,
+        storageOpenSegments = None,
+        storageChecksum = None,
+        network = None
     ):
         """
         ### General ###
 
+        Everything a run generates (configuration files, debug output and the servers' storage)
+        is kept under its own directory, runs/<run_id>, so that several runs can share a machine.
+        The run_id defaults to the start time and the cluster UUID. Use run_path and debug_path
+        for files of the run.
+
         List of tuples (server_id, server_ip) for each server in the cluster, generated from
-        common.hosts with 1-1 mapping.
+        common.hosts (or the given cluster_hosts, a subset of it) with 1-1 mapping. The server_ip
+        is the address the server listens on and clients connect to; the server itself is
+        launched over ssh on the host given for it in common.hosts.
+
+        If local_servers is set, common.hosts is ignored and a cluster of that many servers is run
+        on this machine instead, each listening on its own loopback port (see
+        config.loopback_hosts). The ports are picked afresh for every run. For the servers in
+        common.hosts, the port each server listens on can be chosen with port instead, for the
+        addresses that don't set one.
+
+        With network ("netns" or "proxy", see netfaults.py) and local_servers, the links between
+        the servers can be given delay, jitter and loss, and cut by partitions, through
+        set_link, partition and heal.
+
+        If capture_lines is set, the stderr of servers and client commands is kept in memory, in
+        ring buffers holding that many lines (see common.OutputBuffer), instead of being written to
+        the run's debug/ directory. Use server_log to read a server's output either way, and
+        spill_logs to write the buffers to debug/ (cleanup(debug=True) does so).
 
         ### Snapshotting ###
 
@@ -70,6 +117,8 @@ class TestFramework(object):
 
         ### Raft ###
 
+        Each of these but the election timeout is left to LogCabin's default when None.
+
         The number of milliseconds that a follower waits without hearing from a
         current leader or granting its vote, before it becomes a candidate and starts
         a new election. Until we understand how Raft would behave, it's strongly
@@ -93,12 +142,111 @@ class TestFramework(object):
         a large number of entries.
 
         - raftDebug = no
+
+        ### Other settings ###
+
+        Any other server configuration key (e.g. maxLogEntriesPerRequest or
+        tcpHeartbeatTimeoutMilliseconds) can be set through serverConfig, a dictionary of keys to
+        values, which also overrides the settings above. Values are written with str, except for
+        booleans, which are written as yes or no.
+
+        - serverConfig = None
+
+        ### Per-server settings ###
+
+        Servers need not be configured alike, e.g. to run one server with fewer threads
+        (maxThreads), another storage module or a different election timeout. serverOverrides
+        maps a server id to a dictionary of settings for that server only, which override those
+        above, storage included (but for storagePath, which the run manages).
+
+        - serverOverrides = None, e.g. {3: {"maxThreads": 2}}
+
+        Settings can also be derived from the host a server runs on: hostOverrides is called with
+        the server id, the host name and the attributes of the host in config.host_attributes
+        (an empty dictionary if it has none), and returns a dictionary of settings for that
+        server. serverOverrides takes precedence over it.
+
+        - hostOverrides = None, e.g.
+          lambda server_id, host, attributes: {"maxThreads": attributes.get("cores", 16)}
+
+        ### Storage ###
+
+        Each of these is left to LogCabin's default when None.
+
+        The storage module: Segmented (default), Segmented-Text or SimpleFile. The Memory module
+        cannot be bootstrapped, so a cluster cannot be built on it.
+
+        - storageModule = Segmented
+
+        The directory under which the run keeps the servers' storage, in a directory named after
+        the run id. "shm" is short for /dev/shm, which keeps the log in memory (tmpfs) and takes
+        the disk out of the measurements. Such a path is local to each server host, whereas the
+        default, the run directory, is meant to be shared. Default: the run directory.
+
+        - storagePath = None
+
+        The maximum size of each segment, the number of segment files opened ahead of time and the
+        checksum algorithm for records on disk, for the Segmented modules.
+
+        - storageSegmentBytes = 8388608
+        - storageOpenSegments = 3
+        - storageChecksum = CRC32
         """
 
-        self.server_ids_ips = [(server_id, server_ip) for server_ip, _, server_id in hosts]
+        if storageModule == "Memory":
+            raise ValueError("The Memory storage module cannot be bootstrapped")
+
+        if local_servers:
+            cluster_hosts = loopback_hosts(local_servers, ports=freePorts(local_servers))
+        elif cluster_hosts is None:
+            cluster_hosts = hosts
+
+        self.server_ids_ips = [(server_id, server_ip) for _, server_ip, server_id in cluster_hosts]
+        if port is not None:
+            self.server_ids_ips = [
+                (server_id, server_ip if ':' in server_ip else '%s:%d' % (server_ip, port))
+                for server_id, server_ip in self.server_ids_ips]
+        # The host to launch each server on, by server id
+        self.server_hosts = dict([(server_id, host) for host, _, server_id in cluster_hosts])
+        # The address each server listens on, by server id, if not the one in server_ids_ips
+        # (e.g. behind a proxy, in which case it advertises the one in server_ids_ips to clients
+        # and other servers), and what to run each server under (e.g. a network namespace)
+        self.listen_addresses = {}
+        self.server_prefixes = {}
 
         alphabet = [chr(ord('a') + i) for i in range(26)]
         self.cluster_uuid = ''.join([random.choice(alphabet) for i in range(8)]) 
+
+        if run_id is None:
+            run_id = '%s-%s' % (time.strftime('%Y%m%d-%H%M%S'), self.cluster_uuid)
+        self.run_id = run_id
+        self.run_dir = os.path.join('runs', run_id)
+
+        # Where the servers keep their logs (each in a server<ID> directory), and whether that is
+        # on each server host rather than in the run directory.
+        if storagePath is None:
+            self.storage_dir = self.run_path('storage')
+            self.storage_on_hosts = False
+        else:
+            if storagePath == "shm":
+                storagePath = "/dev/shm"
+            self.storage_dir = os.path.join(storagePath, 'logcabin-%s' % run_id)
+            self.storage_on_hosts = True
+
+        self.network = None
+        if network is not None:
+            if not local_servers:
+                raise ValueError("Network faults need a loopback cluster (local_servers)")
+            self.network = NETWORKS[network]()
+            self.network.attach(self)
+
+        self.storageInfos = {
+            "storageModule" : storageModule,
+            "storagePath" : self.storage_dir,
+            "storageSegmentBytes" : storageSegmentBytes,
+            "storageOpenSegments" : storageOpenSegments,
+            "storageChecksum" : storageChecksum
+        }
         
         self.snapshotInfos = {
             "snapshotMinLogSize" : snapshotMinLogSize,
@@ -107,20 +255,78 @@ class TestFramework(object):
             "electionTimeoutMilliseconds" : electionTimeoutMilliseconds
         }
 
+        self.raftInfos = {
+            "heartbeatPeriodMilliseconds" : heartbeatPeriodMilliseconds,
+            "rpcFailureBackoffMilliseconds" : rpcFailureBackoffMilliseconds,
+            "raftDebug" : raftDebug
+        }
+
+        self.serverConfig = dict(serverConfig or {})
+
+        # Server id to the settings of that server only, derived from its host first; the keys
+        # may be strings, e.g. from a JSON file
+        self.serverOverrides = {}
+        for server_id, server_ip in self.server_ids_ips:
+            overrides = {}
+            if hostOverrides is not None:
+                host = self.server_hosts[server_id]
+                overrides.update(hostOverrides(server_id, host, host_attributes.get(host, {})))
+            overrides.update((serverOverrides or {}).get(server_id, {}))
+            overrides.update((serverOverrides or {}).get(str(server_id), {}))
+            if "storagePath" in overrides:
+                raise ValueError("The storagePath of a server cannot be overridden")
+            if overrides:
+                self.serverOverrides[server_id] = overrides
+
         self.filename = None
 
         self.sandbox = Sandbox()
         self.client_commands = 0
+        # Guards client_commands against concurrent client launches
+        self.lock = threading.Lock()
+
+        # In-memory output of servers (by server id) and client commands (by command number),
+        # when capture_lines is set.
+        self.capture_lines = capture_lines
+        self.server_logs = {}
+        self.client_logs = {}
+        # Server id to (buffer or None, line number or byte offset) set by mark_logs
+        self.log_marks = {}
+        # Leadership state of the servers, parsed incrementally from their logs
+        self.log_index = LogIndex(self)
+        # Raises events from the servers' logs as they are written; started by event_bus
+        self.events = None
 
         # The running processes of the servers in the cluster. If a server is killed, the process
         # is removed from the dictionary. Otherwise, the process is kept in the dictionary from the
         # start of the server until the end of the test.
         self.server_processes = {}
+        # When each server was last started
+        self.server_start_times = {}
+
+        # Bring-up: how long each ServerControl probe may take, how long servers get to answer
+        # one, and the measured seconds from launch to ready per server id and for the whole
+        # cluster (from bootstrap until reconfigured).
+        self.probe_timeout = "250ms"
+        # How long each attempt of a native probe (see native_control) may take
+        self.probe_attempt_sec = .05
+        self.ready_timeout_sec = 30
+        self.time_to_ready = {}
+        self.bringup_time = None
+
+        # Server address to the rpc.ControlClient kept open to it, for control-plane calls made
+        # without ServerControl when the Python protocol buffer modules are built
+        self.native_control = rpc.available()
+        self.control_clients = {}
     
     def _print_attr(self):
         print("server_ids_ips: ", self.server_ids_ips)
+        print("server_hosts: ", self.server_hosts)
+        print("run_dir: ", self.run_dir)
         print("cluster_uuid: ", self.cluster_uuid)
-        print("snapshotInfos: ", self.snapshotInfos)
+        print("server_config: ", self.server_config())
+        print("storageInfos: ", self.storageInfos)
+        print("serverOverrides: ", self.serverOverrides)
         print("filename: ", self.filename)
         print("sandbox: ", self.sandbox)
         print("client_commands: ", self.client_commands)
@@ -135,37 +341,109 @@ class TestFramework(object):
         print(string)
         print('-' * str_len)
 
+    def run_path(self, *parts):
+        """
+        Return the path of a file in the directory of this run.
+        """
+
+        return os.path.join(self.run_dir, *parts)
+
+    def debug_path(self, name):
+        """
+        Return the path of a debug file (server and client output) of this run.
+        """
+
+        return self.run_path('debug', name)
+
+    def event_bus(self):
+        """
+        Return the EventBus of the servers' logs, started on first use (after create_folders).
+        """
+
+        with self.lock:
+            if self.events is None:
+                self.events = EventBus(self)
+            return self.events
+
+    def config_path(self, server_id):
+        """
+        Return the path of the configuration file of a server.
+        """
+
+        return self.run_path('%s-%d.conf' % (self.filename, server_id))
+
     def create_configs(self, filename="logcabin"):
         """ 
-        Create configuration files for each server. 
+        Create configuration files for each server, with the storage settings of the run and the
+        server's overrides (see serverOverrides and hostOverrides).
         """
 
         self.filename = filename
 
-        # Write snapshotting configuration to smoketest.conf that is appended to each server's
-        # configuration file.
-        with open("smoketest.conf", 'w') as f:
-            for key, value in self.snapshotInfos.items():
-                f.write("%s = %d\n" % (key, value))
+        run_shell_command('mkdir -p "%s"' % self.run_dir)
+
+        # Write the snapshotting, Raft and other settings shared by every server to smoketest.conf.
+        # Each server's configuration file has them too, with the server's overrides applied.
+        with open(self.run_path("smoketest.conf"), 'w') as f:
+            for key, value in sorted(self.server_config().items()):
+                f.write("%s = %s\n" % (key, self._config_value(value)))
 
         # Write the configuration files for each server.
         for server_id, server_ip in self.server_ids_ips:
-            with open('%s-%d.conf' % (self.filename, server_id), 'w') as f:
+            with open(self.config_path(server_id), 'w') as f:
                 f.write('serverId = %d\n' % server_id)
-                f.write('listenAddresses = %s\n' % server_ip)
+                listen_address = self.listen_addresses.get(server_id, server_ip)
+                f.write('listenAddresses = %s\n' % listen_address)
+                if listen_address != server_ip:
+                    # So that the configuration, and leader hints, point at server_ip
+                    f.write('advertiseAddresses = %s\n' % server_ip)
                 f.write('clusterUUID = %s\n' % self.cluster_uuid)
+                storage, config = self.server_settings(server_id)
+                for key, value in sorted(storage.items()):
+                    f.write('%s = %s\n' % (key, self._config_value(value)))
                 f.write('\n\n')
-                try:
-                    f.write(open('smoketest.conf').read())
-                except:
-                    pass
+                for key, value in sorted(config.items()):
+                    f.write('%s = %s\n' % (key, self._config_value(value)))
+
+    def server_config(self):
+        """
+        Return the settings written to every server's configuration besides its identity and
+        storage: the snapshotting and Raft settings that are set, and serverConfig.
+        """
+
+        config = dict(self.snapshotInfos)
+        config.update([(key, value) for key, value in self.raftInfos.items() if value is not None])
+        config.update(self.serverConfig)
+        return config
+
+    def server_settings(self, server_id):
+        """
+        Return the storage settings and the other settings of the server with the given id: those
+        of every server, with its overrides applied.
+        """
+
+        storage = dict([(key, value) for key, value in self.storageInfos.items()
+                        if value is not None])
+        config = self.server_config()
+        for key, value in self.serverOverrides.get(server_id, {}).items():
+            if key in self.storageInfos:
+                storage[key] = value
+            else:
+                config[key] = value
+        return storage, config
+
+    @staticmethod
+    def _config_value(value):
+        if isinstance(value, bool):
+            return 'yes' if value else 'no'
+        return str(value)
 
     def create_folders(self):
         """ 
         Create necessary folders for the metadata of the test.
         """
 
-        run_shell_command('mkdir -p debug')
+        run_shell_command('mkdir -p "%s"' % self.run_path('debug'))
 
     def _initialize_first_server(self, server_command):
         """ 
@@ -176,15 +454,16 @@ class TestFramework(object):
         self._print_string('\nInitializing first server\'s log')
         
         server_id, server_ip = self.server_ids_ips[0]
-        command = ('%s --bootstrap --config %s-%d.conf' %
-                    (server_command, self.filename, server_id))
+        command = ('%s%s --bootstrap --config %s' %
+                    (self.server_prefixes.get(server_id, ''), server_command,
+                     self.config_path(server_id)))
 
-        self._print_string('Executing: %s on %s' % (command, server_ip))
+        self._print_string('Executing: %s on %s' % (command, self.server_hosts[server_id]))
 
         self.sandbox.rsh(
-            server_ip,
+            self.server_hosts[server_id],
             command,
-            stderr=open('debug/bootstrap_server', 'w')
+            stderr=open(self.debug_path('bootstrap_server'), 'w')
         ) 
 
     def _start_server(self, server_command, server_id_ip):
@@ -193,19 +472,144 @@ class TestFramework(object):
         """
 
         server_id, server_ip = server_id_ip
-        command = ('%s --config %s-%d.conf' %
-                    (server_command, self.filename, server_id))
+        command = ('%s%s --config %s' %
+                    (self.server_prefixes.get(server_id, ''), server_command,
+                     self.config_path(server_id)))
+
+        self._print_string('Executing: %s on %s' % (command, self.server_hosts[server_id]))
+
+        if self.capture_lines:
+            process = self.sandbox.rsh(
+                self.server_hosts[server_id],
+                command,
+                bg=True,
+                capture=self.capture_lines
+            )
+            self.server_logs[server_id] = process.output['stderr']
+        else:
+            process = self.sandbox.rsh(
+                self.server_hosts[server_id],
+                command,
+                bg=True,
+                stderr=open(self.debug_path('server_%d' % server_id), 'w')
+            )
+        self.server_processes[server_id_ip] = process
+        self.server_start_times[server_id_ip] = time.time()
+        if self.events is not None:
+            self.events.poke()
+        self.sandbox.checkFailures()
+
+    def server_log(self, server_id, since_mark=False):
+        """
+        Return the lines the server with the given id has logged since it was last started, from
+        memory if its output is captured or from its debug file otherwise. With since_mark, only
+        the lines logged after the last mark_logs call are returned (all of them if the server
+        was restarted since).
+        """
 
-        self._print_string('Executing: %s on %s' % (command, server_ip))
+        buffer = self.server_logs.get(server_id)
+        mark_buffer, mark = self.log_marks.get(server_id, (None, 0))
+        if not since_mark or mark_buffer is not buffer:
+            mark = 0
 
-        self.server_processes[server_id_ip] = self.sandbox.rsh(
-            server_ip,
-            command,
-            bg=True,
-            stderr=open('debug/server_%d' % server_id, 'w')
+        if buffer is not None:
+            return [line + '\n' for _, _, line in buffer.since(mark)]
+
+        f = open(self.debug_path('server_%d' % server_id))
+        # A restart truncates the file
+        if mark <= os.fstat(f.fileno()).st_size:
+            f.seek(mark)
+        return f
+
+    def client_log(self, command_number):
+        """
+        Return the lines the client command with the given number has logged so far, from memory
+        if its output is captured or from its debug file otherwise.
+        """
+
+        buffer = self.client_logs.get(command_number)
+        if buffer is not None:
+            return [line + '\n' for _, _, line in buffer.since(0)]
+        return open(self.debug_path('client_command_%d' % command_number))
+
+    def mark_logs(self):
+        """
+        Remember how far each server's log goes, for server_log(since_mark=True).
+        """
+
+        for server_id, _ in self.server_ids_ips:
+            buffer = self.server_logs.get(server_id)
+            if buffer is not None:
+                self.log_marks[server_id] = (buffer, buffer.nextIndex)
+            elif os.path.exists(self.debug_path('server_%d' % server_id)):
+                self.log_marks[server_id] = (
+                    None, os.path.getsize(self.debug_path('server_%d' % server_id)))
+
+    def reset_cluster(self):
+        """
+        Bring a running cluster back to an empty state without restarting it, so that it can be
+        reused by the next experiment: the Tree is cleared and the server logs are marked.
+        """
+
+        self._print_string('\nResetting cluster')
+
+        self.execute_client_command(
+            client_executable = "build/Examples/TreeOps",
+            conf = {
+                "options": "--timeout=10",
+                "command": "rmdir /"
+            }
         )
-        self.sandbox.checkFailures()
+
+        self.mark_logs()
+
+    def spill_logs(self):
+        """
+        Write the captured output of servers and client commands to their files in the debug/
+        directory of the run.
+        """
+
+        for server_id, buffer in self.server_logs.items():
+            buffer.spill(self.debug_path('server_%d' % server_id))
+        for command_number, buffer in self.client_logs.items():
+            buffer.spill(self.debug_path('client_command_%d' % command_number))
         
+    def set_link(self, src, dst, delay=0, jitter=0, loss=0):
+        """
+        Set the delay and jitter (in ms) and loss (in percent) of the links from server src to
+        server dst, where None stands for all servers (for src, clients too).
+        """
+
+        self.network.set_link(src, dst, delay, jitter, loss)
+
+    def partition(self, *groups):
+        """
+        Cut the links between groups of server ids, e.g. partition([1, 2], [3, 4, 5]).
+        """
+
+        self.network.partition(*groups)
+
+    def heal(self):
+        """
+        Undo partition.
+        """
+
+        self.network.heal()
+
+    def current_leader(self):
+        """
+        Return the server (id, ip) that claimed leadership for the highest term in the logs of the
+        running servers, or None if none did.
+        """
+
+        leader = None
+        leader_term = 0
+        for server_id_ip, state in self.log_index.states().items():
+            if state.led_term is not None and state.led_term > leader_term:
+                leader = server_id_ip
+                leader_term = state.led_term
+        return leader
+
     def _kill_server(self, server_id_ip):
         """ 
         Kill a server in the cluster.
@@ -218,15 +622,129 @@ class TestFramework(object):
         del self.server_processes[server_id_ip]
         self.sandbox.kill(server_process)
     
-    def _start_servers(self, server_command):
+    def _pause_server(self, server_id_ip):
+        """
+        Freeze a server in the cluster with SIGSTOP, as a long GC, disk or VM pause would. It
+        still counts as running, and can be resumed or killed.
+        """
+
+        self._print_string('Pausing server %d at %s' % (server_id_ip[0], server_id_ip[1]))
+
+        self.sandbox.pause(self.server_processes[server_id_ip])
+
+    def _resume_server(self, server_id_ip):
+        """
+        Thaw a server frozen by _pause_server.
+        """
+
+        self._print_string('Resuming server %d at %s' % (server_id_ip[0], server_id_ip[1]))
+
+        self.sandbox.resume(self.server_processes[server_id_ip])
+
+    def _stall_server(self, server_id_ip, milliseconds):
         """
-        Starts the servers in the cluster in background processes. 
+        Pause a server for the given time and resume it. Returns the times at which it was paused
+        and resumed.
+        """
+
+        self._pause_server(server_id_ip)
+        paused = time.time()
+        try:
+            # Wake up early only to check for failures of the other processes
+            while True:
+                remaining = paused + milliseconds / 1000.0 - time.time()
+                if remaining <= 0:
+                    break
+                self.sandbox.waitAny(timeout=remaining)
+                self.sandbox.checkFailures()
+        finally:
+            self._resume_server(server_id_ip)
+        return paused, time.time()
+
+    def _start_servers(self, server_command, server_ids_ips=None):
+        """
+        Starts the servers in the cluster (or the given servers) in background processes, all
+        concurrently. Returns the servers started.
         """
 
         self._print_string('\nStarting servers')
 
-        for server_id_ip in self.server_ids_ips:
-            self._start_server(server_command, server_id_ip)
+        if server_ids_ips is None:
+            server_ids_ips = self.server_ids_ips
+
+        gather([spawn(self._start_server, server_command, server_id_ip)
+                for server_id_ip in server_ids_ips])
+
+        return server_ids_ips
+
+    def _await_server_ready(self, server_id_ip, deadline):
+        """
+        Probe a server with ServerControl (or an rpc.ControlClient, see native_control) until it
+        answers, and return the time at which it did. An exception is raised if the deadline
+        passes first or if the server exits.
+        """
+
+        server_id, server_ip = server_id_ip
+        command = "build/Client/ServerControl --server=%s --timeout=%s info get" % (
+            server_ip, self.probe_timeout)
+        probe_client = None
+        if self.native_control:
+            # Each attempt is short, so that a server that exited is noticed between attempts
+            # rather than after the client has retried for the whole probe timeout
+            probe_client = rpc.ControlClient(server_ip, min(rpc.parse_duration(self.probe_timeout),
+                                                            self.probe_attempt_sec))
+
+        try:
+            while True:
+                if self.native_control:
+                    try:
+                        probe_client.server_info()
+                        return time.time()
+                    except rpc.RPCError:
+                        pass
+                else:
+                    with open('/dev/null', 'w') as devnull:
+                        probe = self.sandbox.rsh(
+                            'localhost',
+                            command,
+                            ignoreFailures=True,
+                            bg=True,
+                            stdout=devnull,
+                            stderr=devnull
+                        )
+                    returncode = probe.wait()
+                    self.sandbox.processes.remove(probe)
+                    if returncode == 0:
+                        return probe.exitTime
+
+                # Fail fast if the server died instead of waiting for the deadline
+                self.sandbox.checkFailures()
+                if time.time() > deadline:
+                    raise Exception('Server %d at %s not ready after %d s' % (
+                        server_id, server_ip, self.ready_timeout_sec))
+
+                # A refused connection fails at once, so don't spin on it
+                self.sandbox.waitAny(timeout=.01)
+        finally:
+            if probe_client is not None:
+                probe_client.close()
+
+    def _await_servers_ready(self, server_ids_ips):
+        """
+        Probe the given servers concurrently until each answers an RPC. The time from the launch
+        of each server until it was ready is stored in time_to_ready.
+        """
+
+        self._print_string('\nAwaiting servers')
+
+        deadline = time.time() + self.ready_timeout_sec
+        ready_times = gather([spawn(self._await_server_ready, server_id_ip, deadline)
+                              for server_id_ip in server_ids_ips])
+
+        for server_id_ip, ready_time in zip(server_ids_ips, ready_times):
+            self.time_to_ready[server_id_ip[0]] = ready_time - self.server_start_times[server_id_ip]
+            print('Server %d ready after %.1f ms' % (
+                server_id_ip[0], self.time_to_ready[server_id_ip[0]] * 1000))
     
     def _reconfigure_cluster(self, reconf_opts):
         """
@@ -246,15 +764,22 @@ class TestFramework(object):
     def initialize_cluster(self, server_command="build/LogCabin", reconf_opts=""):
         """ 
         Initialize the cluster by bootstrapping the first server, starting the servers in the
-        cluster and reconfiguring the cluster to contain all servers. 
+        cluster, waiting until every one of them answers RPCs and reconfiguring the cluster to
+        contain all servers. If any step fails, the environment is cleaned up and the error is
+        raised.
         """
 
         try:
+            start_time = time.time()
             self._initialize_first_server(server_command)
-            self._start_servers(server_command)
+            started = self._start_servers(server_command)
+            self._await_servers_ready(started)
             self._reconfigure_cluster(reconf_opts)
+            self.bringup_time = time.time() - start_time
+            print('Cluster up after %.1f ms' % (self.bringup_time * 1000))
         except:
             self.cleanup()
+            raise
     
     def _client_command_to_cluster(
         self, 
@@ -294,13 +819,15 @@ class TestFramework(object):
             "server_ip": "localhost"
         },
         onCluster=True,
-        bg=False
+        bg=False,
+        timed=False
     ):
         """ 
         Executes a client command by providing the client executable, options and command. The
         client command can be executed on the cluster (onCluser=True) or a single server of it 
         (onCluster=False). Also, the command can be executed in the background. The latter is 
-        useful for time_client_command. 
+        useful for time_client_command. With timed, the command runs in the foreground and a
+        timing.ClientTiming of its phases is returned (pass --phases to Benchmark for all of them).
 
         - For cluster commands the conf dictionary has the following keys:
             - options: options for the client command
@@ -319,56 +846,352 @@ class TestFramework(object):
         self._print_string('\nStarting %s on localhost' % (client_command))
 
         try:
-            self.client_commands += 1
+            with self.lock:
+                self.client_commands += 1
+                command_number = self.client_commands
+
+            streams = {}
+            if timed:
+                # Kept to find the phase marks in, and echoed once the client exits
+                streams["stdout"] = tempfile.TemporaryFile()
+
+            if self.capture_lines:
+                process = self.sandbox.rsh(
+                    'localhost',
+                    '%s' % (client_command),
+                    bg=True,
+                    capture=self.capture_lines,
+                    stdout=streams.get("stdout", sys.stdout)
+                )
+                self.client_logs[command_number] = process.output['stderr']
+            else:
+                process = self.sandbox.rsh(
+                    'localhost',
+                    '%s' % (client_command),
+                    bg=True,
+                    stderr=open(self.debug_path('client_command_%d' % command_number), 'w'),
+                    **streams
+                )
+
+            if bg:
+                return process
+            process.wait()
+            self.sandbox.checkFailures()
 
-            return self.sandbox.rsh(
-                'localhost',
-                '%s' % (client_command),
-                bg=bg,
-                stderr=open('debug/client_command_%d' % self.client_commands, 'w')
-            )
+            if timed:
+                return self._client_timing(process, streams["stdout"])
+            return None
         except Exception as e:
             print("Client command error: ", e)
             self.cleanup()
+
+    def _client_timing(self, process, stdout):
+        """
+        Return the timing.ClientTiming of a client process that has exited, given the file its
+        stdout went to.
+        """
+
+        stdout.seek(0)
+        output = stdout.read().decode('utf-8', 'replace')
+        sys.stdout.write(output)
+
+        timing = ClientTiming(process.launchNanos, process.exitNanos, output)
+        self._print_string(timing.report())
+        return timing
     
+    def execute_client_command_on_servers(
+        self,
+        client_executable,
+        conf = {
+            "options": "",
+            "command": ""
+        }
+    ):
+        """
+        Executes the same client command against every server in the cluster (as with
+        onCluster=False) concurrently. The conf dictionary has the options and command keys; the
+        server to connect to is filled in for each server. The stderr of each command is saved in
+        its own client_command_N debug file, as with execute_client_command.
+
+        Returns the common.RshManyResult with the exit code, output and latency per server.
+        """
+
+        client_commands = []
+        for _, server_ip in self.server_ids_ips:
+            server_conf = dict(conf)
+            server_conf["server_ip"] = server_ip
+            client_commands.append(self._client_command_to_server(client_executable, server_conf))
+
+        self._print_string('\nStarting %s on localhost for %d servers' % (
+            self._client_command_to_server(client_executable, dict(conf, server_ip="<server>")),
+            len(client_commands)))
+
+        try:
+            results = self.sandbox.rsh_many(['localhost'] * len(client_commands), client_commands)
+        except Exception as e:
+            print("Client command error: ", e)
+            self.cleanup()
+            return None
+
+        for result in results:
+            with self.lock:
+                self.client_commands += 1
+                command_number = self.client_commands
+            with open(self.debug_path('client_command_%d' % command_number), 'w') as f:
+                f.write(result.stderr)
+            sys.stdout.write(result.stdout)
+
+        print(results.report())
+
+        return results
+
+    def server_stats(self, server_ids_ips=None, timeout="10s"):
+        """
+        Get the ServerStats of the running servers (or the given ones) with ServerControl stats
+        get, concurrently, or over the connections of control_client. Returns a dictionary from
+        server id to a serverstats.Message (or, from control_client, the ServerStats protocol
+        buffer as a serverstats.ProtobufMessage), with every field of Protocol/ServerStats.proto.
+        Servers that could not be reached are left out, with a warning.
+        """
+
+        if server_ids_ips is None:
+            server_ids_ips = sorted(self.server_processes.keys())
+
+        if self.native_control:
+            def get(server_ip):
+                try:
+                    return self.control_client(server_ip, timeout).server_stats()
+                except rpc.RPCError as e:
+                    return e
+
+            stats = {}
+            replies = gather([spawn(get, server_ip) for _, server_ip in server_ids_ips])
+            for (server_id, _), reply in zip(server_ids_ips, replies):
+                if isinstance(reply, rpc.RPCError):
+                    print("Warning: Could not get the stats of server %d: %s" % (server_id, reply))
+                    continue
+                stats[server_id] = serverstats.ProtobufMessage(reply)
+            return stats
+
+        client_commands = [self._client_command_to_server("build/Client/ServerControl", {
+            "options": "--timeout=%s" % timeout,
+            "command": "stats get",
+            "server_ip": server_ip
+        }) for _, server_ip in server_ids_ips]
+
+        results = self.sandbox.rsh_many(['localhost'] * len(client_commands), client_commands,
+                                        ignoreFailures=True)
+
+        stats = {}
+        for (server_id, _), result in zip(server_ids_ips, results):
+            if result.returncode != 0:
+                print("Warning: Could not get the stats of server %d: %s" % (
+                    server_id, result.stderr.strip()))
+                continue
+            stats[server_id] = serverstats.parse(result.stdout)
+        return stats
+
+    def control_client(self, server_ip, timeout="10s"):
+        """
+        Return the rpc.ControlClient to a server, connected on first use and then kept. Only
+        when native_control is set.
+        """
+
+        with self.lock:
+            client = self.control_clients.get(server_ip)
+            if client is None:
+                client = rpc.ControlClient(server_ip)
+                self.control_clients[server_ip] = client
+            client.timeout = rpc.parse_duration(timeout)
+            return client
+
     def time_client_command(self, client_process, timeout_sec=10):
         """ 
         Time the execution of a client command. If the command takes longer that the timeout, an
-        exception is raised.
+        exception is raised. Returns a timing.ClientTiming, from its launch until its exit.
         """
 
-        start = time.time()
+        deadline = time.time() + timeout_sec
 
-        while client_process.proc.returncode is None:
+        while client_process.exitTime is None:
             self.sandbox.checkFailures()
 
-            time.sleep(.1)
-
-            if time.time() - start > timeout_sec:
+            # Wakes up as soon as the client or any server exits
+            remaining = deadline - time.time()
+            if remaining <= 0:
                 raise Exception('Warning: timeout exceeded!')
+            self.sandbox.waitAny(timeout=remaining)
+
+        self.sandbox.checkFailures()
+        return ClientTiming(client_process.launchNanos, client_process.exitNanos)
     
     def cleanup(self, debug=False):
         """
-        Clean up the environment: configuration files, debug files and storage folders. Also, 
-        release the resources of the sandbox, concerning the remote processes.
+        Clean up the environment: the directory of the run, with its configuration files, debug
+        files and storage folders (with debug, the debug files are kept), and the storage on the
+        server hosts, if any. Also, release the resources of the sandbox, concerning the remote
+        processes.
         """
 
         self._print_string('\nCleaning up')
 
-        # Generated from TestFramework.create_config
-        run_shell_command('rm "smoketest.conf"')
-        run_shell_command('rm "%s-"*".conf"' % self.filename)
         if not debug:
-            run_shell_command('rm -f debug/*')
+            run_shell_command('rm -rf "%s"' % self.run_dir)
+        else:
+            self.spill_logs()
+            print('Debug files kept in %s' % self.run_path('debug'))
+
+            # Generated from TestFramework.create_config
+            run_shell_command('rm -f "%s"' % self.run_path('smoketest.conf'))
+            run_shell_command('rm -f "%s-"*".conf"' % self.run_path(self.filename))
+
+            # Generated from LogCabin
+            if not self.storage_on_hosts:
+                run_shell_command('rm -rf "%s"' % self.storage_dir)
 
-        # Generated from LogCabin
-        run_shell_command('rm -rf "Storage/server"*"/"')
-        run_shell_command('rm -rf "Server/server"*"/"')
+        # Report ssh channel usage before the channels are torn down
+        channels_report = self.sandbox.channels.report()
+        if channels_report:
+            self._print_string('\nSSH channels')
+            print(channels_report)
+
+        if self.events is not None:
+            self.events.close()
+            self.events = None
+
+        for client in self.control_clients.values():
+            client.close()
+        self.control_clients = {}
 
         # Release Ssandbox resources
         self.sandbox.__exit__(None, None, None)
 
-        
+        teardown_report = self.sandbox.teardownReport()
+        if teardown_report:
+            self._print_string('\nTeardown')
+            print(teardown_report)
+
+        # Only once the servers are gone, or they might write to it again
+        if self.storage_on_hosts:
+            self._remove_host_storage()
+
+        if self.network is not None:
+            self.network.close()
+            self.network = None
+
+    def _remove_host_storage(self):
+        """
+        Remove the storage directory of the run from every server host.
+        """
+
+        server_hosts = sorted(set(self.server_hosts.values()))
+        with Sandbox() as sandbox:
+            results = sandbox.rsh_many(server_hosts, 'rm -rf %s' % self.storage_dir,
+                                       ignoreFailures=True)
+        for result in results.failures():
+            print("Warning: Could not remove %s on %s: %s" % (
+                self.storage_dir, result.host, result.stderr.strip()))
+
+
+class ClusterFixture(object):
+    """
+    Keeps a cluster running between experiments, so that a sweep only pays for bootstrap,
+    reconfiguration and cleanup when it must.
+
+    acquire is given the parameters that need a server restart to change (those passed to the
+    TestFramework constructor). While they stay the same, the running cluster is reset with
+    reset_cluster and handed out again; settings that can be flipped at runtime, e.g. through
+    ServerControl, are up to the caller. Once they change, the cluster is cleaned up and a new
+    one is built.
+    """
+
+    def __init__(self, factory=TestFramework, server_command="build/LogCabin", reconf_opts="",
+                 debug=False):
+        """
+        The factory (usually a TestFramework subclass) is called with the acquire parameters to
+        create each cluster. With debug, the debug files of every cluster are kept when it is
+        cleaned up, be it by release or because acquire needs a new one.
+        """
+
+        self.factory = factory
+        self.server_command = server_command
+        self.reconf_opts = reconf_opts
+        self.debug = debug
+
+        self.test = None
+        self.params = None
+
+        # How often a cluster was built and how often a running one was reused
+        self.builds = 0
+        self.reuses = 0
+
+    def acquire(self, **params):
+        """
+        Return a running, reset cluster for the given restart parameters.
+        """
+
+        if self.test is not None and params == self.params:
+            self.reuses += 1
+            self.test.reset_cluster()
+            return self.test
+
+        self.release()
+
+        self.test = self.factory(**params)
+        self.params = params
+        self.builds += 1
+
+        self.test.create_configs()
+        self.test.create_folders()
+        self.test.initialize_cluster(self.server_command, self.reconf_opts)
+        self.test.mark_logs()
+
+        return self.test
+
+    def release(self, debug=None):
+        """
+        Clean up the current cluster, if any, keeping its debug files if debug (by default, that of
+        the fixture) is set.
+        """
+
+        if debug is None:
+            debug = self.debug
+        if self.test is not None:
+            self.test.cleanup(debug)
+            self.test = None
+            self.params = None
+
+    def report(self):
+        return 'Clusters built: %d, reused: %d' % (self.builds, self.reuses)
+
+class AsyncTestFramework(TestFramework):
+    """
+    A TestFramework that runs operations on the servers concurrently on top of an AsyncSandbox, so
+    that killing or restarting every server takes about as long as doing so for one.
+    """
+
+    def __init__(self, *args, **kwargs):
+        TestFramework.__init__(self, *args, **kwargs)
+        self.sandbox = AsyncSandbox()
+
+    def _kill_servers(self, server_ids_ips):
+        """
+        Kill the given servers concurrently.
+        """
+
+        gather([spawn(self._kill_server, server_id_ip) for server_id_ip in server_ids_ips])
+
+    def _restart_servers(self, server_command, server_ids_ips):
+        """
+        Kill the given servers and start them again, all concurrently.
+        """
+
+        def restart(server_id_ip):
+            self._kill_server(server_id_ip)
+            self._start_server(server_command, server_id_ip)
+
+        gather([spawn(restart, server_id_ip) for server_id_ip in server_ids_ips])
+
 if __name__ == '__main__':
     test = TestFramework()
     test._print_attr()
@@ -0,0 +1,269 @@
+"""
+Long-lived execution agent. Sandbox starts one per host and then launches, kills and inspects
+processes on that host through it, instead of opening a new ssh session to run regexec or killpid
+for every command.
+
+The agent speaks newline-delimited JSON. Each request carries an id, which is echoed in its reply:
+
+    {"id": 1, "op": "launch", "handle": "h1", "command": "...", "cwd": "..."}
+    {"id": 1, "pid": 1234}
+
+Operations:
+  launch   Start command in cwd, in its own process group, under the client's handle.
+  kill     SIGTERM the process group, then SIGKILL it after timeout seconds. Replies with the
+           signal that was needed.
+  signal   Send a signal (by number) to the process group, e.g. SIGSTOP and SIGCONT to freeze and
+           thaw it.
+  status   Reply with the pid and returncode (null while running) of a handle.
+  tail     Reply with the last lines of a handle's stdout or stderr.
+  ping     Reply right away; useful to measure the round trip.
+
+Failed requests are answered with {"id": ..., "error": "..."}. In addition, the agent pushes
+{"event": "output", "handle", "stream", "data"} as a process writes to stdout or stderr, and
+{"event": "exit", "handle", "returncode", "time"} once it exits.
+
+When the client disconnects, the agent kills the processes it launched for that client. In stdio
+mode the agent then exits.
+
+Usage:
+  agent.py [--listen=<address>]
+  agent.py (-h | --help)
+
+Options:
+  -h --help             Show this help message and exit
+  --listen=<address>    Serve clients over TCP on host:port rather than serving a single client
+                        on stdin/stdout. With port 0 a free port is picked, and printed on stdout.
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from docopt import docopt
+
+# Number of lines of each stream kept for tail requests
+TAIL_LINES = 1000
+
+class Child(object):
+    """
+    A process launched by the agent.
+    """
+
+    def __init__(self, handle, popen, connection):
+        self.handle = handle
+        self.popen = popen
+        self.connection = connection
+        self.returncode = None
+        self.exited = threading.Event()
+        self.tails = {
+            "stdout": collections.deque(maxlen=TAIL_LINES),
+            "stderr": collections.deque(maxlen=TAIL_LINES)
+        }
+
+class Connection(object):
+    """
+    One client of the agent. Requests are served in their own threads, so that a slow kill does
+    not hold up other requests.
+    """
+
+    def __init__(self, agent, rfile, wfile, sock=None):
+        self.agent = agent
+        self.rfile = rfile
+        self.wfile = wfile
+        self.sock = sock
+        self.write_lock = threading.Lock()
+
+    def send(self, message):
+        data = (json.dumps(message) + '\n').encode('utf-8')
+        with self.write_lock:
+            try:
+                self.wfile.write(data)
+                self.wfile.flush()
+            except (IOError, OSError, ValueError):
+                # The client is gone; serve() cleans up once it sees EOF.
+                pass
+
+    def serve(self):
+        for line in iter(self.rfile.readline, b''):
+            request = json.loads(line.decode('utf-8'))
+            thread = threading.Thread(target=self._handle, args=(request,))
+            thread.daemon = True
+            thread.start()
+        self.agent.disconnected(self)
+        # Tell the client we are done cleaning up after it.
+        with self.write_lock:
+            if self.sock is not None:
+                self.sock.shutdown(socket.SHUT_RDWR)
+                self.sock.close()
+            else:
+                self.wfile.close()
+
+    def _handle(self, request):
+        reply = {"id": request.get("id")}
+        try:
+            reply.update(self.agent.dispatch(self, request))
+        except Exception as e:
+            reply["error"] = "%s: %s" % (type(e).__name__, e)
+        self.send(reply)
+
+class Agent(object):
+    """
+    The table of processes launched on this host, shared by all connections.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.children = {}
+
+    def dispatch(self, connection, request):
+        op = request["op"]
+        if op == "launch":
+            return self.launch(connection, request["handle"], request["command"],
+                               request.get("cwd"), request.get("env", {}))
+        elif op == "kill":
+            return self.kill(self._child(request["handle"]), request.get("timeout", 5))
+        elif op == "signal":
+            self._signal(self._child(request["handle"]), request["signal"])
+            return {}
+        elif op == "status":
+            child = self._child(request["handle"])
+            return {"pid": child.popen.pid, "returncode": child.returncode}
+        elif op == "tail":
+            child = self._child(request["handle"])
+            lines = list(child.tails[request.get("stream", "stderr")])
+            return {"lines": lines[-request.get("lines", 10):]}
+        elif op == "ping":
+            return {}
+        else:
+            raise ValueError("Unknown op %s" % op)
+
+    def _child(self, handle):
+        with self.lock:
+            return self.children[handle]
+
+    def launch(self, connection, handle, command, cwd, env):
+        child_env = dict(os.environ)
+        child_env.update(env)
+        # Same as regexec
+        child_env['LD_LIBRARY_PATH'] = ':'.join(
+            [os.path.expanduser('~/bin'), '/usr/local/lib',
+             child_env.get('LD_LIBRARY_PATH', '')])
+        popen = subprocess.Popen(shlex.split(command), cwd=cwd, env=child_env,
+                                 stdin=open(os.devnull), stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE, preexec_fn=os.setsid)
+        child = Child(handle, popen, connection)
+        with self.lock:
+            self.children[handle] = child
+
+        readers = [threading.Thread(target=self._read, args=(child, stream, pipe))
+                   for stream, pipe in [("stdout", popen.stdout), ("stderr", popen.stderr)]]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+        waiter = threading.Thread(target=self._wait, args=(child, readers))
+        waiter.daemon = True
+        waiter.start()
+
+        return {"pid": popen.pid}
+
+    def _read(self, child, stream, pipe):
+        partial = ''
+        while True:
+            data = os.read(pipe.fileno(), 65536)
+            if not data:
+                break
+            # latin-1 maps every byte to one character, so the client can restore the exact bytes
+            text = data.decode('latin-1')
+            child.connection.send({"event": "output", "handle": child.handle,
+                                   "stream": stream, "data": text})
+            lines = (partial + text).split('\n')
+            partial = lines.pop()
+            child.tails[stream].extend(lines)
+        if partial:
+            child.tails[stream].append(partial)
+        pipe.close()
+
+    def _wait(self, child, readers):
+        returncode = child.popen.wait()
+        exit_time = time.time()
+        # Let the output drain before reporting the exit; grandchildren may hold the pipes open,
+        # so don't wait on them forever.
+        for reader in readers:
+            reader.join(1)
+        child.returncode = returncode
+        child.exited.set()
+        child.connection.send({"event": "exit", "handle": child.handle,
+                               "returncode": returncode, "time": exit_time})
+
+    def kill(self, child, timeout):
+        self._signal(child, signal.SIGTERM)
+        # A paused process only acts on SIGTERM once it runs again
+        self._signal(child, signal.SIGCONT)
+        if child.exited.wait(timeout):
+            return {"signal": "SIGTERM"}
+        self._signal(child, signal.SIGKILL)
+        child.exited.wait()
+        return {"signal": "SIGKILL"}
+
+    def _signal(self, child, sig):
+        try:
+            os.killpg(child.popen.pid, sig)
+        except OSError:
+            # The whole group has already exited.
+            pass
+
+    def disconnected(self, connection):
+        """
+        Kill whatever the client left running, and forget about its processes.
+        """
+
+        with self.lock:
+            children = [c for c in self.children.values() if c.connection is connection]
+            for child in children:
+                del self.children[child.handle]
+        for child in children:
+            if child.returncode is None:
+                self.kill(child, 5)
+
+def serve_tcp(agent, address):
+    host, port = address.rsplit(':', 1)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, int(port)))
+    listener.listen(16)
+    print(listener.getsockname()[1])
+    sys.stdout.flush()
+
+    while True:
+        sock, _ = listener.accept()
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        connection = Connection(agent, sock.makefile('rb'), sock.makefile('wb'), sock)
+        thread = threading.Thread(target=connection.serve)
+        thread.daemon = True
+        thread.start()
+
+def main():
+    arguments = docopt(__doc__)
+
+    # Don't die with the ssh session before cleaning up
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    agent = Agent()
+    if arguments['--listen']:
+        serve_tcp(agent, arguments['--listen'])
+    else:
+        stdin = getattr(sys.stdin, 'buffer', sys.stdin)
+        stdout = getattr(sys.stdout, 'buffer', sys.stdout)
+        Connection(agent, stdin, stdout).serve()
+
+if __name__ == '__main__':
+    main()
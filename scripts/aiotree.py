@@ -0,0 +1,527 @@
+"""
+A LogCabin Tree client in pure Python, on asyncio (Python 3 only). It does what Client/ClientImpl
+and Client/LeaderRPC do:
+
+  - Finds the leader, by trying the cluster's hosts at random and following the leader hints of
+    NOT_LEADER replies, and retries every RPC (with the same exactly-once information) until it
+    succeeds or its timeout elapses. New connections are rate limited, at 5 per 100 ms.
+  - Opens a session on the first read-write operation, numbers read-write operations for the
+    exactly-once semantics of the replicated state machine, keeps the session alive when idle and
+    closes it when done.
+
+Unlike the C++ client, any number of operations can be in flight on one connection, and any number
+of logical clients (each with its own session, as a process running TreeOps or Benchmark) can share
+the connections of a Cluster. So thousands of clients can run from one Python process:
+
+    async def run():
+        cluster = Cluster('127.0.0.1:5254,127.0.0.1:5255,127.0.0.1:5256')
+        trees = [cluster.tree() for i in range(1000)]
+        await asyncio.gather(*[tree.write('/client%d' % i, b'x')
+                               for i, tree in enumerate(trees)])
+        print(await trees[0].list_directory('/'))
+        await cluster.close()
+
+Tree operations raise TreeError for the statuses that are not OK (with the status name in status),
+including TIMEOUT once their timeout has elapsed. Paths are relative to the working directory of
+the Tree, as for Client::Tree. The protocol buffer modules of rpc.protocol are needed.
+
+Usage:
+  aiotree.py --cluster=<addresses> [options]
+  aiotree.py (-h | --help)
+
+Options:
+  -h --help              Show this help message and exit
+  --cluster=<addresses>  Network addresses of the LogCabin servers, comma-separated
+  --clients=<n>          Logical clients, each with its own session [default: 100]
+  --writes=<n>           Writes per client, one at a time [default: 10]
+  --size=<bytes>         Size of each value written [default: 1024]
+  --timeout=<time>       Timeout for each operation, e.g. 10s [default: 10s]
+"""
+
+import asyncio
+import collections
+import itertools
+import random
+import socket
+import time
+
+import rpc
+from rpc import RPCError, RequestRejected, ServiceSpecificError
+
+# How long a session may be idle before a keep-alive is sent (ClientImpl's keepAliveInterval)
+KEEPALIVE_INTERVAL = 60
+
+class TreeError(Exception):
+    """
+    A Tree operation that did not succeed; status is the name of the Protocol::Client::Status.
+    """
+
+    def __init__(self, status, error):
+        Exception.__init__(self, '%s: %s' % (status, error))
+        self.status = status
+        self.error = error
+
+class SessionExpired(TreeError):
+    """
+    The cluster expired the session of a Tree, so its read-write operations can no longer be
+    applied exactly once. ClientImpl panics on this.
+    """
+
+class Connection(object):
+    """
+    An asyncio MessageSocket connection, with any number of RPCs in flight.
+    """
+
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        self.message_ids = itertools.count()
+        # Message id to the future of its reply
+        self.pending = {}
+        self.error = None
+        self.receiver = asyncio.ensure_future(self._receive())
+
+    @classmethod
+    async def open(cls, address):
+        try:
+            reader, writer = await asyncio.open_connection(*rpc.split_address(address))
+        except OSError as e:
+            raise RPCError('Could not connect to %s: %s' % (address, e))
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(address, reader, writer)
+
+    async def _receive(self):
+        try:
+            while True:
+                length, message_id = rpc.parse_header(
+                    await self.reader.readexactly(rpc.HEADER.size))
+                payload = await self.reader.readexactly(length)
+                future = self.pending.pop(message_id, None)
+                # Anything else (e.g. a reply to a ping) is not for us
+                if future is not None and not future.done():
+                    future.set_result(payload)
+        except (OSError, asyncio.IncompleteReadError, RPCError) as e:
+            self._fail(RPCError('Connection to %s failed: %s' % (self.address, e)))
+        except asyncio.CancelledError:
+            self._fail(RPCError('Connection to %s closed' % self.address))
+
+    def _fail(self, error):
+        self.error = error
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(error)
+        self.writer.close()
+
+    async def call(self, service, op_code, request):
+        """
+        Send a serialized request and return the serialized response (see rpc.response_body).
+        """
+
+        if self.error is not None:
+            raise self.error
+        message_id = next(self.message_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[message_id] = future
+        try:
+            self.writer.write(rpc.frame(message_id, rpc.request_payload(service, op_code,
+                                                                        request)))
+            return rpc.response_body(await future)
+        finally:
+            self.pending.pop(message_id, None)
+
+    def close(self):
+        self.receiver.cancel()
+
+class Backoff(object):
+    """
+    Allows at most count operations to begin in any window of seconds (Client/Backoff).
+    """
+
+    def __init__(self, count, window):
+        self.window = window
+        self.starts = collections.deque(maxlen=count)
+
+    async def delay_and_begin(self, deadline):
+        now = time.monotonic()
+        if len(self.starts) == self.starts.maxlen:
+            wake = self.starts[0] + self.window
+            if deadline is not None:
+                wake = min(wake, deadline)
+            if wake > now:
+                await asyncio.sleep(wake - now)
+                now = time.monotonic()
+        self.starts.append(now)
+
+class Cluster(object):
+    """
+    The connection to the leader of a cluster (LeaderRPC), shared by the Trees made from it.
+    """
+
+    def __init__(self, hosts, cluster_uuid=None):
+        self.hosts = [host.strip() for host in hosts.split(',') if host.strip()]
+        self.cluster_uuid = cluster_uuid
+        self.messages = rpc.protocol('Client')
+        self.leader_hint = None
+        # The Connection to the leader, or a future of it while one is being opened
+        self.leader = None
+        self.connecting = None
+        self.backoff = Backoff(5, .1)
+        self.failures_since_last_success = 0
+        self.trees = set()
+
+    def tree(self, working_directory='/', timeout=None):
+        """
+        Return a new logical client, with its own session, to the Tree of the cluster. timeout is
+        the default timeout of its operations, in seconds.
+        """
+
+        return Tree(self, working_directory, timeout)
+
+    async def _connection(self, deadline):
+        while self.connecting is not None:
+            await asyncio.shield(self.connecting)
+        if self.leader is not None:
+            return self.leader
+
+        self.connecting = asyncio.get_running_loop().create_future()
+        try:
+            if self.leader_hint is not None:
+                address, self.leader_hint = self.leader_hint, None
+            else:
+                address = random.choice(self.hosts)
+            await self.backoff.delay_and_begin(deadline)
+            connection = await Connection.open(address)
+            try:
+                await self._verify_recipient(connection)
+            except RPCError:
+                connection.close()
+                raise
+            self.leader = connection
+            return connection
+        finally:
+            self.connecting.set_result(None)
+            self.connecting = None
+
+    async def _verify_recipient(self, connection):
+        """
+        Check that the server belongs to the cluster (or learn the cluster's UUID from it), as
+        SessionManager::createSession does.
+        """
+
+        messages = self.messages.VerifyRecipient
+        request = messages.Request()
+        if self.cluster_uuid is not None:
+            request.cluster_uuid = self.cluster_uuid
+        response = messages.Response()
+        response.ParseFromString(await connection.call(
+            rpc.CLIENT_SERVICE, self.messages.VERIFY_RECIPIENT, request.SerializeToString()))
+        if not response.ok:
+            raise RPCError('Intended recipient was not at %s: %s' % (
+                connection.address, response.error))
+        if self.cluster_uuid is None and response.cluster_uuid:
+            self.cluster_uuid = response.cluster_uuid
+
+    def _drop(self, connection):
+        self.failures_since_last_success += 1
+        if connection is self.leader:
+            self.leader = None
+            connection.close()
+
+    async def call(self, op_code, request, response, deadline):
+        """
+        Call the leader with a request message until it replies, and parse its reply into
+        response. Raises TreeError('TIMEOUT') once deadline (on time.monotonic(), or None) passes.
+        """
+
+        request = request.SerializeToString()
+        while True:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TreeError('TIMEOUT', 'Client-specified timeout elapsed')
+            try:
+                connection = await asyncio.wait_for(self._connection(deadline), remaining)
+            except RPCError:
+                continue
+            except asyncio.TimeoutError:
+                continue
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            try:
+                body = await asyncio.wait_for(
+                    connection.call(rpc.CLIENT_SERVICE, op_code, request), remaining)
+            except asyncio.TimeoutError:
+                continue
+            except ServiceSpecificError as e:
+                error = self.messages.Error()
+                error.ParseFromString(e.payload)
+                if error.error_code != self.messages.Error.NOT_LEADER:
+                    raise RPCError('Unknown error code %d from %s' % (
+                        error.error_code, connection.address))
+                if error.HasField('leader_hint') and connection is self.leader:
+                    self.leader_hint = error.leader_hint
+                self._drop(connection)
+                continue
+            except RequestRejected:
+                raise
+            except RPCError:
+                self._drop(connection)
+                continue
+
+            self.failures_since_last_success = 0
+            response.ParseFromString(body)
+            return response
+
+    async def close(self):
+        """
+        Close the sessions of the Trees and the connection.
+        """
+
+        await asyncio.gather(*[tree.close() for tree in list(self.trees)])
+        if self.leader is not None:
+            self.leader.close()
+            self.leader = None
+
+def canonicalize(path, working_directory):
+    """
+    Return the absolute path of path from working_directory, without '.' and '..' components
+    (ClientImpl::canonicalize).
+    """
+
+    components = []
+    if not path.startswith('/'):
+        if not working_directory.startswith('/'):
+            raise TreeError('INVALID_ARGUMENT',
+                            "Can't use relative path '%s' from working directory '%s' (working "
+                            "directory should be an absolute path)" % (path, working_directory))
+        components.extend(c for c in working_directory.split('/') if c)
+    for component in path.split('/'):
+        if component in ('', '.'):
+            continue
+        if component == '..':
+            if not components:
+                raise TreeError('INVALID_ARGUMENT',
+                                "Path '%s' from working directory '%s' attempts to look up "
+                                "directory above root ('/')" % (path, working_directory))
+            components.pop()
+        else:
+            components.append(component)
+    return '/' + '/'.join(components)
+
+class Tree(object):
+    """
+    A logical client of the Tree of a Cluster, with its own session (ClientImpl and Client::Tree).
+    Every operation takes an optional condition, a (path, contents) pair that must hold for it to
+    be applied, and a timeout in seconds, which defaults to that of the Tree.
+    """
+
+    def __init__(self, cluster, working_directory='/', timeout=None):
+        self.cluster = cluster
+        self.messages = cluster.messages
+        self.working_directory = canonicalize(working_directory, '/')
+        self.timeout = timeout
+        # Set once the session is open; opening is shared by the first operations
+        self.client_id = None
+        self.opening = None
+        self.rpc_numbers = itertools.count(1)
+        self.outstanding = set()
+        self.last_keepalive_start = time.monotonic()
+        self.keepalive = None
+        cluster.trees.add(self)
+
+    def _deadline(self, timeout):
+        if timeout is None:
+            timeout = self.timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    async def _open_session(self, deadline):
+        if self.client_id is not None:
+            return
+        if self.opening is None:
+            self.opening = asyncio.ensure_future(self._do_open_session(deadline))
+        try:
+            await asyncio.shield(self.opening)
+        except TreeError:
+            # Let the next operation try again, with its own deadline
+            self.opening = None
+            raise
+
+    async def _do_open_session(self, deadline):
+        request = self.messages.StateMachineCommand.Request()
+        request.open_session.SetInParent()
+        response = await self.cluster.call(self.messages.STATE_MACHINE_COMMAND, request,
+                                           self.messages.StateMachineCommand.Response(), deadline)
+        self.client_id = response.open_session.client_id
+        self.keepalive = asyncio.ensure_future(self._keep_alive())
+
+    def _rpc_info(self, exactly_once):
+        self.last_keepalive_start = time.monotonic()
+        rpc_number = next(self.rpc_numbers)
+        self.outstanding.add(rpc_number)
+        exactly_once.client_id = self.client_id
+        exactly_once.rpc_number = rpc_number
+        exactly_once.first_outstanding_rpc = min(self.outstanding)
+        return rpc_number
+
+    async def _keep_alive(self):
+        """
+        Send a no-op write (with a condition that fails) whenever the session has been idle for
+        KEEPALIVE_INTERVAL, so that the cluster does not expire it.
+        """
+
+        while True:
+            idle = time.monotonic() - self.last_keepalive_start
+            if idle < KEEPALIVE_INTERVAL:
+                await asyncio.sleep(KEEPALIVE_INTERVAL - idle)
+                continue
+            tree = self.messages.ReadWriteTree.Request()
+            tree.condition.path = 'keepalive'
+            tree.condition.contents = (b"this is just a no-op to keep the client's session "
+                                       b"active; the condition is expected to fail")
+            tree.write.path = 'keepalive'
+            tree.write.contents = b"you shouldn't see this!"
+            await self._read_write(tree, None)
+
+    async def _read_write(self, tree, deadline):
+        """
+        Apply a ReadWriteTree request exactly once, and return its response.
+        """
+
+        await self._open_session(deadline)
+        rpc_number = self._rpc_info(tree.exactly_once)
+        request = self.messages.StateMachineCommand.Request()
+        request.tree.CopyFrom(tree)
+        try:
+            response = await self.cluster.call(self.messages.STATE_MACHINE_COMMAND, request,
+                                               self.messages.StateMachineCommand.Response(),
+                                               deadline)
+        finally:
+            self.outstanding.discard(rpc_number)
+        return response.tree
+
+    async def _read_only(self, tree, deadline):
+        request = self.messages.StateMachineQuery.Request()
+        request.tree.CopyFrom(tree)
+        response = await self.cluster.call(self.messages.STATE_MACHINE_QUERY, request,
+                                           self.messages.StateMachineQuery.Response(), deadline)
+        return response.tree
+
+    def _check(self, response):
+        if response.status == self.messages.OK:
+            return
+        status = self.messages.Status.Name(response.status)
+        if response.status == self.messages.SESSION_EXPIRED:
+            raise SessionExpired(status, response.error)
+        raise TreeError(status, response.error)
+
+    def _request(self, kind, condition):
+        tree = kind()
+        if condition is not None:
+            tree.condition.path = canonicalize(condition[0], self.working_directory)
+            tree.condition.contents = condition[1]
+        return tree
+
+    async def make_directory(self, path, condition=None, timeout=None):
+        tree = self._request(self.messages.ReadWriteTree.Request, condition)
+        tree.make_directory.path = canonicalize(path, self.working_directory)
+        self._check(await self._read_write(tree, self._deadline(timeout)))
+
+    async def list_directory(self, path, condition=None, timeout=None):
+        """
+        Return the names of the children of a directory; those of directories end with '/'.
+        """
+
+        tree = self._request(self.messages.ReadOnlyTree.Request, condition)
+        tree.list_directory.path = canonicalize(path, self.working_directory)
+        response = await self._read_only(tree, self._deadline(timeout))
+        self._check(response)
+        return list(response.list_directory.child)
+
+    async def remove_directory(self, path, condition=None, timeout=None):
+        tree = self._request(self.messages.ReadWriteTree.Request, condition)
+        tree.remove_directory.path = canonicalize(path, self.working_directory)
+        self._check(await self._read_write(tree, self._deadline(timeout)))
+
+    async def write(self, path, contents, condition=None, timeout=None):
+        if isinstance(contents, str):
+            contents = contents.encode()
+        tree = self._request(self.messages.ReadWriteTree.Request, condition)
+        tree.write.path = canonicalize(path, self.working_directory)
+        tree.write.contents = contents
+        self._check(await self._read_write(tree, self._deadline(timeout)))
+
+    async def read(self, path, condition=None, timeout=None):
+        """
+        Return the contents of a file, as bytes.
+        """
+
+        tree = self._request(self.messages.ReadOnlyTree.Request, condition)
+        tree.read.path = canonicalize(path, self.working_directory)
+        response = await self._read_only(tree, self._deadline(timeout))
+        self._check(response)
+        return response.read.contents
+
+    async def remove_file(self, path, condition=None, timeout=None):
+        tree = self._request(self.messages.ReadWriteTree.Request, condition)
+        tree.remove_file.path = canonicalize(path, self.working_directory)
+        self._check(await self._read_write(tree, self._deadline(timeout)))
+
+    async def close(self, timeout=10):
+        """
+        Close the session, if one was opened, waiting up to timeout seconds for the cluster to
+        acknowledge it (ClientImpl's sessionCloseTimeout).
+        """
+
+        self.cluster.trees.discard(self)
+        if self.keepalive is not None:
+            self.keepalive.cancel()
+            self.keepalive = None
+        if self.client_id is None:
+            return
+        request = self.messages.StateMachineCommand.Request()
+        request.close_session.client_id = self.client_id
+        self.client_id = None
+        try:
+            await self.cluster.call(self.messages.STATE_MACHINE_COMMAND, request,
+                                    self.messages.StateMachineCommand.Response(),
+                                    time.monotonic() + timeout)
+        except (TreeError, RequestRejected) as e:
+            print('Could not definitively close client session: %s. It may remain open until '
+                  'it expires.' % e)
+
+async def run_clients(cluster_addresses, clients, writes, size, timeout):
+    """
+    Have clients logical clients write writes values each, one after the other, and return the
+    seconds it took.
+    """
+
+    cluster = Cluster(cluster_addresses)
+    trees = [cluster.tree(timeout=timeout) for i in range(clients)]
+    value = b'x' * size
+
+    async def client(i, tree):
+        for j in range(writes):
+            await tree.write('/aiotree/%d' % i, value)
+
+    await trees[0].make_directory('/aiotree')
+    start = time.monotonic()
+    await asyncio.gather(*[client(i, tree) for i, tree in enumerate(trees)])
+    took = time.monotonic() - start
+    await cluster.close()
+    return took
+
+def main():
+    from docopt import docopt
+    arguments = docopt(__doc__)
+
+    clients = int(arguments['--clients'])
+    writes = int(arguments['--writes'])
+    took = asyncio.run(run_clients(arguments['--cluster'], clients, writes,
+                                   int(arguments['--size']),
+                                   rpc.parse_duration(arguments['--timeout'])))
+    print('%d clients wrote %d objects in %.3f s (%.1f writes/s)' % (
+        clients, clients * writes, took, clients * writes / took))
+
+if __name__ == '__main__':
+    main()
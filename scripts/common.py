@@ -15,17 +15,30 @@
 
 """Misc utilities and variables for Python scripts."""
 
+import collections
 import contextlib
+import ctypes
+import ctypes.util
+import errno
+import itertools
+import json
 import os
 import random
 import re
+import select
 import shlex
 import signal
+import socket
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
-__all__ = ['sh', 'captureSh', 'Sandbox', 'getDumpstr']
+__all__ = ['sh', 'captureSh', 'Sandbox', 'AsyncSandbox', 'RshResult',
+           'RshManyResult', 'SshChannelPool', 'OutputBuffer', 'Agent',
+           'AgentError', 'Future', 'spawn', 'gather', 'parallelMap',
+           'isLocalHost', 'freePorts', 'monotonicNanos', 'getDumpstr']
 
 def sh(command, bg=False, **kwargs):
     """Execute a local command."""
@@ -50,102 +63,1116 @@ def captureSh(command, **kwargs):
     else:
         return output
 
+class SshChannelPool(object):
+    """Keeps one multiplexed ssh control channel open per remote host.
+
+    The first command sent to a host sets up an OpenSSH ControlMaster
+    connection to it. Every later command for that host is carried over the
+    same channel, so only the first one pays for a full ssh handshake.
+    """
+    class Channel(object):
+        def __init__(self, host, controlPath):
+            self.host = host
+            self.controlPath = controlPath
+            # Seconds it took to establish the control channel, or None if it
+            # has not been set up yet.
+            self.setupTime = None
+            # Number of commands that were carried over an already
+            # established channel.
+            self.reuses = 0
+            self.lock = threading.Lock()
+
+        def __repr__(self):
+            return repr(self.__dict__)
+
+    def __init__(self):
+        self.controlDir = None
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def _channel(self, host):
+        """Return the channel for host, setting it up if necessary."""
+        with self.lock:
+            if self.controlDir is None:
+                # Unix socket paths are short, so keep this under /tmp.
+                self.controlDir = tempfile.mkdtemp(prefix='lcssh-', dir='/tmp')
+            channel = self.channels.get(host)
+            if channel is None:
+                controlPath = os.path.join(self.controlDir,
+                                           '%d' % len(self.channels))
+                channel = self.Channel(host, controlPath)
+                self.channels[host] = channel
+        with channel.lock:
+            if channel.setupTime is None:
+                start = time.time()
+                # -f returns as soon as the master is authenticated and
+                # ready to accept multiplexed sessions.
+                subprocess.check_call(['ssh',
+                                       '-o', 'ControlMaster=yes',
+                                       '-o', 'ControlPath=%s' %
+                                             channel.controlPath,
+                                       '-o', 'ControlPersist=yes',
+                                       '-N', '-f', host])
+                channel.setupTime = time.time() - start
+            else:
+                channel.reuses += 1
+        return channel
+
+    def command(self, host, *args):
+        """Return the argument list to run args on host over its channel."""
+        channel = self._channel(host)
+        return ['ssh', '-o', 'ControlPath=%s' % channel.controlPath,
+                host] + list(args)
+
+    def close(self):
+        """Shut down every control channel opened so far."""
+        with self.lock:
+            channels = self.channels.values()
+            self.channels = {}
+            controlDir = self.controlDir
+            self.controlDir = None
+        for channel in channels:
+            if channel.setupTime is None:
+                continue
+            with open(os.devnull, 'w') as devnull:
+                subprocess.call(['ssh', '-o', 'ControlPath=%s' %
+                                             channel.controlPath,
+                                 '-O', 'exit', channel.host],
+                                stdout=devnull, stderr=devnull)
+        if controlDir is not None:
+            try:
+                os.rmdir(controlDir)
+            except OSError:
+                pass
+
+    def report(self):
+        """Return a summary of setup time and reuse count per channel."""
+        with self.lock:
+            channels = sorted(self.channels.values(), key=lambda c: c.host)
+        lines = []
+        for channel in channels:
+            if channel.setupTime is None:
+                continue
+            lines.append('%s: setup %.1f ms, reused %d times' %
+                         (channel.host, channel.setupTime * 1000,
+                          channel.reuses))
+        return '\n'.join(lines)
+
+class Reaper(object):
+    """Waits for child processes in the background and reports their exits.
+
+    Each watched process gets a thread that blocks in wait() on it, so an exit
+    is noticed as soon as it happens instead of at the next poll. The exit
+    time is recorded in the Process, and threads blocked in waitAny() are
+    woken up through a pipe each, which select() watches with no polling
+    quantum.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Write ends of the pipes of the threads currently in waitAny().
+        self.waiters = []
+
+    def watch(self, process):
+        """Start waiting for process in the background."""
+        thread = threading.Thread(target=self._wait, args=(process,))
+        thread.daemon = True
+        thread.start()
+
+    def _wait(self, process):
+        process.proc.wait()
+        exitNanos = monotonicNanos()
+        exitTime = time.time()
+        # Let captured output drain, but don't wait forever on a grandchild
+        # that holds the pipe open.
+        for buffer in process.output.values():
+            buffer.closed.wait(1)
+        with self.lock:
+            process.exitNanos = exitNanos
+            process.exitTime = exitTime
+            process.exited.set()
+            for fd in self.waiters:
+                os.write(fd, b'x')
+
+    def addWaiter(self, fd):
+        """Write a byte to fd whenever a process exits, until
+        removeWaiter()."""
+        with self.lock:
+            self.waiters.append(fd)
+
+    def removeWaiter(self, fd):
+        with self.lock:
+            self.waiters.remove(fd)
+
+    def waitAny(self, processes, timeout=None):
+        """Block until one of processes has exited or timeout expires.
+
+        @param processes: The Process objects to wait for.
+        @param timeout: Seconds to wait, or None to wait forever.
+        @return: A Process from processes that has exited, or None if the
+                 timeout expired first.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        r, w = os.pipe()
+        try:
+            with self.lock:
+                self.waiters.append(w)
+            while True:
+                for process in processes:
+                    if process.exitTime is not None:
+                        return process
+                if timeout is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                try:
+                    ready = select.select([r], [], [], remaining)[0]
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                if ready:
+                    os.read(r, 4096)
+        finally:
+            with self.lock:
+                self.waiters.remove(w)
+            os.close(r)
+            os.close(w)
+
+class OutputBuffer(object):
+    """A bounded, line-indexed, in-memory copy of one output stream.
+
+    Lines are numbered from 0 in the order they were written. Only the most
+    recent maxLines are kept; older ones are dropped, but the numbering
+    continues, so a reader can ask for everything after the last line it saw.
+    It is file-like enough to be written to directly, and to disk only when
+    spill() is called.
+    """
+    def __init__(self, maxLines=10000):
+        self.lock = threading.Lock()
+        # (time.time() of arrival, line without its newline)
+        self.buffer = collections.deque(maxlen=maxLines)
+        # Number of complete lines written so far.
+        self.nextIndex = 0
+        self.partial = ''
+        # Set once the stream has hit EOF.
+        self.closed = threading.Event()
+        # Called without arguments whenever lines are added.
+        self.listeners = []
+
+    def addListener(self, callback):
+        """Call callback whenever lines are added, e.g. to wake up a reader
+        that then reads them with since()."""
+        with self.lock:
+            self.listeners.append(callback)
+
+    def _notify(self):
+        with self.lock:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def write(self, data):
+        data = toStr(data)
+        now = time.time()
+        with self.lock:
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()
+            for line in lines:
+                self.buffer.append((now, line))
+            self.nextIndex += len(lines)
+        if lines:
+            self._notify()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Mark the end of the stream, completing any unterminated line."""
+        with self.lock:
+            if self.partial:
+                self.buffer.append((time.time(), self.partial))
+                self.partial = ''
+                self.nextIndex += 1
+        self.closed.set()
+        self._notify()
+
+    def readFrom(self, pipe):
+        """Copy everything from pipe into this buffer in the background."""
+        def read():
+            while True:
+                data = os.read(pipe.fileno(), 65536)
+                if not data:
+                    break
+                self.write(data)
+            pipe.close()
+            self.close()
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+
+    def firstIndex(self):
+        """Return the number of the oldest line still kept."""
+        with self.lock:
+            return self.nextIndex - len(self.buffer)
+
+    def since(self, index=0):
+        """Return the lines numbered index and above that are still kept.
+
+        @return: A list of (number, arrival time, line) tuples.
+        """
+        with self.lock:
+            first = self.nextIndex - len(self.buffer)
+            skip = max(0, index - first)
+            return [(first + skip + i, t, line) for i, (t, line)
+                    in enumerate(itertools.islice(self.buffer, skip, None))]
+
+    def tail(self, lines=10):
+        """Return the last lines kept, without their numbers."""
+        with self.lock:
+            return [line for _, line in self.buffer][-lines:]
+
+    def grep(self, pattern, index=0):
+        """Search the lines numbered index and above.
+
+        @param pattern: A regular expression, as a string or compiled.
+        @return: A list of (number, match object) for the matching lines.
+        """
+        pattern = re.compile(pattern)
+        matches = []
+        for number, _, line in self.since(index):
+            m = pattern.search(line)
+            if m is not None:
+                matches.append((number, m))
+        return matches
+
+    def __iter__(self):
+        return iter([line + '\n' for _, _, line in self.since()])
+
+    def spill(self, path):
+        """Write the lines kept so far to a file at path."""
+        with open(path, 'w') as f:
+            for line in self:
+                f.write(line)
+
+class AgentError(Exception):
+    """Raised when an agent.py instance fails a request."""
+    pass
+
+class AgentProc(object):
+    """A process launched through an Agent.
+
+    It quacks enough like subprocess.Popen for Sandbox and the Reaper.
+    """
+    def __init__(self, agent, handle, stdout, stderr):
+        self.agent = agent
+        self.handle = handle
+        self.stdout = stdout
+        self.stderr = stderr
+        self.pid = None
+        self.returncode = None
+        self.exited = threading.Event()
+
+    def _output(self, stream, data):
+        f = self.stdout if stream == 'stdout' else self.stderr
+        if f is None:
+            f = sys.stdout if stream == 'stdout' else sys.stderr
+        # The agent sends bytes encoded as latin-1.
+        try:
+            f.write(data.encode('latin-1'))
+        except TypeError:
+            f.write(data)
+        f.flush()
+
+    def _exit(self, returncode):
+        # The agent sends all output before the exit.
+        for f in (self.stdout, self.stderr):
+            if isinstance(f, OutputBuffer):
+                f.close()
+        self.returncode = returncode
+        self.exited.set()
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        self.exited.wait()
+        return self.returncode
+
+    def kill(self):
+        self.agent.kill(self, 0)
+
+class Agent(object):
+    """Client for an agent.py instance running on one host.
+
+    The agent launches, kills and inspects processes on its host, so each of
+    those costs one round trip over an existing connection rather than an ssh
+    session of its own. Output and exits of the processes it launched are
+    streamed back as they happen.
+    """
+    def __init__(self, host, rfile, wfile, proc=None, sock=None):
+        self.host = host
+        self.rfile = rfile
+        self.wfile = wfile
+        # The ssh or agent.py process at the other end of rfile and wfile.
+        self.proc = proc
+        # The TCP connection to a loopback agent, if that is what rfile and
+        # wfile wrap.
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.nextId = 1
+        self.pending = {}
+        self.procs = {}
+        self.closed = False
+        self.reader = threading.Thread(target=self._read)
+        self.reader.daemon = True
+        self.reader.start()
+
+    @classmethod
+    def start(cls, host, channels):
+        """Start an agent on host over its ssh channel."""
+        # Assumes scripts and python are at same path on remote machine
+        proc = subprocess.Popen(channels.command(host, sys.executable,
+                                                 '%s/agent.py' % scripts_path),
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return cls(host, proc.stdout, proc.stdin, proc)
+
+    @classmethod
+    def loopback(cls, host='localhost'):
+        """Start an agent on this machine and connect to it over TCP.
+
+        @param host: The name under which the agent will be known; Sandbox
+                     routes commands for this host to it.
+        """
+        proc = subprocess.Popen([sys.executable, '%s/agent.py' % scripts_path,
+                                 '--listen=127.0.0.1:0'],
+                                stdout=subprocess.PIPE)
+        port = int(proc.stdout.readline())
+        sock = socket.create_connection(('127.0.0.1', port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return cls(host, sock.makefile('rb'), sock.makefile('wb'), proc, sock)
+
+    def _read(self):
+        for line in iter(self.rfile.readline, b''):
+            message = json.loads(line.decode('utf-8'))
+            if 'id' in message:
+                with self.lock:
+                    future = self.pending.pop(message['id'])
+                future.value = message
+                future.finished.set()
+                continue
+            with self.lock:
+                proc = self.procs.get(message['handle'])
+            if proc is None:
+                continue
+            if message['event'] == 'output':
+                proc._output(message['stream'], message['data'])
+            elif message['event'] == 'exit':
+                with self.lock:
+                    del self.procs[message['handle']]
+                proc._exit(message['returncode'])
+        # The connection is gone, and with it everything the agent ran.
+        with self.lock:
+            self.closed = True
+            pending = list(self.pending.values())
+            procs = list(self.procs.values())
+            self.pending = {}
+            self.procs = {}
+        for future in pending:
+            future.error = AgentError('Lost connection to agent on %s' %
+                                      self.host)
+            future.finished.set()
+        for proc in procs:
+            proc._exit(255)
+
+    def call(self, op, **args):
+        """Send a request and wait for its reply.
+
+        @return: The reply, as a dict.
+        @raise AgentError: If the agent failed the request or is gone.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise AgentError('Lost connection to agent on %s' % self.host)
+            requestId = self.nextId
+            self.nextId += 1
+            self.pending[requestId] = future
+            args['id'] = requestId
+            args['op'] = op
+            self.wfile.write((json.dumps(args) + '\n').encode('utf-8'))
+            self.wfile.flush()
+        reply = future.result()
+        if 'error' in reply:
+            raise AgentError('%s on %s: %s' % (op, self.host, reply['error']))
+        return reply
+
+    def launch(self, command, cwd, stdout=None, stderr=None):
+        """Start command on the agent's host.
+
+        @return: An AgentProc for it.
+        """
+        with self.lock:
+            handle = 'h%d' % self.nextId
+            self.nextId += 1
+            proc = AgentProc(self, handle, stdout, stderr)
+            # Registered before the request goes out, since the process may
+            # produce output or exit before the reply arrives.
+            self.procs[handle] = proc
+        try:
+            proc.pid = self.call('launch', handle=handle, command=command,
+                                 cwd=cwd)['pid']
+        except AgentError:
+            with self.lock:
+                self.procs.pop(handle, None)
+            raise
+        return proc
+
+    def kill(self, proc, timeout):
+        """Stop proc, escalating from SIGTERM to SIGKILL after timeout.
+
+        @return: The name of the last signal it took, 'SIGTERM' or 'SIGKILL'.
+        """
+        return self.call('kill', handle=proc.handle, timeout=timeout)['signal']
+
+    def signal(self, proc, sig):
+        """Send signal number sig to proc's process group."""
+        self.call('signal', handle=proc.handle, signal=sig)
+
+    def status(self, proc):
+        """Return the exit status of proc, or None while it runs."""
+        return self.call('status', handle=proc.handle)['returncode']
+
+    def tail(self, proc, stream='stderr', lines=10):
+        """Return the last lines proc wrote to stream."""
+        return self.call('tail', handle=proc.handle, stream=stream,
+                         lines=lines)['lines']
+
+    def close(self):
+        """Disconnect, which makes the agent kill whatever is left."""
+        try:
+            if self.sock is not None:
+                self.sock.shutdown(socket.SHUT_WR)
+            else:
+                self.wfile.close()
+        except (IOError, OSError, socket.error):
+            pass
+        # The agent hangs up once it has cleaned up after this client.
+        self.reader.join()
+        if self.proc is not None:
+            if self.sock is not None:
+                # A loopback agent would keep serving other clients.
+                self.proc.terminate()
+            self.proc.wait()
+
 class Sandbox(object):
     """A context manager for launching and cleaning up remote processes."""
     class Process(object):
-        def __init__(self, host, command, kwargs, sonce, proc, ignoreFailures):
+        def __init__(self, host, command, kwargs, sonce, proc, ignoreFailures,
+                     pgid=None):
             self.host = host
             self.command = command
             self.kwargs = kwargs
             self.sonce = sonce
             self.proc = proc
             self.ignoreFailures = ignoreFailures
+            # Process group of a command launched directly on this machine,
+            # or None if it was launched through ssh.
+            self.pgid = pgid
+            # The Agent that launched the process, if any.
+            self.agent = None
+            # Stream name ('stdout' or 'stderr') to the OutputBuffer
+            # capturing it, for commands run with capture.
+            self.output = {}
+            # monotonicNanos() just before proc was launched.
+            self.launchNanos = None
+            # Set by the Reaper: the time.time() at which proc exited, and
+            # the same on the monotonic clock.
+            self.exitTime = None
+            self.exitNanos = None
+            self.exited = threading.Event()
+            # Whether Sandbox.pause() froze the process.
+            self.paused = False
+
+        def wait(self):
+            """Block until the Reaper has seen this process exit.
+
+            @return: The process's exit status.
+            """
+            # Event.wait() without a timeout blocks on a lock rather than
+            # polling.
+            self.exited.wait()
+            return self.proc.returncode
 
         def __repr__(self):
             return repr(self.__dict__)
 
-    def __init__(self):
+    def __init__(self, killTimeout=5, teardownWorkers=16, useAgents=False):
+        """
+        @param killTimeout: Seconds a process gets to exit after SIGTERM
+                            before it is sent SIGKILL.
+        @param teardownWorkers: Maximum number of processes that __exit__()
+                                stops at the same time.
+        @param useAgents: If True, commands for remote hosts go through an
+                          agent.py started once per host, rather than through
+                          an ssh session and regexec each.
+        """
         self.processes = []
+        self.channels = SshChannelPool()
+        self.reaper = Reaper()
+        self.killTimeout = killTimeout
+        self.teardownWorkers = teardownWorkers
+        # Filled in by __exit__() for teardownReport().
+        self.teardown = []
+        self.teardownSeconds = 0
+        self.useAgents = useAgents
+        # Host to Agent. Agent.loopback() instances may be added here by hand
+        # to route a host's commands to them.
+        self.agents = {}
+        self.agentsLock = threading.Lock()
 
-    def rsh(self, host, command, ignoreFailures=False, bg=False, **kwargs):
+    def rsh(self, host, command, ignoreFailures=False, bg=False,
+            capture=None, **kwargs):
         """Execute a remote command.
 
+        @param capture: If set, stdout and stderr (unless redirected in
+                        kwargs) are kept in memory in OutputBuffers of this
+                        many lines, found in the Process's output dict.
         @return: If bg is True then a Process corresponding to the command
                  which was run, otherwise None.
         """
-        if bg:
+        if bg and capture:
+            launchKwargs = dict(kwargs)
+            for stream in ('stdout', 'stderr'):
+                if kwargs.get(stream) is None:
+                    launchKwargs[stream] = OutputBuffer(capture)
+            process = self.rsh(host, command, ignoreFailures, True,
+                               **launchKwargs)
+            # restart() should capture into fresh buffers.
+            process.kwargs = dict(kwargs, capture=capture)
+            return process
+        elif bg and (host in self.agents or
+                     (self.useAgents and not isLocalHost(host))):
+            return self._agentSh(host, command, ignoreFailures, **kwargs)
+        elif bg and isLocalHost(host):
+            return self._localSh(host, command, ignoreFailures, **kwargs)
+        elif bg:
             sonce = ''.join([chr(random.choice(range(ord('a'), ord('z'))))
                              for c in range(8)])
             # Assumes scripts are at same path on remote machine
-            sh_command = ['ssh', host,
-                          '%s/regexec' % scripts_path, sonce,
-                          os.getcwd(), "'%s'" % command]
-            p = subprocess.Popen(sh_command, **kwargs)
+            sh_command = self.channels.command(host,
+                                               '%s/regexec' % scripts_path,
+                                               sonce, os.getcwd(),
+                                               "'%s'" % command)
+            launchNanos = monotonicNanos()
+            p = self._popen(sh_command, **dict(kwargs))
             process = self.Process(host, command, kwargs, sonce,
                                    p, ignoreFailures)
-            self.processes.append(process)
+            process.launchNanos = launchNanos
+            self._track(process)
             return process
         else:
-            self.rsh(host, command, ignoreFailures, bg=True,
-                     **kwargs).proc.wait()
+            self.rsh(host, command, ignoreFailures, bg=True, capture=capture,
+                     **kwargs).wait()
             self.checkFailures()
             return None
 
-    def kill(self, process):
-        """Kill a remote process started with rsh().
+    def rsh_many(self, hosts, command, ignoreFailures=False, workers=None):
+        """Execute a remote command on many hosts concurrently.
 
-        @param process: A Process corresponding to the command to kill which
-                        was created with rsh().
+        @param hosts: The hosts to run on. A host may appear more than once.
+        @param command: The command to run on every host, or a list with one
+                        command per entry of hosts.
+        @param workers: Maximum number of commands in flight at once, or None
+                        to start all of them right away.
+        @return: An RshManyResult with one RshResult per entry of hosts.
+        @raise subprocess.CalledProcessError: If a command exited with a
+            non-zero status and ignoreFailures is False. This is raised after
+            all commands have completed.
         """
-        killer = subprocess.Popen(['ssh', process.host,
-                                   '%s/killpid' % scripts_path,
-                                    process.sonce])
-        killer.wait()
+        hosts = list(hosts)
+        if isinstance(command, (list, tuple)):
+            commands = list(command)
+            assert len(commands) == len(hosts)
+        else:
+            commands = [command] * len(hosts)
+
+        def run(i):
+            # Files rather than pipes, so that nothing blocks on a full pipe
+            # while the Reaper waits for the process.
+            stdout = tempfile.TemporaryFile()
+            stderr = tempfile.TemporaryFile()
+            start = time.time()
+            process = self.rsh(hosts[i], commands[i], True, bg=True,
+                               stdout=stdout, stderr=stderr)
+            returncode = process.wait()
+            seconds = process.exitTime - start
+            self.processes.remove(process)
+            stdout.seek(0)
+            stderr.seek(0)
+            return RshResult(hosts[i], commands[i], returncode,
+                             toStr(stdout.read()), toStr(stderr.read()),
+                             seconds)
+
+        start = time.time()
+        results = parallelMap(run, range(len(hosts)),
+                              workers or max(1, len(hosts)))
+        result = RshManyResult(results, time.time() - start)
+        if not ignoreFailures:
+            for r in result.failures():
+                print ('Process exited with status %d (%s on %s)' %
+                       (r.returncode, r.command, r.host))
+                raise subprocess.CalledProcessError(r.returncode, r.command)
+        return result
+
+    def _popen(self, args, **kwargs):
+        """Like subprocess.Popen, but OutputBuffers may be given as stdout
+        and stderr; they are fed from pipes."""
+        buffers = {}
+        for stream in ('stdout', 'stderr'):
+            if isinstance(kwargs.get(stream), OutputBuffer):
+                buffers[stream] = kwargs[stream]
+                kwargs[stream] = subprocess.PIPE
+        p = subprocess.Popen(args, **kwargs)
+        for stream, buffer in buffers.items():
+            buffer.readFrom(getattr(p, stream))
+        return p
+
+    def _track(self, process):
+        for stream in ('stdout', 'stderr'):
+            if isinstance(process.kwargs.get(stream), OutputBuffer):
+                process.output[stream] = process.kwargs[stream]
+        self.processes.append(process)
+        self.reaper.watch(process)
+
+    def waitAny(self, processes=None, timeout=None):
+        """Block until a process exits or timeout expires.
+
+        @param processes: The Process objects to wait for. Defaults to every
+                          process that is still running.
+        @param timeout: Seconds to wait, or None to wait forever.
+        @return: An exited Process, or None if the timeout expired first.
+        """
+        if processes is None:
+            processes = [p for p in self.processes if p.exitTime is None]
+        return self.reaper.waitAny(processes, timeout)
+
+    def _localSh(self, host, command, ignoreFailures, **kwargs):
+        """Launch a command on this machine without going through ssh.
+
+        The command runs in its own process group, which is later used to
+        signal it and all of its children. This mirrors what regexec does
+        on remote hosts, minus the pidfile.
+        """
+        env = dict(kwargs.pop('env', os.environ))
+        env['LD_LIBRARY_PATH'] = ':'.join(
+            [os.path.expanduser('~/bin'), '/usr/local/lib',
+             env.get('LD_LIBRARY_PATH', '')])
+        launchNanos = monotonicNanos()
+        p = self._popen(shlex.split(command), cwd=os.getcwd(), env=env,
+                        preexec_fn=os.setsid, **dict(kwargs))
+        kwargs['env'] = env
+        process = self.Process(host, command, kwargs, None, p,
+                               ignoreFailures, pgid=p.pid)
+        process.launchNanos = launchNanos
+        self._track(process)
+        return process
+
+    def _agentSh(self, host, command, ignoreFailures, **kwargs):
+        """Launch a command through the agent on host."""
+        with self.agentsLock:
+            agent = self.agents.get(host)
+            if agent is None:
+                agent = Agent.start(host, self.channels)
+                self.agents[host] = agent
+        launchNanos = monotonicNanos()
+        p = agent.launch(command, os.getcwd(), kwargs.get('stdout'),
+                         kwargs.get('stderr'))
+        process = self.Process(host, command, kwargs, None, p, ignoreFailures)
+        process.launchNanos = launchNanos
+        process.agent = agent
+        self._track(process)
+        return process
+
+    def _signalLocal(self, process, sig):
+        """Send sig to the process group of a locally launched process."""
+        try:
+            os.killpg(process.pgid, sig)
+        except OSError:
+            # The whole group has already exited.
+            pass
+
+    def _terminate(self, process, timeout):
+        """Stop a process, escalating from SIGTERM to SIGKILL.
+
+        @param timeout: Seconds to give the process to exit after SIGTERM
+                        before it is sent SIGKILL.
+        @return: The name of the last signal it took, 'SIGTERM' or 'SIGKILL',
+                 or 'timeout' if killpid did not finish in time or the
+                 command never started, in which case it is not known
+                 whether the process is gone.
+        """
+        if process.agent is not None:
+            try:
+                sig = process.agent.kill(process.proc, timeout)
+            except AgentError:
+                # Either it already exited, or the agent is gone, and with
+                # it the process.
+                sig = 'SIGTERM'
+            process.wait()
+            return sig
+        if process.pgid is not None:
+            self._signalLocal(process, signal.SIGTERM)
+            # A paused process only acts on SIGTERM once it runs again.
+            self._signalLocal(process, signal.SIGCONT)
+            if self.reaper.waitAny([process], timeout) is not None:
+                return 'SIGTERM'
+            self._signalLocal(process, signal.SIGKILL)
+            process.wait()
+            return 'SIGKILL'
+        # Assumes scripts are at same path on remote machine. killpid escalates
+        # on its own, after waiting up to timeout for the command to start;
+        # the extra second covers the ssh round trip.
+        killer = subprocess.Popen(self.channels.command(
+                                      process.host,
+                                      '%s/killpid' % scripts_path,
+                                      process.sonce, '%g' % timeout))
+        killed = spawn(killer.wait)
+        if killed.finished.wait(2 * timeout + 1):
+            # 3: the command never wrote its pidfile, so it may still start
+            sig = {2: 'SIGKILL', 3: 'timeout'}.get(killed.result(), 'SIGTERM')
+        else:
+            killer.kill()
+            sig = 'timeout'
+        # Closing the local ssh client is enough once the remote end is gone.
         try:
             process.proc.kill()
         except:
             pass
-        process.proc.wait()
+        process.wait()
+        return sig
+
+    def kill(self, process):
+        """Kill a remote process started with rsh().
+
+        @param process: A Process corresponding to the command to kill which
+                        was created with rsh().
+        """
+        self._terminate(process, self.killTimeout)
         self.processes.remove(process)
 
+    def sendSignal(self, process, sig):
+        """Send a signal to a process started with rsh(), without waiting
+        for it to act on it.
+
+        Locally and through an agent the whole process group is signaled;
+        through ssh only the command regexec ran.
+
+        @param sig: The signal number, e.g. signal.SIGSTOP.
+        """
+        if process.agent is not None:
+            try:
+                process.agent.signal(process.proc, sig)
+            except AgentError:
+                # Either it already exited, or the agent is gone, and with
+                # it the process.
+                pass
+        elif process.pgid is not None:
+            self._signalLocal(process, sig)
+        else:
+            # Assumes scripts are at same path on remote machine
+            subprocess.call(self.channels.command(process.host,
+                                                  '%s/sigpid' % scripts_path,
+                                                  process.sonce, str(sig)))
+
+    def pause(self, process):
+        """Freeze a process with SIGSTOP, as a long GC or I/O stall would,
+        until resume(). It can still be killed while paused."""
+        self.sendSignal(process, signal.SIGSTOP)
+        process.paused = True
+
+    def resume(self, process):
+        """Thaw a process frozen by pause()."""
+        self.sendSignal(process, signal.SIGCONT)
+        process.paused = False
+
     def restart(self, process):
         self.kill(process)
-        self.rsh(process.host, process.command, process.ignoreFailures, True, **process.kwargs)
+        return self.rsh(process.host, process.command, process.ignoreFailures, True, **process.kwargs)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        def stop(process):
+            start = time.time()
+            sig = self._terminate(process, self.killTimeout)
+            return {'host': process.host,
+                    'command': process.command,
+                    'seconds': time.time() - start,
+                    'signal': sig}
+        start = time.time()
         with delayedInterrupts():
-            killers = []
-            for p in self.processes:
-                # Assumes scripts are at same path on remote machine
-                killers.append(subprocess.Popen(['ssh', p.host,
-                                                 '%s/killpid' % scripts_path,
-                                                 p.sonce]))
-            for killer in killers:
-                killer.wait()
-        # a half-assed attempt to clean up zombies
-        for p in self.processes:
-            try:
-                p.proc.kill()
-            except:
-                pass
-            p.proc.wait()
+            self.teardown = parallelMap(stop, self.processes,
+                                        self.teardownWorkers)
+        self.teardownSeconds = time.time() - start
+        self.processes = []
+        with self.agentsLock:
+            agents = list(self.agents.values())
+            self.agents = {}
+        for agent in agents:
+            agent.close()
+        self.channels.close()
+
+    def teardownReport(self):
+        """Return a summary of how long the last __exit__() took."""
+        if not self.teardown:
+            return ''
+        slowest = max(self.teardown, key=lambda t: t['seconds'])
+        lines = ['Stopped %d processes in %.1f ms (slowest %.1f ms: %s on %s)' %
+                 (len(self.teardown), self.teardownSeconds * 1000,
+                  slowest['seconds'] * 1000, slowest['command'],
+                  slowest['host'])]
+        for t in self.teardown:
+            if t['signal'] == 'SIGKILL':
+                lines.append('Needed SIGKILL after %.1f ms: %s on %s' %
+                             (t['seconds'] * 1000, t['command'], t['host']))
+            elif t['signal'] == 'timeout':
+                lines.append('Timed out killing after %.1f ms, may still run: '
+                             '%s on %s' %
+                             (t['seconds'] * 1000, t['command'], t['host']))
+        return '\n'.join(lines)
 
     def checkFailures(self):
         """Raise exception if any process has exited with a non-zero status."""
         for p in self.processes:
             if (p.ignoreFailures == False):
-                rc = p.proc.poll()
+                # Only the Reaper reaps, so read what it recorded.
+                rc = p.proc.returncode
                 if rc is not None and rc != 0:
                     print ('Process exited with status %d (%s)' %
                            (rc, p.command))
                     raise subprocess.CalledProcessError(rc, p.command)
 
+class RshResult(object):
+    """The outcome of one command run by Sandbox.rsh_many()."""
+    def __init__(self, host, command, returncode, stdout, stderr, seconds):
+        self.host = host
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        # Wall-clock seconds from launch until the command exited.
+        self.seconds = seconds
+
+    def __repr__(self):
+        return repr(self.__dict__)
+
+class RshManyResult(object):
+    """The outcomes of all commands run by one Sandbox.rsh_many() call.
+
+    Iterating over it yields RshResults in the order of the hosts given.
+    """
+    def __init__(self, results, seconds):
+        self.results = results
+        # Wall-clock seconds the whole fan-out took.
+        self.seconds = seconds
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, index):
+        return self.results[index]
+
+    def failures(self):
+        """Return the RshResults of the commands that exited non-zero."""
+        return [r for r in self.results if r.returncode != 0]
+
+    def report(self):
+        """Return a one-line summary of the per-host latencies."""
+        latencies = sorted(r.seconds for r in self.results)
+        if not latencies:
+            return 'No commands'
+        return ('%d commands in %.1f ms (per host: min %.1f ms, '
+                'median %.1f ms, max %.1f ms), %d failed' %
+                (len(latencies), self.seconds * 1000, latencies[0] * 1000,
+                 latencies[len(latencies) // 2] * 1000,
+                 latencies[-1] * 1000, len(self.failures())))
+
+class AsyncSandbox(Sandbox):
+    """A Sandbox whose operations can also run concurrently.
+
+    Each *Async method starts the corresponding Sandbox operation in a
+    background thread and returns a Future for its result, so that an
+    operation on many hosts can be fanned out with gather() and take about
+    as long as the slowest host.
+    """
+
+    def rshAsync(self, host, command, ignoreFailures=False, bg=False,
+                 **kwargs):
+        """Like rsh(), but returns a Future for its result."""
+        return spawn(self.rsh, host, command, ignoreFailures, bg, **kwargs)
+
+    def killAsync(self, process):
+        """Like kill(), but returns a Future that completes once killed."""
+        return spawn(self.kill, process)
+
+    def restartAsync(self, process):
+        """Like restart(), but returns a Future for the new Process."""
+        return spawn(self.restart, process)
+
+    def waitAsync(self, process):
+        """Return a Future for the exit status of process."""
+        return spawn(process.wait)
+
+class Future(object):
+    """The eventual result of a call made by spawn()."""
+
+    def __init__(self):
+        self.finished = threading.Event()
+        self.value = None
+        self.error = None
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self):
+        """Block until the call completes.
+
+        @return: The call's return value.
+        @raise: Whatever the call raised.
+        """
+        self.finished.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+def spawn(function, *args, **kwargs):
+    """Call function(*args, **kwargs) in a background thread.
+
+    @return: A Future for the call's result.
+    """
+    future = Future()
+    def run():
+        try:
+            future.value = function(*args, **kwargs)
+        except BaseException as e:
+            future.error = e
+        future.finished.set()
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def gather(futures):
+    """Wait for all of futures to complete.
+
+    @return: Their results, in the same order.
+    @raise: The first error raised by any of them, once all have completed.
+    """
+    for future in futures:
+        future.finished.wait()
+    return [future.result() for future in futures]
+
+def parallelMap(function, items, workers):
+    """Call function on each of items, at most workers of them at a time.
+
+    @return: The results, in the same order as items.
+    @raise: The first error raised by any call, once all have completed.
+    """
+    items = list(items)
+    futures = [Future() for item in items]
+    pending = list(zip(items, futures))
+    lock = threading.Lock()
+    def work():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                item, future = pending.pop(0)
+            try:
+                future.value = function(item)
+            except BaseException as e:
+                future.error = e
+            future.finished.set()
+    threads = [threading.Thread(target=work)
+               for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return gather(futures)
+
+def toStr(data):
+    """Return the captured bytes data as a native str."""
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+_CLOCK_MONOTONIC = 1
+try:
+    _clockGettime = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                                use_errno=True).clock_gettime
+    _clockGettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+except (OSError, AttributeError):
+    _clockGettime = None
+
+def monotonicNanos():
+    """Return the time on the monotonic clock in nanoseconds.
+
+    It does not jump when the system time is set, and it is the clock that
+    Benchmark --phases reports in, so the two can be compared for clients
+    run on this machine. Falls back to time.time() where clock_gettime is
+    not available.
+    """
+    if _clockGettime is None:
+        return int(time.time() * 1e9)
+    now = _Timespec()
+    if _clockGettime(_CLOCK_MONOTONIC, ctypes.byref(now)) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return now.tv_sec * 1000000000 + now.tv_nsec
+
+def isLocalHost(host):
+    """Return True if host names this machine's loopback interface."""
+    return host == 'localhost' or host.startswith('127.')
+
+def freePorts(count, host='127.0.0.1'):
+    """Return count distinct TCP ports that are currently free on host.
+
+    The kernel picks them, from its ephemeral range, so runs allocating
+    ports at the same time do not collect the same ones. Nothing holds
+    the ports afterwards, though, so use them right away.
+    """
+    sockets = []
+    try:
+        for i in range(count):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(s)
+            s.bind((host, 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
 @contextlib.contextmanager
 def delayedInterrupts():
-    """Block SIGINT and SIGTERM temporarily."""
+    """Block SIGINT and SIGTERM temporarily.
+
+    Signals are only delivered to the main thread, and only it may set
+    handlers, so elsewhere (e.g. runs sharing a process) this does nothing.
+    """
+    if threading.current_thread().name != 'MainThread':
+        yield None
+        return
     quit = []
     def delay(sig, frame):
         if quit:
@@ -27,7 +27,8 @@ import subprocess
 import sys
 
 __all__ = ['git_branch',
-        'hosts', 'obj_dir', 'obj_path', 'scripts_path',
+        'host_attributes', 'hosts', 'loopback_hosts', 'obj_dir', 'obj_path',
+        'scripts_path',
         'smokehosts',
         'top_path']
 
@@ -77,6 +78,23 @@ for i in range(1, 61):
 # The set of hosts available for basic correctness testing.
 smokehosts = hosts
 
+# Attributes of the hosts, by host name (for ssh), for clusters whose hosts
+# differ, e.g. {'rc07': {'disk': 'hdd', 'cores': 4}}. A TestFramework can
+# derive per-server settings from them (see its hostOverrides).
+host_attributes = {}
+
+def loopback_hosts(servers, base_port=5254, ports=None):
+    """
+    Returns a hosts list, in the same form as hosts, for a cluster of servers that
+    all run on this machine: each one listens on its own port of the loopback
+    interface, starting at base_port (LogCabin's default port), or on the given
+    list of ports.
+    """
+    if ports is None:
+        ports = range(base_port, base_port + servers)
+    return [('localhost', '127.0.0.1:%d' % port, i + 1)
+            for i, port in enumerate(ports[:servers])]
+
 # Full path to the directory containing RAMCloud executables.
 obj_path = '%s/%s' % (top_path, obj_dir)
 
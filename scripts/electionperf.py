@@ -15,16 +15,43 @@
 
 """
 This runs a LogCabin cluster and continually kills off the leader, timing how
-long each leader election takes.
+long each leader election takes. With --stall, it instead freezes the leader for
+a while (as a GC, disk or VM pause would) while a client writes to the cluster,
+and counts the needless elections, the time without a usable leader and the
+client's retries.
+
+Usage:
+  electionperf.py [options]
+  electionperf.py (-h | --help)
+
+Options:
+  -h --help            Show this help message and exit
+  --local=<sizes>      Comma-separated cluster sizes (e.g. 3,7,15,31) to run on this
+                       machine, on loopback ports, instead of one server per host in
+                       localconfig.py.
+  --parallel=<n>       Run this many experiments at once, each on its own cluster: the
+                       hosts are split into n clusters, or n loopback clusters are run
+                       with --local [default: 1]
+  --network=<kind>     Put a fault-injecting network between the local servers: netns
+                       (network namespaces and tc netem, needs root) or proxy (a TCP
+                       proxy in front of each server). Needs --local.
+  --rtt=<ms>           Comma-separated round-trip times to add between all servers on the
+                       network [default: 0]
+  --stall=<ms>         Comma-separated durations to freeze the leader for, instead of
+                       killing it. Results go to electionperf_stalls.csv.
 """
 
 from __future__ import print_function
 
+import calendar
 import time
 import sys
 import re
+import threading
+from docopt import docopt
 
 from TestFramework import TestFramework, run_shell_command
+from scheduler import Scheduler
 
 class ElectionTest(TestFramework):
     # Metadata from experiments to be stored in the csv file
@@ -33,26 +60,49 @@ class ElectionTest(TestFramework):
     # Experiment identifier
     experiment_id = 0
 
+    # Guards the metadata and identifier above against experiments running in parallel
+    metadata_lock = threading.Lock()
+
     # Path to the csv file for the plot
     csv_file = "scripts/plot/csv/electionperf.csv"
+    stall_csv_file = "scripts/plot/csv/electionperf_stalls.csv"
     plot_file = "scripts/plot/plot_electionperf.py"
 
     # The value 500 ms is suggested by the creators
-    def __init__(self, electionTimeoutMilliseconds=500):
+    def __init__(self, electionTimeoutMilliseconds=500, local_servers=None, **kwargs):
         # Initialize the parent class
         TestFramework.__init__(
             self,
-            electionTimeoutMilliseconds=electionTimeoutMilliseconds
+            electionTimeoutMilliseconds=electionTimeoutMilliseconds,
+            local_servers=local_servers,
+            **kwargs
         )
 
-        # Assign an experiment id
-        self.experiment_id = ElectionTest.experiment_id
-        ElectionTest.experiment_id += 1
+        self.electionTimeout = electionTimeoutMilliseconds
+
+        # Set by new_experiment
+        self.experiment_id = None
 
-        # Initialize the metadata for the experiment
-        ElectionTest.experiment_metadata[self.experiment_id] = {}
+    def new_experiment(self):
+        """
+        Start a new experiment on this cluster, with an id and metadata of its own, and return its
+        metadata. A cluster that is reused across points runs a new experiment for each of them.
+        """
 
-        ElectionTest.experiment_metadata[self.experiment_id]["electionTimeout"] = electionTimeoutMilliseconds
+        with ElectionTest.metadata_lock:
+            # Assign an experiment id
+            self.experiment_id = ElectionTest.experiment_id
+            ElectionTest.experiment_id += 1
+
+            # Initialize the metadata for the experiment
+            metadata = {
+                "electionTimeout": self.electionTimeout,
+                "servers": len(self.server_ids_ips),
+                "rtt": 0
+            }
+            ElectionTest.experiment_metadata[self.experiment_id] = metadata
+
+        return metadata
 
     def _same(self, lst):
         """
@@ -62,49 +112,29 @@ class ElectionTest(TestFramework):
         return len(set(lst)) == 1
     
     def _await_stable_leader(self, after_term=0):
-        while True:
-            server_beliefs = {}
-
-            # Only the running servers are considered, whereas the self.server_ids_ips contains all
-            # servers in the cluster.
-            for server_id_ip, server_process in self.server_processes.items():
-                server_beliefs[server_id_ip] = {'leader_id_ip': None,
-                                                'term': None,
-                                                'wake': None}
-                b = server_beliefs[server_id_ip]
-
-                for line in open('debug/server_%d' % server_id_ip[0]):
-
-                    m = re.search('All hail leader (\d+) for term (\d+)', line)
-                    if m is not None:
-                        b['leader_id_ip'] = filter(
-                                lambda server_id_ip: server_id_ip[0] == int(m.group(1)), 
-                                self.server_ids_ips)[0]
-                        b['term'] = int(m.group(2))
-                        continue
-
-                    m = re.search('Now leader for term (\d+)', line)
-                    if m is not None:
-                        b['leader_id_ip'] = server_id_ip
-                        b['term'] = int(m.group(1))
-                        continue
-
-                    m = re.search('Running for election in term (\d+)', line)
-                    if m is not None:
-                        b['wake'] = int(m.group(1))
-
-            terms = [b['term'] for b in server_beliefs.values()]
-            leaders_ids_ips = [b['leader_id_ip'] for b in server_beliefs.values()]
-
-            if self._same(terms) and terms[0] > after_term:
-                assert self._same(leaders_ids_ips), server_beliefs
-
-                return {'leader_id_ip': leaders_ids_ips[0],
-                        'term': terms[0],
-                        'num_woken': sum([1 for b in server_beliefs.values() if b['wake'] > after_term])}
-            else:
-                time.sleep(.25)
-                self.sandbox.checkFailures()
+        with self.event_bus().subscribe(lambda e: e.kind != 'stats') as changes:
+            while True:
+                # Only the running servers are considered, whereas the self.server_ids_ips
+                # contains all servers in the cluster. The log index only parses what was logged
+                # since last time.
+                server_beliefs = self.log_index.states()
+
+                terms = [b.term for b in server_beliefs.values()]
+                leaders = [b.leader for b in server_beliefs.values()]
+
+                if self._same(terms) and terms[0] > after_term:
+                    assert self._same(leaders), server_beliefs
+
+                    leader_id_ip = filter(lambda server_id_ip: server_id_ip[0] == leaders[0],
+                                          self.server_ids_ips)[0]
+                    return {'leader_id_ip': leader_id_ip,
+                            'term': terms[0],
+                            'num_woken': sum([1 for b in server_beliefs.values()
+                                              if b.wake > after_term])}
+                else:
+                    # Check again once a server's view of the leadership changes, a server exits or
+                    # 250 ms have passed
+                    changes.wait(time.time() + .25)
 
     def election_performance(self, repeat=100):
         print("\n\n==============")
@@ -122,11 +152,23 @@ class ElectionTest(TestFramework):
             old = self._await_stable_leader()
             print('Server %d is the leader in term %d' % (old['leader_id_ip'][0], old['term']))
 
-            self._kill_server(old['leader_id_ip'])
-
-            start_time = time.time()
-            new = self._await_stable_leader(after_term=old['term'])
-            end_time = time.time()
+            # The election starts when the kill is sent (killing takes a while, and the new leader
+            # may already be elected when it returns) and ends when the new leader logs that it is
+            # one; the bus stamps that line as it is written, whereas polling would see it later
+            with self.event_bus().subscribe(
+                    lambda e: e.kind == 'leader' and e.term > old['term']) as elected:
+                start_time = time.time()
+                self._kill_server(old['leader_id_ip'])
+
+                new = self._await_stable_leader(after_term=old['term'])
+                end_time = time.time()
+                while True:
+                    event = elected.wait(end_time + 1)
+                    if event is None or event.term == new['term']:
+                        break
+                if event is not None:
+                    end_time = event.time
+            assert end_time >= start_time, (start_time, end_time)
             print('Server %d is the leader in term %d' % (new['leader_id_ip'][0], new['term']))
             ElectionTest.experiment_metadata[self.experiment_id]["duration"].append(end_time - start_time)
 
@@ -154,27 +196,167 @@ class ElectionTest(TestFramework):
         print('\n'.join(['%d: %d' % (i + 1, n) for (i, n) in enumerate(num_woken)]),
             file=sys.stderr)
 
+    @staticmethod
+    def _log_time(line):
+        """
+        Return the time.time() at which LogCabin logged a line, from its UTC timestamp.
+        """
+
+        return (calendar.timegm(time.strptime(line[:19], '%Y-%m-%d %H:%M:%S')) +
+                int(line[20:26]) / 1e6)
+
+    def _await_time(self, deadline):
+        """
+        Wait until deadline, checking for failures whenever a process exits.
+        """
+
+        while True:
+            self.sandbox.checkFailures()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            self.sandbox.waitAny(timeout=remaining)
+
+    def stall_performance(self, repeat=20, stall=300):
+        """
+        Freeze the leader for stall milliseconds, repeatedly, while a Benchmark client writes to the
+        cluster. For every stall, records the terms it cost, whether the leader changed, the
+        seconds the cluster had no usable leader (from the pause until the frozen leader resumed or
+        a new one took over) and the retries of the client.
+        """
+
+        print("\n\n====================")
+        print("New Stall Experiment")
+        print("====================\n\n")
+
+        metadata = ElectionTest.experiment_metadata[self.experiment_id]
+        metadata["stall"] = stall
+        metadata["elections"] = repeat
+        metadata["terms"] = []
+        metadata["leader_changed"] = []
+        metadata["unavailable"] = []
+        metadata["retries"] = []
+
+        electionTimeout = metadata["electionTimeout"] / 1000.0
+
+        # Writes until it is killed, retrying through every stall
+        client = self.execute_client_command(
+            client_executable="build/Examples/Benchmark",
+            conf={
+                "options": "--writes=1000000000 --timeout=86400s",
+                "command": ""
+            },
+            bg=True
+        )
+        client_command = self.client_commands
+        client_lines = 0
+
+        try:
+            for i in range(repeat):
+                old = self._await_stable_leader()
+                print('Server %d is the leader in term %d' % (old['leader_id_ip'][0], old['term']))
+
+                paused, resumed = self._stall_server(old['leader_id_ip'], stall)
+
+                # A follower may still time out just after the leader resumes, before its
+                # heartbeats arrive
+                self._await_time(resumed + electionTimeout)
+
+                woken = [b.wake for b in self.log_index.states().values()
+                         if b.wake is not None and b.wake > old['term']]
+
+                if woken:
+                    new = self._await_stable_leader(after_term=max(woken) - 1)
+                    recovered = time.time()
+                    for line in self.server_log(new['leader_id_ip'][0]):
+                        if 'Now leader for term %d' % new['term'] in line:
+                            recovered = self._log_time(line)
+                else:
+                    new = old
+                    recovered = resumed
+
+                print('Server %d is the leader in term %d' % (new['leader_id_ip'][0], new['term']))
+                metadata["terms"].append(new['term'] - old['term'])
+                metadata["leader_changed"].append(new['leader_id_ip'] != old['leader_id_ip'])
+                metadata["unavailable"].append(recovered - paused)
+
+                # Give the client time to find the leader, and count the attempts it took
+                self._await_time(time.time() + electionTimeout)
+                retries = 0
+                lines = list(self.client_log(client_command))
+                for line in lines[client_lines:]:
+                    m = re.search('Successfully connected to leader .* after (\d+) failures', line)
+                    if m is not None:
+                        retries += int(m.group(1))
+                client_lines = len(lines)
+                metadata["retries"].append(retries)
+
+                print('Stall of %d ms: %d terms, %.1f ms without a leader, %d client retries' % (
+                    stall, metadata["terms"][-1], metadata["unavailable"][-1] * 1000, retries))
+        finally:
+            if client is not None:
+                self.sandbox.kill(client)
+
+        print('Spurious elections: %d of %d stalls' % (
+            sum([1 for terms in metadata["terms"] if terms > 0]), repeat),
+            file=sys.stderr)
+
     @staticmethod
     def _write_csv():
         with open("%s" % ElectionTest.csv_file, 'w') as f:
-            f.write("elections;time;electionTimeout;terms\n")
+            f.write("elections;time;electionTimeout;terms;servers;rtt\n")
 
             for _, metadata in ElectionTest.experiment_metadata.items():
+                if "stall" in metadata:
+                    continue
                 elections = metadata["elections"]
                 duration = metadata["duration"]
                 electionTimeout = metadata["electionTimeout"]
                 terms = metadata["terms"]
+                servers = metadata["servers"]
+                rtt = metadata["rtt"]
 
                 for time, term in zip(duration, terms):
-                    f.write('%d;%f;%.2f;%d\n' % (
+                    f.write('%d;%f;%.2f;%d;%d;%.2f\n' % (
                         elections,
                         time,
                         electionTimeout,
-                        term)
+                        term,
+                        servers,
+                        rtt)
+                    )
+
+    @staticmethod
+    def _write_stall_csv():
+        with open("%s" % ElectionTest.stall_csv_file, 'w') as f:
+            f.write("stall;electionTimeout;servers;rtt;terms;leaderChanged;unavailable;retries\n")
+
+            for _, metadata in ElectionTest.experiment_metadata.items():
+                if "stall" not in metadata:
+                    continue
+
+                for terms, leader_changed, unavailable, retries in zip(
+                        metadata["terms"], metadata["leader_changed"],
+                        metadata["unavailable"], metadata["retries"]):
+                    f.write('%d;%.2f;%d;%.2f;%d;%d;%f;%d\n' % (
+                        metadata["stall"],
+                        metadata["electionTimeout"],
+                        metadata["servers"],
+                        metadata["rtt"],
+                        terms,
+                        leader_changed,
+                        unavailable,
+                        retries)
                     )
 
     @staticmethod
     def plot():
+        if any(["stall" in metadata for metadata in ElectionTest.experiment_metadata.values()]):
+            ElectionTest._write_stall_csv()
+            print("\nStall results written to %s" % ElectionTest.stall_csv_file)
+        if all(["stall" in metadata for metadata in ElectionTest.experiment_metadata.values()]):
+            return
+
         ElectionTest._write_csv()
 
         print("\nPlotting electionperf results")
@@ -184,32 +366,94 @@ class ElectionTest(TestFramework):
         except Exception as e:
             print("Error: %s" % e)
 
-def run_experiments(electionTimeouts):
+def run_experiments(electionTimeouts, local_sizes=[None], parallel=1, network=None, rtts=[0],
+                    stalls=[None]):
     """
-    Runs experiment with different electionTimeouts for a number of repeats.
+    Runs experiment with different electionTimeouts for a number of repeats, on each of the
+    local cluster sizes (None runs on the hosts in localconfig.py). Up to parallel experiments
+    run at once, each on its own cluster. With a network (see netfaults.py), each experiment is
+    also run with each of the round-trip times rtts (in ms) added between the servers. With
+    stalls (in ms), the leader is frozen for each of them rather than killed.
     """
     repeat = 100
 
-    for electionTimeout in electionTimeouts:
+    def run_point(fixture, point):
+        local_servers, rtt, stall, electionTimeout = point
+
         print("\n\n================================")
-        print("electionTimeout: %d, repeats: %d" % (electionTimeout, repeat))
+        print("electionTimeout: %d, repeats: %d, local servers: %s, rtt: %s ms, stall: %s ms" % (
+            electionTimeout, repeat, local_servers, rtt, stall))
         print("================================\n\n")
 
-        test = ElectionTest(electionTimeout)
-        test.create_configs()
-        test.create_folders()
-
-        test.initialize_cluster()
+        params = {"electionTimeoutMilliseconds": electionTimeout}
+        if local_servers:
+            params["local_servers"] = local_servers
+        if network:
+            params["network"] = network
+        test = fixture.acquire(**params)
+        test.new_experiment()
 
-        test.election_performance(repeat=repeat)
+        try:
+            if network:
+                # Half of the round trip on each direction
+                test.set_link(None, None, delay=rtt / 2.0)
+                ElectionTest.experiment_metadata[test.experiment_id]["rtt"] = rtt
+            if stall is None:
+                test.election_performance(repeat=repeat)
+            else:
+                test.stall_performance(repeat=repeat, stall=stall)
+        finally:
+            # A failed experiment is retried as a new one
+            with ElectionTest.metadata_lock:
+                metadata = ElectionTest.experiment_metadata.pop(test.experiment_id)
+
+        return [metadata]
+
+    points = [(local_servers, rtt, stall, electionTimeout)
+              for local_servers in local_sizes
+              for rtt in rtts
+              for stall in stalls
+              for electionTimeout in electionTimeouts]
+
+    local = [size for size in local_sizes if size]
+    scheduler = Scheduler(
+        factory = ElectionTest,
+        clusters = parallel,
+        local_servers = max(local) if local else None,
+        debug = True
+    )
+    rows = scheduler.run(points, run_point)
 
-        test.cleanup(debug=True)
+    # Merge the results of all clusters, in the order of the points
+    for metadata in rows:
+        with ElectionTest.metadata_lock:
+            ElectionTest.experiment_metadata[ElectionTest.experiment_id] = metadata
+            ElectionTest.experiment_id += 1
 
 def main():
+    arguments = docopt(__doc__)
+
     electionTimeouts = [500, 250, 100, 50, 10]
 
+    local_sizes = [None]
+    if arguments['--local']:
+        local_sizes = [int(size) for size in arguments['--local'].split(',')]
+
+    network = arguments['--network']
+    if network and local_sizes == [None]:
+        sys.exit('--network needs --local')
+    rtts = [float(rtt) for rtt in arguments['--rtt'].split(',')]
+    stalls = [None]
+    if arguments['--stall']:
+        stalls = [int(stall) for stall in arguments['--stall'].split(',')]
+
     run_experiments(
         electionTimeouts=electionTimeouts,
+        local_sizes=local_sizes,
+        parallel=int(arguments['--parallel']),
+        network=network,
+        rtts=rtts if network else [0],
+        stalls=stalls
     )
 
     ElectionTest.plot()
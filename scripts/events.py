@@ -0,0 +1,329 @@
+"""
+Events from the servers' logs, raised as soon as the lines are written. An EventBus follows the
+logs of the servers of a TestFramework from a thread of its own, which sleeps until there is
+something new to read: inotify tells it when a debug file is written, OutputBuffers call it when
+captured lines arrive, and the Reaper when a process exits. Callers subscribe with a predicate and
+wait for the next matching event, up to a deadline.
+
+Each event is stamped with the time the harness saw its line (the arrival time of a captured line,
+or the time a debug file was read right after inotify reported the write), on the same clock as
+time.time(). Without inotify, the debug files are polled every POLL_INTERVAL seconds.
+"""
+
+from __future__ import print_function
+
+import collections
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import re
+import select
+import threading
+import time
+
+from logtail import LEADERSHIP, LogTail
+
+# How often the debug files are read where inotify is not available
+POLL_INTERVAL = .01
+
+STATS = re.compile(r'ServerStats:')
+
+_IN_NONBLOCK = 0o4000
+_IN_CLOEXEC = 0o2000000
+_IN_MODIFY = 0x2
+_IN_CLOSE_WRITE = 0x8
+_IN_CREATE = 0x100
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_init1.argtypes = [ctypes.c_int]
+    _inotify_add_watch = _libc.inotify_add_watch
+    _inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+except (OSError, AttributeError):
+    _inotify_init1 = None
+
+def watch_directory(path):
+    """
+    Return a file descriptor that becomes readable whenever a file in the directory is created or
+    written, or None if inotify is not available.
+    """
+
+    if _inotify_init1 is None:
+        return None
+    fd = _inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+    if fd < 0:
+        return None
+    if not isinstance(path, bytes):
+        path = path.encode()
+    if _inotify_add_watch(fd, path, _IN_MODIFY | _IN_CLOSE_WRITE | _IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def _drain(fd):
+    """
+    Read everything there is to read from a non-blocking file descriptor.
+    """
+
+    while True:
+        try:
+            if not os.read(fd, 65536):
+                return
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            if e.errno != errno.EINTR:
+                raise
+
+def _set_nonblocking(fd):
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+class ServerEvent(object):
+    """
+    A line of a server's log that matters to the harness. kind is one of:
+
+      leader     The server became leader for term
+      hail       The server acknowledged leader as the leader of term
+      election   The server ran for election in term
+      stats      The server dumped its statistics (see ServerControl stats dump)
+    """
+
+    def __init__(self, kind, server_id, time, line, term=None, leader=None):
+        self.kind = kind
+        self.server_id = server_id
+        self.time = time
+        self.line = line
+        self.term = term
+        self.leader = leader
+
+    @classmethod
+    def parse(cls, server_id, time, line):
+        """
+        Return the event a line of the log of the given server stands for, or None.
+        """
+
+        m = LEADERSHIP.search(line)
+        if m is not None:
+            if m.group('hail') is not None:
+                return cls('hail', server_id, time, line, term=int(m.group('hail_term')),
+                           leader=int(m.group('hail')))
+            if m.group('led_term') is not None:
+                return cls('leader', server_id, time, line, term=int(m.group('led_term')),
+                           leader=server_id)
+            return cls('election', server_id, time, line, term=int(m.group('wake')))
+        if STATS.search(line) is not None:
+            return cls('stats', server_id, time, line)
+        return None
+
+    def __repr__(self):
+        return 'ServerEvent(%s, server %d, term %s, leader %s, at %.6f)' % (
+            self.kind, self.server_id, self.term, self.leader, self.time)
+
+class Subscription(object):
+    """
+    The events of an EventBus that match a predicate, in the order they were raised.
+    """
+
+    def __init__(self, bus, predicate):
+        self.bus = bus
+        self.predicate = predicate
+        # Matching events not returned by wait yet
+        self.pending = collections.deque()
+        # Every matching event so far
+        self.events = []
+        # Readable once there are pending events; also handed to the Reaper while waiting
+        self.wake_r, self.wake_w = os.pipe()
+        _set_nonblocking(self.wake_r)
+        self.lock = threading.Lock()
+        self.signalled = False
+        self.cancelled = False
+
+    def _deliver(self, events):
+        matching = [event for event in events if self.predicate(event)]
+        if not matching:
+            return
+        with self.lock:
+            if self.cancelled:
+                return
+            self.pending.extend(matching)
+            self.events.extend(matching)
+            if not self.signalled:
+                self.signalled = True
+                os.write(self.wake_w, b'x')
+
+    def wait(self, deadline=None):
+        """
+        Return the next matching event, or None if there was none by deadline (a time.time()),
+        with None waiting for as long as it takes. The sandbox is checked for failed processes
+        whenever one exits.
+        """
+
+        reaper = self.bus.test.sandbox.reaper
+        reaper.addWaiter(self.wake_w)
+        try:
+            while True:
+                self.bus.test.sandbox.checkFailures()
+                with self.lock:
+                    if self.pending:
+                        return self.pending.popleft()
+                    self.signalled = False
+                if deadline is None:
+                    remaining = None
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                try:
+                    select.select([self.wake_r], [], [], remaining)
+                except select.error as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                _drain(self.wake_r)
+        finally:
+            reaper.removeWaiter(self.wake_w)
+
+    def cancel(self):
+        """
+        Stop receiving events.
+        """
+
+        self.bus.unsubscribe(self)
+        with self.lock:
+            if self.cancelled:
+                return
+            self.cancelled = True
+            os.close(self.wake_r)
+            os.close(self.wake_w)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.cancel()
+
+class EventBus(object):
+    """
+    Raises the events of the logs of the running servers of a TestFramework, in a thread of its
+    own, until closed.
+    """
+
+    def __init__(self, test):
+        self.test = test
+        self.subscriptions = []
+        # Server id to the LogTail following its log since it was last started
+        self.tails = {}
+        # The OutputBuffers that wake the thread when lines arrive
+        self.buffers = set()
+        self.lock = threading.Lock()
+        self.poked = False
+        self.closed = False
+
+        self.inotify = watch_directory(test.debug_path(''))
+        self.wake_r, self.wake_w = os.pipe()
+        _set_nonblocking(self.wake_r)
+        test.sandbox.reaper.addWaiter(self.wake_w)
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def subscribe(self, predicate):
+        """
+        Return a Subscription to the events raised from now on for which predicate is true.
+        """
+
+        subscription = Subscription(self, predicate)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def poke(self):
+        """
+        Make the thread look for new lines, e.g. once a server has been started.
+        """
+
+        with self.lock:
+            if self.poked or self.closed:
+                return
+            self.poked = True
+            os.write(self.wake_w, b'x')
+
+    def _run(self):
+        fds = [self.wake_r]
+        timeout = POLL_INTERVAL
+        if self.inotify is not None:
+            fds.append(self.inotify)
+            timeout = None
+
+        while True:
+            try:
+                ready = select.select(fds, [], [], timeout)[0]
+            except select.error as e:
+                if e.args[0] != errno.EINTR:
+                    raise
+                continue
+            for fd in ready:
+                _drain(fd)
+            with self.lock:
+                # Lines arriving from now on poke again
+                self.poked = False
+                if self.closed:
+                    return
+                subscriptions = list(self.subscriptions)
+
+            events = self._read()
+            for subscription in subscriptions:
+                subscription._deliver(events)
+
+    def _read(self):
+        """
+        Return the events of the lines logged since the last read.
+        """
+
+        events = []
+        for server_id, buffer in list(self.test.server_logs.items()):
+            if buffer not in self.buffers:
+                self.buffers.add(buffer)
+                buffer.addListener(self.poke)
+
+        for server_id_ip in list(self.test.server_processes.keys()):
+            server_id = server_id_ip[0]
+            started = self.test.server_start_times.get(server_id_ip)
+            tail = self.tails.get(server_id)
+            if tail is None or tail.started != started:
+                tail = LogTail(server_id, started)
+                self.tails[server_id] = tail
+
+            for arrival, line in tail.read(self.test):
+                event = ServerEvent.parse(server_id, arrival, line)
+                if event is not None:
+                    events.append(event)
+
+        events.sort(key=lambda event: event.time)
+        return events
+
+    def close(self):
+        """
+        Stop the thread and release its file descriptors.
+        """
+
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            os.write(self.wake_w, b'x')
+        self.thread.join()
+
+        self.test.sandbox.reaper.removeWaiter(self.wake_w)
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+        if self.inotify is not None:
+            os.close(self.inotify)
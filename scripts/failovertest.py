@@ -28,6 +28,12 @@ Options:
   --binary=<cmd>       Server binary to execute [default: build/LogCabin]
   --reconf=<opts>      Additional options to pass through to the Reconfigure
                        binary. [default: '']
+  --parallel=<n>       Split the hosts into this many clusters and run that many
+                       experiments at once [default: 1]
+  --policy=<policy>    Which servers to kill: random, leader, follower or majority
+                       (see faults.py) [default: random]
+  --seed=<seed>        Seed of the fault schedules; run r of the sweep uses seed + r.
+                       Picked at random by default and recorded in the results.
 """
 
 import random
@@ -35,16 +41,19 @@ import time
 
 from docopt import docopt
 from TestFramework import TestFramework, run_shell_command
+from scheduler import Scheduler
+from faults import FaultSchedule, FaultInjector
 
 class FailoverTest(TestFramework):
-    def __init__(self):
-        TestFramework.__init__(self)
+    # Path to the csv file for the plot
+    csv_file = "scripts/plot/csv/failover.csv"
+    plot_file = "scripts/plot/plot_failover.py"
+
+    def __init__(self, **kwargs):
+        TestFramework.__init__(self, **kwargs)
         # Hold metadata from each experiment.
         # E.g. start and end time, kill interval, launch delay
         self.experiment_metadata = {}
-        # Path to the csv file for the plot
-        self.csv_file = "scripts/plot/csv/failover.csv"
-        self.plot_file = "scripts/plot/plot_failover.py"
     
     def run_failovertest(self, writes, run):
 
@@ -71,74 +80,84 @@ class FailoverTest(TestFramework):
         test_process,
         server_command,
         killinterval,
-        launchdelay
+        launchdelay,
+        policy = 'random',
+        seed = None
     ):
         """ 
-        Randomly kill a server in the cluster at a given interval and restart it after a given
-        delay. The process is repeated until the failovertest exits. The presence of errors is
-        checked.
+        Kill servers in the cluster according to the policy at a given interval and restart them
+        after a given delay, following a seeded fault schedule (see faults.py). The process is
+        repeated until the failovertest exits. The presence of errors is checked. The executed
+        schedule is logged to the faults_N debug file.
 
         Important: The killinerval should be greater or equal to the launchdelay.
         """
 
-        self.experiment_metadata[self.client_commands]["kill_interval"] = killinterval
-        self.experiment_metadata[self.client_commands]["launch_delay"] = launchdelay
-
-        start = time.time()
-        lastkill = start
-        tolaunch = [] # [(time to launch, server id)]
-
-        while True:
-            time.sleep(.1)
+        schedule = FaultSchedule(policy, killinterval, launchdelay, seed)
 
-            self.sandbox.checkFailures()
-            now = time.time()
+        metadata = self.experiment_metadata[self.client_commands]
+        metadata["kill_interval"] = killinterval
+        metadata["launch_delay"] = launchdelay
+        metadata["policy"] = policy
+        metadata["seed"] = schedule.seed
 
-            # Check if the failovertest exited
-            if test_process.proc.poll() is not None:
-                self.experiment_metadata[self.client_commands]["end_time"] = time.time()
-                # Revive killed servers to start (probably) next test fresh
-                for server_id_ip in self.server_ids_ips:
-                    if server_id_ip not in self.server_processes.keys():
-                        self._start_server(server_command, server_id_ip)
-                # Exit infinite loop
-                break
+        injector = FaultInjector(self, schedule, server_command)
+        metadata["end_time"] = injector.run(until=test_process)
+        injector.write_log(self.debug_path('faults_%d' % self.client_commands))
 
-            # Check if the kill interval has been met
-            if now - lastkill > killinterval:
-                server_id_ip = random.choice(self.server_processes.keys())
+        # Revive killed servers to start (probably) next test fresh
+        injector.restore()
 
-                self._kill_server(server_id_ip)
+    def failover_experiment(
+        self,
+        server_command,
+        writes,
+        killinterval,
+        launchdelay,
+        run,
+        policy = 'random',
+        seed = None
+    ):
+        """
+        Run the failovertest while killing servers, and return the metadata of the experiment.
+        """
 
-                lastkill = now
-                tolaunch.append((now + launchdelay, server_id_ip))
+        process = self.run_failovertest(writes, run)
+        self.random_server_kill(process, server_command, killinterval, launchdelay, policy, seed)
 
-            # Check if lanchdelay has been met and there are servers to launch
-            while tolaunch and now > tolaunch[0][0]:
-                server_id_ip = tolaunch.pop(0)[1]
-                self._start_server(server_command, server_id_ip)
+        return self.experiment_metadata[self.client_commands]
 
-    def _write_csv(self):
-        with open("%s" % self.csv_file, 'w') as f:
-            f.write("time;writes;killinterval;launchdelay;run\n")
+    @staticmethod
+    def _write_csv(experiment_metadata):
+        with open("%s" % FailoverTest.csv_file, 'w') as f:
+            f.write("time;writes;killinterval;launchdelay;run;policy;seed\n")
 
-            for _, metadata in self.experiment_metadata.items():
-                f.write('%f;%d;%d;%d;%d\n' % (
+            for _, metadata in experiment_metadata.items():
+                f.write('%f;%d;%d;%d;%d;%s;%d\n' % (
                     metadata["end_time"] - metadata["start_time"],
                     int(metadata["writes"]),
                     metadata["kill_interval"],
                     metadata["launch_delay"],
-                    metadata["run"])
+                    metadata["run"],
+                    metadata["policy"],
+                    metadata["seed"])
                 )
 
-    def plot(self):
-        self._write_csv()
-        self._print_string("\nPlotting failover results")
+    @staticmethod
+    def plot(experiment_metadata):
+        """
+        Write the metadata of the experiments (of any number of clusters) to the csv file and
+        plot it.
+        """
+
+        FailoverTest._write_csv(experiment_metadata)
+
+        print("\nPlotting failover results")
+        print("-------------------------")
         try:
-            run_shell_command('python3 %s' % self.plot_file)
+            run_shell_command('python3 %s' % FailoverTest.plot_file)
         except Exception as e:
-            self._print_string("Error: %s" % e)
-            self.cleanup()
+            print("Error: %s" % e)
 
 def main():
     # Parse command line arguments
@@ -156,30 +175,45 @@ def main():
     killintervals = [4, 4, 4, 6, 6, 6, 8, 8, 8]
     launchdelays = [1, 2, 3, 1, 3, 5, 1, 4, 7]
 
-    # Run the test
-    test = FailoverTest()
-
-    test.create_configs()
-    test.create_folders()
-
-    test.initialize_cluster(server_command, reconf_opts)
-
-    for run in range(runs):
-        for writes in writes_array:
-            for killinterval, launchdelay in zip(killintervals, launchdelays):
-                print("\n============================================")
-                print("writes: %d, killinterval: %d, launchdelay: %d" % (
-                    writes,
-                    killinterval,
-                    launchdelay)
-                )
-                print("============================================")
-
-                process = test.run_failovertest(writes, run)
-                test.random_server_kill(process, server_command, killinterval, launchdelay)
-
-    test.plot()
-    test.cleanup()
+    policy = arguments['--policy']
+    if arguments['--seed'] is not None:
+        seed = int(arguments['--seed'])
+    else:
+        seed = random.randrange(2 ** 31)
+    print("Fault policy: %s, seed: %d" % (policy, seed))
+
+    points = [(run, writes, killinterval, launchdelay)
+              for run in range(runs)
+              for writes in writes_array
+              for killinterval, launchdelay in zip(killintervals, launchdelays)]
+
+    def run_point(fixture, point):
+        run, writes, killinterval, launchdelay = point
+
+        print("\n============================================")
+        print("writes: %d, killinterval: %d, launchdelay: %d" % (
+            writes,
+            killinterval,
+            launchdelay)
+        )
+        print("============================================")
+
+        # The same cluster is kept for all the points it runs
+        test = fixture.acquire()
+        return [test.failover_experiment(server_command, writes, killinterval, launchdelay, run,
+                                         policy, seed + run)]
+
+    # Run the test, on as many clusters at once as asked for
+    scheduler = Scheduler(
+        factory = FailoverTest,
+        clusters = int(arguments['--parallel']),
+        server_command = server_command,
+        reconf_opts = reconf_opts
+    )
+    rows = scheduler.run(points, run_point)
+
+    # Merge the results of all clusters for the plot
+    FailoverTest.plot(dict(enumerate(rows)))
 
 if __name__ == '__main__':
     main()
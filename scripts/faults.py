@@ -0,0 +1,201 @@
+"""
+Seeded fault injection. A FaultSchedule turns a seed and a policy into a timeline of kill and
+restart events, and a FaultInjector executes that timeline against a running TestFramework
+cluster, logging every event with the time it was planned for and the time it happened.
+
+The same seed and policy give the same timeline, and the same choice of servers given the same
+state of the cluster, so a failover run can be replayed.
+
+Policies:
+  random     Kill one running server, chosen at random
+  leader     Kill the current leader
+  follower   Kill one running server that is not the leader, chosen at random
+  majority   Kill a majority of the cluster at once, chosen at random among the running servers
+
+Every kill is followed by a restart of the servers it killed after the launch delay.
+"""
+
+from __future__ import print_function
+
+import heapq
+import random
+import time
+
+from common import spawn, gather
+
+POLICIES = ['random', 'leader', 'follower', 'majority']
+
+class Event(object):
+    """
+    A planned fault: at offset seconds from the start, kill according to the policy, or restart
+    the servers killed by the kill with the same number.
+    """
+
+    def __init__(self, offset, action, number):
+        self.offset = offset
+        self.action = action
+        self.number = number
+
+    def __repr__(self):
+        return '%.3f %s #%d' % (self.offset, self.action, self.number)
+
+class FaultSchedule(object):
+    """
+    A timeline of faults: a kill every killinterval seconds, each followed by a restart after
+    launchdelay seconds.
+    """
+
+    def __init__(self, policy='random', killinterval=4, launchdelay=1, seed=None):
+        if policy not in POLICIES:
+            raise ValueError('Unknown fault policy %s, not one of %s' % (policy, POLICIES))
+
+        # Without a seed, pick one so that the run can still be replayed from the log
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+
+        self.policy = policy
+        self.killinterval = killinterval
+        self.launchdelay = launchdelay
+        self.seed = seed
+
+    def events(self):
+        """
+        Generate the events of the timeline in order, without end. A restart due at the same
+        time as a kill comes first.
+        """
+
+        order = {'restart': 0, 'kill': 1}
+        pending = []
+        number = 0
+        while True:
+            number += 1
+            kill = Event(number * self.killinterval, 'kill', number)
+            while pending and (pending[0][0], pending[0][1]) <= (kill.offset, order['kill']):
+                yield heapq.heappop(pending)[2]
+            yield kill
+            restart = Event(kill.offset + self.launchdelay, 'restart', number)
+            heapq.heappush(pending, (restart.offset, order['restart'], restart))
+
+    def timeline(self, duration):
+        """
+        Return the events due within duration seconds.
+        """
+
+        events = []
+        for event in self.events():
+            if event.offset > duration:
+                return events
+            events.append(event)
+
+    def __repr__(self):
+        return 'policy=%s killinterval=%s launchdelay=%s seed=%d' % (
+            self.policy, self.killinterval, self.launchdelay, self.seed)
+
+class FaultInjector(object):
+    """
+    Executes a FaultSchedule against the servers of a TestFramework.
+    """
+
+    def __init__(self, test, schedule, server_command="build/LogCabin"):
+        self.test = test
+        self.schedule = schedule
+        self.server_command = server_command
+        self.random = random.Random(schedule.seed)
+
+        # Kill number to the servers it killed that are still down
+        self.killed = {}
+        # (planned offset, actual offset, action, server ids) of every event executed
+        self.log = []
+
+    def run(self, duration=None, until=None):
+        """
+        Execute the timeline from now until duration seconds have passed or the given process
+        has exited, whichever comes first. Wakes up for each event, or as soon as any process
+        exits, in which case failures are checked as usual. Returns the time at which it stopped.
+        """
+
+        print('\nFault schedule: %s' % self.schedule)
+
+        sandbox = self.test.sandbox
+        self.start = time.time()
+
+        for event in self.schedule.events():
+            due = self.start + event.offset
+            if duration is not None:
+                due = min(due, self.start + duration)
+
+            while True:
+                sandbox.checkFailures()
+                if until is not None and until.exitTime is not None:
+                    return until.exitTime
+                remaining = due - time.time()
+                if remaining <= 0:
+                    break
+                sandbox.waitAny(timeout=remaining)
+
+            if duration is not None and event.offset > duration:
+                return self.start + duration
+
+            self._execute(event)
+
+    def _execute(self, event):
+        if event.action == 'kill':
+            servers = self._choose()
+            # All at once, so that a majority goes down together
+            gather([spawn(self.test._kill_server, server_id_ip) for server_id_ip in servers])
+            self.killed[event.number] = servers
+        else:
+            servers = self.killed.pop(event.number, [])
+            gather([spawn(self.test._start_server, self.server_command, server_id_ip)
+                    for server_id_ip in servers])
+
+        actual = time.time() - self.start
+        self.log.append((event.offset, actual, event.action,
+                         [server_id for server_id, _ in servers]))
+        print('Fault %s: %s servers %s (%.1f ms late)' % (
+            event, event.action, [server_id for server_id, _ in servers],
+            (actual - event.offset) * 1000))
+
+    def _choose(self):
+        """
+        Pick the servers to kill according to the policy. Candidates are sorted by server id, so
+        the seeded choice only depends on which servers are running.
+        """
+
+        running = sorted(self.test.server_processes.keys())
+        policy = self.schedule.policy
+
+        if policy == 'random':
+            return [self.random.choice(running)] if running else []
+
+        if policy == 'majority':
+            majority = len(self.test.server_ids_ips) // 2 + 1
+            return sorted(self.random.sample(running, min(majority, len(running))))
+
+        leader = self.test.current_leader()
+        if policy == 'leader':
+            return [leader] if leader in running else []
+
+        followers = [server_id_ip for server_id_ip in running if server_id_ip != leader]
+        return [self.random.choice(followers)] if followers else []
+
+    def restore(self):
+        """
+        Restart the servers that are still down, e.g. to start the next experiment fresh.
+        """
+
+        for number in sorted(self.killed.keys()):
+            for server_id_ip in self.killed.pop(number):
+                self.test._start_server(self.server_command, server_id_ip)
+
+    def write_log(self, path):
+        """
+        Write the schedule and the executed events to a file.
+        """
+
+        with open(path, 'w') as f:
+            f.write('# %s\n' % self.schedule)
+            f.write('planned;actual;action;servers\n')
+            for planned, actual, action, server_ids in self.log:
+                f.write('%f;%f;%s;%s\n' % (
+                    planned, actual, action, ','.join([str(i) for i in server_ids])))
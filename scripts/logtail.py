@@ -0,0 +1,146 @@
+"""
+Incremental parsing of the servers' logs for leadership. A LogIndex remembers how far it has read
+each server's log (a line number in its in-memory buffer, or a byte offset in its debug file) and
+only parses what was logged since, with one combined pattern. So asking who leads costs the same
+however long an experiment has been running.
+"""
+
+from __future__ import print_function
+
+import re
+import threading
+import time
+
+# The lines that change what a server believes about leadership
+LEADERSHIP = re.compile(r'All hail leader (?P<hail>\d+) for term (?P<hail_term>\d+)'
+                        r'|Now leader for term (?P<led_term>\d+)'
+                        r'|Running for election in term (?P<wake>\d+)')
+
+class ServerState(object):
+    """
+    What a server's log says since it was last started.
+    """
+
+    def __init__(self, server_id):
+        self.server_id = server_id
+        # The id of the leader it last acknowledged (possibly itself), and for which term
+        self.leader = None
+        self.term = None
+        # The last term it ran for election in
+        self.wake = None
+        # The highest term it was leader for
+        self.led_term = None
+
+    def parse(self, line):
+        m = LEADERSHIP.search(line)
+        if m is None:
+            return
+        if m.group('hail') is not None:
+            self.leader = int(m.group('hail'))
+            self.term = int(m.group('hail_term'))
+        elif m.group('led_term') is not None:
+            self.leader = self.server_id
+            self.term = int(m.group('led_term'))
+            if self.led_term is None or self.term > self.led_term:
+                self.led_term = self.term
+        else:
+            self.wake = int(m.group('wake'))
+
+    def __repr__(self):
+        return repr(self.__dict__)
+
+class LogTail(object):
+    """
+    Follows one server's log: its OutputBuffer if its output is captured, its debug file
+    otherwise.
+    """
+
+    def __init__(self, server_id, started):
+        self.state = ServerState(server_id)
+        # When the server was started; a restart starts a new log
+        self.started = started
+        # Where the next read starts: the buffer and line number, or the byte offset in the file
+        self.buffer = None
+        self.index = 0
+        self.offset = 0
+        # A line still being written to the file
+        self.partial = ''
+
+    def read_buffer(self, buffer):
+        """
+        Return the (arrival time, line) of the lines added to the buffer since the last read.
+        """
+
+        if buffer is not self.buffer:
+            self.buffer = buffer
+            self.index = 0
+        lines = buffer.since(self.index)
+        if lines:
+            self.index = lines[-1][0] + 1
+        return [(arrival, line) for _, arrival, line in lines]
+
+    def read_file(self, path):
+        """
+        Return the (time read, line) of the complete lines added to the file since the last read.
+        """
+
+        try:
+            f = open(path)
+        except IOError:
+            # Not created yet
+            return []
+        with f:
+            f.seek(self.offset)
+            data = f.read()
+        now = time.time()
+        self.offset += len(data)
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        return [(now, line) for line in lines]
+
+    def read(self, test):
+        """
+        Return the new lines of the server's log in the given TestFramework, as above.
+        """
+
+        buffer = test.server_logs.get(self.state.server_id)
+        if buffer is not None:
+            return self.read_buffer(buffer)
+        return self.read_file(test.debug_path('server_%d' % self.state.server_id))
+
+class LogIndex(object):
+    """
+    The leadership state of every server of a TestFramework, kept up to date from the new part of
+    their logs on every call.
+    """
+
+    def __init__(self, test):
+        self.test = test
+        self.tails = {}
+        self.lock = threading.Lock()
+
+    def state(self, server_id_ip):
+        """
+        Return the ServerState of a server, brought up to date.
+        """
+
+        server_id = server_id_ip[0]
+        started = self.test.server_start_times.get(server_id_ip)
+
+        with self.lock:
+            tail = self.tails.get(server_id)
+            if tail is None or tail.started != started:
+                tail = LogTail(server_id, started)
+                self.tails[server_id] = tail
+
+            for _, line in tail.read(self.test):
+                tail.state.parse(line)
+            return tail.state
+
+    def states(self):
+        """
+        Return the ServerState of every running server, by (id, ip).
+        """
+
+        return dict([(server_id_ip, self.state(server_id_ip))
+                     for server_id_ip in list(self.test.server_processes.keys())])
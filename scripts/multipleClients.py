@@ -1,12 +1,44 @@
+"""
+This runs the Benchmark with a number of client threads against clusters of increasing size,
+measuring the throughput of each combination.
+
+Usage:
+  multipleClients.py [--override=<setting>]... [options]
+  multipleClients.py (-h | --help)
+
+Options:
+  -h --help            Show this help message and exit
+  --local=<servers>    Run a cluster of this many servers on this machine, on loopback ports,
+                       instead of one server per host in localconfig.py. The cluster is then
+                       grown through 3, 7, 15, 31, ... servers up to this number.
+  --parallel=<n>       Run this many experiments at once, each on its own cluster: the hosts
+                       are split into n clusters, or n loopback clusters are run with --local.
+                       Cluster sizes beyond the servers of one cluster are skipped [default: 1]
+  --network=<kind>     Put a fault-injecting network between the local servers: netns (network
+                       namespaces and tc netem, needs root) or proxy (a TCP proxy in front of
+                       each server). Needs --local.
+  --rtt=<ms>           Comma-separated round-trip times to add between all servers on the
+                       network [default: 0]
+  --override=<setting>  A setting of one server only, as <server id>:<key>=<value>, e.g.
+                       3:maxThreads=2 for one under-threaded server. May be repeated.
+"""
+
 import itertools
-import time
+import sys
+from docopt import docopt
 
 from TestFramework import TestFramework, run_shell_command
 from common import sh
+from scheduler import Scheduler
+from timing import PHASES
 
 class MultipleClients(TestFramework):
-    def __init__(self):
-        TestFramework.__init__(self)
+    # Path to the csv file for the plot
+    csv_file = "scripts/plot/csv/multipleclients.csv"
+    plot_file = "scripts/plot/plot_multipleclients.py"
+
+    def __init__(self, **kwargs):
+        TestFramework.__init__(self, **kwargs)
         # All the running servers
         self.parent_server_ids_ips = self.server_ids_ips
         # Number of servers in the cluster
@@ -14,19 +46,12 @@ class MultipleClients(TestFramework):
         # Metadata for experiments
         self.experiment_metadata = {}
 
-        # Path to the csv file for the plot
-        self.csv_file = "scripts/plot/csv/multipleclients.csv"
-        self.plot_file = "scripts/plot/plot_multipleclients.py"
-
     def _start_servers(self, server_command):
         """
-        Starts the servers in the cluster in background processes.
+        Starts all the servers, including those not in the cluster yet, in background processes.
         """
 
-        self._print_string('\nStarting servers')
-
-        for server_id_ip in self.parent_server_ids_ips:
-            self._start_server(server_command, server_id_ip)
+        return TestFramework._start_servers(self, server_command, self.parent_server_ids_ips)
 
     def _reconfigure_cluster(self, reconf_opts=""):
         """
@@ -59,46 +84,73 @@ class MultipleClients(TestFramework):
         run,
         threads=1,
         size=1024,
-        writes=1000
+        writes=1000,
+        rtt=0
     ):
         self._print_string('\nExecuting client command with %d threads' % threads)
 
-        start_time = time.time()
-        self.execute_client_command(
+        timing = self.execute_client_command(
             client_executable="build/Examples/Benchmark",
             conf= {
-                "options": "--threads=%s --size=%s --write=%s" % (threads, size, writes),
+                "options": "--threads=%s --size=%s --write=%s --phases" % (threads, size, writes),
                 "command": ""
-            }
+            },
+            timed=True
         )
-        end_time = time.time()
+
+        leader = self.current_leader()
+
+        # Writes per second once every thread has found the leader, not counting process startup
+        throughput = timing.throughput()
+        if throughput is None:
+            throughput = writes / timing.total()
 
         self.experiment_metadata[self.client_commands] = {
             "threads": threads,
             "servers": len(self.server_ids_ips),
-            "throughput": writes / (end_time - start_time), # writes per second
-            "run": run
+            "throughput": throughput,
+            "run": run,
+            "rtt": rtt,
+            "phases": timing.phases(),
+            # Where the leader ended up, e.g. with servers configured differently
+            "leader": leader[0] if leader else 0
         }
 
-    def _write_csv(self):
-        with open("%s" % self.csv_file, "w") as f:
-            f.write("threads;servers;throughput;run\n")
-            for _, metadata in self.experiment_metadata.items():
-                f.write("%d;%d;%f;%d\n" % (
+        return self.experiment_metadata[self.client_commands]
+
+    @staticmethod
+    def _write_csv(experiment_metadata):
+        with open("%s" % MultipleClients.csv_file, "w") as f:
+            f.write("threads;servers;throughput;run;rtt;leader;%s\n" % ";".join(PHASES))
+            for _, metadata in experiment_metadata.items():
+                # Phases in ms, empty where the client did not report them
+                phases = ["" if metadata["phases"][phase] is None else
+                          "%f" % (metadata["phases"][phase] * 1000) for phase in PHASES]
+                f.write("%d;%d;%f;%d;%.2f;%d;%s\n" % (
                     metadata["threads"],
                     metadata["servers"],
                     metadata["throughput"],
-                    metadata["run"])
+                    metadata["run"],
+                    metadata["rtt"],
+                    metadata["leader"],
+                    ";".join(phases))
                 )
 
-    def plot(self):
-        self._write_csv()
-        self._print_string('\nPlotting results')
+    @staticmethod
+    def plot(experiment_metadata):
+        """
+        Write the metadata of the experiments (of any number of clusters) to the csv file and
+        plot it.
+        """
+
+        MultipleClients._write_csv(experiment_metadata)
+
+        print("\nPlotting results")
+        print("----------------")
         try:
-            run_shell_command("python3 %s" % self.plot_file)
+            run_shell_command("python3 %s" % MultipleClients.plot_file)
         except Exception as e:
-            self._print_string("Error: %s" % e)
-            self.cleanup()
+            print("Error: %s" % e)
 
 def combinations(*arrays):
     """
@@ -106,50 +158,93 @@ def combinations(*arrays):
     """
     return [list(x) for x in itertools.product(*arrays)]
 
-def run_experiments(threads_array, sizes_array, writes_array, servers_num, runs=5):
-    arrays_combinations = combinations(threads_array, sizes_array, writes_array, servers_num)
-
-    # Test preparation
-    test = MultipleClients()
-
-    test.create_configs()
-    test.create_folders()
+def run_experiments(threads_array, sizes_array, writes_array, servers_num, runs=5,
+                    local_servers=None, parallel=1, network=None, rtts=[0],
+                    serverOverrides=None):
+    # Test preparation: each cluster initially contains all of its servers
+    scheduler = Scheduler(
+        factory = MultipleClients,
+        clusters = parallel,
+        local_servers = local_servers
+    )
+
+    skipped = [servers for servers in servers_num if servers > scheduler.servers()]
+    if skipped:
+        print("Skipping cluster sizes %s, larger than the %d servers per cluster" % (
+            skipped, scheduler.servers()))
+        servers_num = [servers for servers in servers_num if servers not in skipped]
+
+    arrays_combinations = combinations(threads_array, sizes_array, writes_array, servers_num,
+                                       rtts)
+    points = [[run] + combination
+              for run in range(runs)
+              for combination in arrays_combinations]
+
+    def run_point(fixture, point):
+        run, threads, size, writes, servers, rtt = point
 
-    # Intial configuration contains all the servers
-    test.initialize_cluster()
-
-    for run in range(runs):
         print("\n\n================================================")
-        print("Run %d" % run)
+        print("run: %d, threads: %d, size: %d, writes: %d, servers: %d, rtt: %s ms" % (
+            run, threads, size, writes, servers, rtt))
         print("================================================\n\n")
-        for threads, size, writes, servers in arrays_combinations:
-            print("\n\n================================================")
-            print("threads: %d, size: %d, writes: %d, servers: %d" % (threads, size, writes, servers))
-            print("================================================\n\n")
-
-            test.set_servers_num(servers)
-            test._reconfigure_cluster()
-
-            test.execute_client_command_with_multiple_threads(
-                threads=threads,
-                size=size,
-                writes=writes,
-                run=run
-            )
 
-    # Plot the results
-    test.plot()
-
-    # Cleanup environment
-    test.cleanup()
+        # The same cluster is kept for all the points it runs
+        params = {}
+        if network:
+            params["network"] = network
+        if serverOverrides:
+            params["serverOverrides"] = serverOverrides
+        test = fixture.acquire(**params)
+        if network:
+            # Half of the round trip on each direction
+            test.set_link(None, None, delay=rtt / 2.0)
+
+        test.set_servers_num(servers)
+        test._reconfigure_cluster()
+
+        return [test.execute_client_command_with_multiple_threads(
+            threads=threads,
+            size=size,
+            writes=writes,
+            run=run,
+            rtt=rtt
+        )]
+
+    rows = scheduler.run(points, run_point)
+
+    # Plot the results of all clusters
+    MultipleClients.plot(dict(enumerate(rows)))
 
 def main():
+    arguments = docopt(__doc__)
+
     threads_array = [1, 10, 100]
     sizes_array = [1024]
     writes_array = [1000]
     servers_num = [1, 2, 3, 4, 5]
 
-    run_experiments(threads_array, sizes_array, writes_array, servers_num)
+    local_servers = None
+    if arguments['--local']:
+        local_servers = int(arguments['--local'])
+        # 3, 7, 15, 31, ... servers
+        servers_num = [n for n in [2 ** k - 1 for k in range(2, 10)] if n <= local_servers]
+
+    network = arguments['--network']
+    if network and not local_servers:
+        sys.exit('--network needs --local')
+    rtts = [0]
+    if network:
+        rtts = [float(rtt) for rtt in arguments['--rtt'].split(',')]
+
+    serverOverrides = {}
+    for setting in arguments['--override']:
+        server_id, assignment = setting.split(':', 1)
+        key, value = assignment.split('=', 1)
+        serverOverrides.setdefault(int(server_id), {})[key.strip()] = value.strip()
+
+    run_experiments(threads_array, sizes_array, writes_array, servers_num,
+                    local_servers=local_servers, parallel=int(arguments['--parallel']),
+                    network=network, rtts=rtts, serverOverrides=serverOverrides)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
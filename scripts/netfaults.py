@@ -0,0 +1,431 @@
+"""
+Network faults between the servers of a loopback cluster: per-link delay, jitter and loss, and
+partitions. Links are directed, from a server (or, with None, from anywhere) to a server (or, with
+None, to every server); the most specific setting of a link wins.
+
+Two implementations are available, chosen with TestFramework(network=...):
+
+  netns   Every server runs in its own network namespace, attached to a bridge, and each link is
+          shaped by tc netem on the egress of its source (a class per destination). Faithful to
+          the kernel's TCP behavior, but needs root and iproute2. Clients and ServerControl run
+          outside the namespaces and are not affected.
+  proxy   A userspace TCP proxy takes over each server's address and delays, stalls or cuts what
+          goes through it. The server listens on a port of its own but advertises the proxy's
+          address (advertiseAddresses), so that it is the one in the cluster configuration and
+          in leader hints, and Raft traffic goes through the proxies too. The source of a
+          connection is found by looking up which server process owns its socket, so links
+          between servers can be told apart from those of clients (source None). Being a byte
+          stream, it cannot drop packets: a loss adds a retransmission timeout to the chunk
+          instead.
+
+Partitions split the listed servers into groups that cannot reach each other; servers left out
+keep talking to everyone.
+"""
+
+from __future__ import print_function
+
+import os
+import Queue
+import random
+import socket
+import struct
+import threading
+import time
+
+from common import sh, freePorts
+
+class Link(object):
+    """
+    The faults on a link: delay and jitter (uniform, plus or minus) in milliseconds, and loss in
+    percent.
+    """
+
+    def __init__(self, delay=0, jitter=0, loss=0):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+
+    def __repr__(self):
+        return 'delay=%sms jitter=%sms loss=%s%%' % (self.delay, self.jitter, self.loss)
+
+class Network(object):
+    """
+    The faults configured on the links of a cluster. attach sets up the network for a
+    TestFramework before its configs are created; close tears it down.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (source id or None, destination id or None) to Link
+        self.links = {}
+        # Sets of server ids that can only reach each other
+        self.groups = []
+
+    def set_link(self, src, dst, delay=0, jitter=0, loss=0):
+        """
+        Set the faults on the links from src to dst; either may be None for all.
+        """
+
+        with self.lock:
+            self.links[(src, dst)] = Link(delay, jitter, loss)
+        print('Network: %s -> %s: %s' % (src, dst, self.links[(src, dst)]))
+        self._update()
+
+    def partition(self, *groups):
+        """
+        Cut the links between the given groups of server ids.
+        """
+
+        with self.lock:
+            self.groups = [set(group) for group in groups]
+        print('Network: partition %s' % ' | '.join([str(sorted(g)) for g in self.groups]))
+        self._update()
+
+    def heal(self):
+        """
+        Remove the partition, if any. The link faults stay.
+        """
+
+        with self.lock:
+            self.groups = []
+        print('Network: healed')
+        self._update()
+
+    def link(self, src, dst):
+        """
+        Return the Link in effect from src to dst.
+        """
+
+        for key in [(src, dst), (src, None), (None, dst), (None, None)]:
+            if key in self.links:
+                return self.links[key]
+        return Link()
+
+    def blocked(self, src, dst):
+        """
+        Return True if a partition separates src from dst.
+        """
+
+        src_groups = [i for i, group in enumerate(self.groups) if src in group]
+        dst_groups = [i for i, group in enumerate(self.groups) if dst in group]
+        return bool(src_groups and dst_groups and src_groups != dst_groups)
+
+    def attach(self, test):
+        raise NotImplementedError
+
+    def _update(self):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+class NetnsNetwork(Network):
+    """
+    Servers in network namespaces, with tc netem per link.
+    """
+
+    # Server addresses are 10.201.<subnet>.<server id>; the bridge is .254
+    prefix = '10.201'
+
+    def attach(self, test):
+        if os.geteuid() != 0:
+            raise Exception('Network namespaces need root')
+
+        self.server_ids = [server_id for server_id, _ in test.server_ids_ips]
+        if max(self.server_ids) > 253:
+            raise Exception('Server ids must be below 254 to run in network namespaces')
+
+        # Claim a subnet that no other run is using
+        for subnet in range(1, 255):
+            self.bridge = 'lcbr%d' % subnet
+            if not os.path.exists('/sys/class/net/%s' % self.bridge):
+                try:
+                    sh('ip link add %s type bridge' % self.bridge)
+                    break
+                except Exception:
+                    # Taken by a run starting at the same time
+                    pass
+        else:
+            raise Exception('No free subnet for network namespaces')
+        self.subnet = subnet
+        self.namespaces = {}
+        # (src, dst) to the netem settings applied to it
+        self.applied = {}
+
+        try:
+            self._setup(test)
+        except:
+            self.close()
+            raise
+
+    def _setup(self, test):
+        subnet = self.subnet
+
+        sh('ip addr add %s.%d.254/24 dev %s' % (self.prefix, subnet, self.bridge))
+        sh('ip link set %s up' % self.bridge)
+
+        server_ids_ips = []
+        for server_id in self.server_ids:
+            namespace = 'lc%d-%d' % (subnet, server_id)
+            address = '%s.%d.%d' % (self.prefix, subnet, server_id)
+            self.namespaces[server_id] = namespace
+
+            sh('ip netns add %s' % namespace)
+            sh('ip link add lc%dv%d type veth peer name lc%dp%d' % (
+                subnet, server_id, subnet, server_id))
+            sh('ip link set lc%dv%d master %s up' % (subnet, server_id, self.bridge))
+            sh('ip link set lc%dp%d netns %s' % (subnet, server_id, namespace))
+            self._ns(server_id, 'ip link set lc%dp%d name eth0' % (subnet, server_id))
+            self._ns(server_id, 'ip addr add %s/24 dev eth0' % address)
+            self._ns(server_id, 'ip link set eth0 up')
+            self._ns(server_id, 'ip link set lo up')
+
+            # A netem qdisc per destination, picked by destination address
+            self._ns(server_id, 'tc qdisc add dev eth0 root handle 1: htb default 1')
+            self._ns(server_id, 'tc class add dev eth0 parent 1: classid 1:1 htb rate 10gbit '
+                     'quantum 60000')
+            for dst in self.server_ids:
+                if dst == server_id:
+                    continue
+                self._ns(server_id, 'tc class add dev eth0 parent 1: classid 1:%x htb rate 10gbit '
+                         'quantum 60000' % (dst + 16))
+                self._ns(server_id, 'tc qdisc add dev eth0 parent 1:%x handle %x: netem delay 0ms' %
+                         (dst + 16, dst + 16))
+                self._ns(server_id, 'tc filter add dev eth0 parent 1: protocol ip prio 1 u32 '
+                         'match ip dst %s.%d.%d/32 flowid 1:%x' % (
+                             self.prefix, subnet, dst, dst + 16))
+
+            server_ids_ips.append((server_id, '%s:5254' % address))
+            test.server_prefixes[server_id] = 'ip netns exec %s ' % namespace
+
+        test.server_ids_ips = server_ids_ips
+        test.listen_addresses = dict(server_ids_ips)
+
+    def _ns(self, server_id, command):
+        sh('ip netns exec %s %s' % (self.namespaces[server_id], command))
+
+    def _update(self):
+        with self.lock:
+            for src in self.server_ids:
+                for dst in self.server_ids:
+                    if src == dst:
+                        continue
+                    link = self.link(src, dst)
+                    loss = 100 if self.blocked(src, dst) else link.loss
+                    netem = 'delay %.3fms %.3fms loss %s%%' % (link.delay, link.jitter, loss)
+                    if self.applied.get((src, dst), 'delay 0ms') == netem:
+                        continue
+                    self._ns(src, 'tc qdisc change dev eth0 parent 1:%x handle %x: netem %s' % (
+                        dst + 16, dst + 16, netem))
+                    self.applied[(src, dst)] = netem
+
+    def close(self):
+        # Also after a partial setup. Deleting a namespace deletes the veth pair in it.
+        for server_id, namespace in self.namespaces.items():
+            if os.path.exists('/run/netns/%s' % namespace):
+                sh('ip netns del %s' % namespace)
+            veth = 'lc%dv%d' % (self.subnet, server_id)
+            if os.path.exists('/sys/class/net/%s' % veth):
+                sh('ip link del %s' % veth)
+        self.namespaces = {}
+        sh('ip link del %s' % self.bridge)
+
+class ProxyConnection(object):
+    """
+    A connection through a proxy, from src (None for a client) to the server dst.
+    """
+
+    def __init__(self, src, dst, sockets):
+        self.src = src
+        self.dst = dst
+        self.sockets = sockets
+        # Directions that have finished forwarding
+        self.finished = 0
+
+class ProxyNetwork(Network):
+    """
+    A TCP proxy in front of each server.
+    """
+
+    # Added to a chunk of data that is "lost": Linux's minimum retransmission timeout
+    retransmit_timeout = .2
+
+    def attach(self, test):
+        self.test = test
+        self.listeners = []
+        self.connections = []
+        self.closed = False
+
+        # The proxies take over the addresses of the servers, which move to new ports but keep
+        # advertising the old ones (see TestFramework.create_configs)
+        for server_id, server_ip in test.server_ids_ips:
+            host, port = server_ip.rsplit(':', 1)
+            listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            listener.bind((host, int(port)))
+            listener.listen(64)
+            self.listeners.append((server_id, listener))
+
+        ports = freePorts(len(test.server_ids_ips))
+        for (server_id, _), port in zip(test.server_ids_ips, ports):
+            test.listen_addresses[server_id] = '127.0.0.1:%d' % port
+
+        for server_id, listener in self.listeners:
+            self._thread(self._accept, listener, server_id)
+
+    def _thread(self, target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _accept(self, listener, dst):
+        while True:
+            try:
+                sock, peer = listener.accept()
+            except socket.error:
+                # Closed
+                return
+            self._thread(self._connect, sock, peer, dst)
+
+    def _connect(self, sock, peer, dst):
+        src = self._identify(peer)
+        if self.closed or self.blocked(src, dst):
+            sock.close()
+            return
+
+        try:
+            host, port = self.test.listen_addresses[dst].rsplit(':', 1)
+            upstream = socket.create_connection((host, int(port)))
+        except socket.error:
+            # The server is down; let the peer see it
+            sock.close()
+            return
+
+        for s in [sock, upstream]:
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        connection = ProxyConnection(src, dst, [sock, upstream])
+        with self.lock:
+            self.connections.append(connection)
+
+        self._pump(connection, sock, upstream, src, dst)
+        self._pump(connection, upstream, sock, dst, src)
+
+    def _pump(self, connection, source, sink, src, dst):
+        """
+        Forward what arrives on source to sink, after the delay of the link from src to dst.
+        """
+
+        queue = Queue.Queue()
+
+        def read():
+            deliver = 0
+            while True:
+                try:
+                    data = source.recv(65536)
+                except socket.error:
+                    data = ''
+                if not data:
+                    queue.put((None, None))
+                    return
+                link = self.link(src, dst)
+                delay = link.delay + random.uniform(-link.jitter, link.jitter)
+                if link.loss and random.uniform(0, 100) < link.loss:
+                    delay += self.retransmit_timeout * 1000
+                # TCP keeps the bytes in order
+                deliver = max(deliver, time.time() + max(0, delay) / 1000.0)
+                queue.put((deliver, data))
+
+        def send():
+            while True:
+                deliver, data = queue.get()
+                if data is None:
+                    self._shutdown(sink, socket.SHUT_WR)
+                    with self.lock:
+                        connection.finished += 1
+                        both = connection.finished == 2
+                    if both:
+                        self._drop(connection)
+                    return
+                remaining = deliver - time.time()
+                if remaining > 0:
+                    time.sleep(remaining)
+                try:
+                    sink.sendall(data)
+                except socket.error:
+                    self._drop(connection)
+                    return
+
+        self._thread(read)
+        self._thread(send)
+
+    def _shutdown(self, sock, how):
+        try:
+            sock.shutdown(how)
+        except socket.error:
+            pass
+
+    def _drop(self, connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+        for sock in connection.sockets:
+            self._shutdown(sock, socket.SHUT_RDWR)
+            sock.close()
+
+    def _identify(self, peer):
+        """
+        Return the id of the server whose socket is connected from the given (ip, port), or None
+        if it is not a server's (e.g. a client's).
+        """
+
+        ip, port = peer[:2]
+        # /proc/net/tcp has the address as a number in host byte order
+        address = '%08X:%04X' % (struct.unpack('=I', socket.inet_aton(ip))[0], port)
+        inode = None
+        with open('/proc/net/tcp') as f:
+            for line in f.readlines()[1:]:
+                fields = line.split()
+                if fields[1] == address:
+                    inode = fields[9]
+                    break
+        if inode is None:
+            return None
+
+        target = 'socket:[%s]' % inode
+        for (server_id, _), process in self.test.server_processes.items():
+            fd_dir = '/proc/%d/fd' % process.proc.pid
+            try:
+                fds = os.listdir(fd_dir)
+            except OSError:
+                continue
+            for fd in fds:
+                try:
+                    if os.readlink(os.path.join(fd_dir, fd)) == target:
+                        return server_id
+                except OSError:
+                    pass
+        return None
+
+    def _update(self):
+        # Delays are read for every chunk; only the connections a partition cuts need handling
+        with self.lock:
+            cut = [c for c in self.connections if self.blocked(c.src, c.dst)]
+        for connection in cut:
+            self._drop(connection)
+
+    def close(self):
+        self.closed = True
+        for _, listener in self.listeners:
+            # Wakes up the accept, which close alone would not
+            self._shutdown(listener, socket.SHUT_RDWR)
+            listener.close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            self._drop(connection)
+
+NETWORKS = {
+    'netns': NetnsNetwork,
+    'proxy': ProxyNetwork
+}
@@ -15,17 +15,24 @@ class PlotSnapshotting(PlotWithPython3):
         self.fig_name = '%s%s' % (fig_name, curr_time)
     
     def plot_stats(self):
+        # Older results have no storage column; they all used the default module
+        if 'storage' not in self.data:
+            self.data['storage'] = 'Segmented'
+
         # Group data
-        grouped_data = self.data.groupby(['writes', 'size', 'snapshotting'])['time']
+        grouped_data = self.data.groupby(['storage', 'writes', 'size', 'snapshotting'])['time']
 
         # Calculate mean and standard deviation of the time
         grouped_data = grouped_data.agg(['mean', 'std']).reset_index()
 
         fig, ax = self.plt.subplots()
 
-        for snapshotting_value in grouped_data['snapshotting'].unique():
+        storages = grouped_data['storage'].unique()
+        for storage, snapshotting_value in grouped_data[['storage', 'snapshotting']] \
+                .drop_duplicates().itertuples(index=False):
             # Filter data
-            data = grouped_data[grouped_data['snapshotting'] == snapshotting_value]
+            data = grouped_data[(grouped_data['storage'] == storage) &
+                                (grouped_data['snapshotting'] == snapshotting_value)]
 
             # Parse data
             writes = data['writes']
@@ -39,6 +46,8 @@ class PlotSnapshotting(PlotWithPython3):
 
             # Label
             label = "Snapshotting" if snapshotting_value else "Bare-Bones"
+            if len(storages) > 1:
+                label = "%s (%s)" % (label, storage)
 
             # Scatter plot
             ax.errorbar(
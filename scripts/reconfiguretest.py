@@ -14,6 +14,8 @@ Options:
   --binary=<cmd>       Server binary to execute [default: build/LogCabin]
   --reconf=<opts>      Additional options to pass through to the Reconfigure
                        binary. [default: '']
+  --local=<servers>    Run a cluster of this many servers on this machine, on
+                       loopback ports, instead of one per host in localconfig.py.
 """
 
 import random
@@ -24,8 +26,8 @@ from common import sh
 from TestFramework import TestFramework, run_shell_command
 
 class ReconfigureTest(TestFramework):
-    def __init__(self):
-        TestFramework.__init__(self)
+    def __init__(self, local_servers=None):
+        TestFramework.__init__(self, local_servers=local_servers)
         # Infos from localconfig.py
         self.parent_server_ids_ips = self.server_ids_ips
         # Path to the csv file for the plot
@@ -101,9 +103,10 @@ def run_test(
         reconf_opts,
         tries_range,
         debug = False,
-        runs=5
+        runs=5,
+        local_servers=None
     ):
-    test = ReconfigureTest()
+    test = ReconfigureTest(local_servers=local_servers)
 
     test.create_configs()
     test.create_folders()
@@ -143,12 +146,17 @@ def main():
     if reconf_opts == "''":
         reconf_opts = ""
 
+    local_servers = None
+    if arguments['--local']:
+        local_servers = int(arguments['--local'])
+
     # Run the test
     run_test(
         server_command = server_command,
         reconf_opts = reconf_opts,
         tries_range = [10, 100, 250, 500],
-        debug = True
+        debug = True,
+        local_servers = local_servers
     )
 
 if __name__ == '__main__':
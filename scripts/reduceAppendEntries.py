@@ -30,47 +30,30 @@ Options:
                        binary. [default: '']
 """
 
-import random
 import time
-import re
 
 from docopt import docopt
 from TestFramework import TestFramework
+from faults import FaultSchedule, FaultInjector
 
 class reduceAppendEntries(TestFramework):
     def __init__(self):
         TestFramework.__init__(self)
     
-    def random_server_kill(self, server_command, timeout, killinterval, launchdelay):
+    def random_server_kill(self, server_command, timeout, killinterval, launchdelay,
+                           policy='random', seed=None):
+        """
+        Kill servers according to a seeded fault schedule (see faults.py) until the timeout, and
+        log the executed schedule to the faults debug file.
+        """
 
-        start = time.time()
-        lastkill = start
-        tolaunch = [] # [(time to launch, server id)]
+        schedule = FaultSchedule(policy, killinterval, launchdelay, seed)
 
-        while True:
-            time.sleep(.1)
+        injector = FaultInjector(self, schedule, server_command)
+        injector.run(duration=timeout)
+        injector.write_log(self.debug_path('faults'))
 
-            self.sandbox.checkFailures()
-            now = time.time()
-
-            # Check if the timeout has been met
-            if now - start > timeout:
-                print('\nSuccess: Timeout met with no errors!')
-                break
-
-            # Check if the kill interval has been met
-            if now - lastkill > killinterval:
-                server_id_ip = random.choice(self.server_processes.keys())
-
-                self._kill_server(server_id_ip)
-
-                lastkill = now
-                tolaunch.append((now + launchdelay, server_id_ip))
-
-            # Check if lanchdelay has been met and there are servers to launch
-            while tolaunch and now > tolaunch[0][0]:
-                server_id_ip = tolaunch.pop(0)[1]
-                self._start_server(server_command, server_id_ip)
+        print('\nSuccess: Timeout met with no errors!')
     
     def test_cluster(self):
         self.execute_client_command(
@@ -143,31 +126,13 @@ class reduceAppendEntries(TestFramework):
             bg = True
         )
 
-    def dumpStats(self):
-        for _, server_ip in self.server_ids_ips:
-            self.execute_client_command(
-                client_executable = "build/Client/ServerControl",
-                conf = {
-                    "options": "--timeout=10",
-                    "command": "stats dump",
-                    "server_ip": server_ip,
-                },
-                onCluster = False,
-            )
-    
-    def _match_string(self, match_string, line):
-        m = re.search('%s: (\d+)' % match_string, line)
-        if m is not None:
-            print "%s: %s" % (match_string, m.group(1))
-    
     def printStats(self):
-        for server_id, _ in self.server_ids_ips:
+        for server_id, stats in sorted(self.server_stats().items()):
             self._print_string("\nServer %d stats" % server_id)
 
-            for line in open('debug/server_%d' % server_id):
-                self._match_string('current_term', line)
-                self._match_string('commit_index', line)
-                self._match_string('last_log_index', line)
+            print("current_term: %d" % stats.raft.current_term)
+            print("commit_index: %d" % stats.raft.commit_index)
+            print("last_log_index: %d" % stats.raft.last_log_index)
 
 
 def main():
@@ -189,7 +154,6 @@ def main():
     test.initialize_cluster(server_command, reconf_opts)
 
     test.test_cluster()
-    test.dumpStats()
     test.printStats()
 
     test.cleanup(debug=True)
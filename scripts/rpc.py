@@ -0,0 +1,325 @@
+"""
+LogCabin's RPC protocol, spoken from Python. Messages are framed as RPC/MessageSocket frames them:
+a 16-byte big-endian header (0xdaf4, version 1, payload length, message id) followed by the
+payload. The payload of a request is the header of RPC/Protocol (version 1, service,
+service-specific error version, op code) followed by the serialized protocol buffer; that of a
+response is a status byte followed by the serialized response, or error.
+
+ControlClient calls Server/ControlService as build/Client/ServerControl does, over a connection
+kept open between calls, so that a control or stats call costs one round trip rather than a
+fork/exec/connect:
+
+    client = ControlClient('127.0.0.1:5254', timeout=1)
+    client.server_stats().raft.commit_index
+    client.call('SnapshotInhibitSet', nanoseconds=10 ** 9)
+
+The protocol buffer modules are the ones protoc generates next to the C++ code, as
+build/Protocol/*_pb2.py (see Protocol/SConscript); they need the protobuf Python package. The
+framing itself needs neither, and is shared with the asyncio client.
+"""
+
+from __future__ import print_function
+
+import importlib
+import os
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+
+# Protocol/Common.h
+DEFAULT_PORT = 5254
+PING_MESSAGE_ID = 2 ** 64 - 1
+VERSION_MESSAGE_ID = 2 ** 64 - 2
+MAX_MESSAGE_LENGTH = 1024 + 1024 * 1024
+CLIENT_SERVICE = 1
+RAFT_SERVICE = 2
+CONTROL_SERVICE = 3
+
+# RPC/MessageSocket.h
+MAGIC = 0xdaf4
+FRAMING_VERSION = 1
+HEADER = struct.Struct('>HHIQ')
+
+# RPC/Protocol.h
+REQUEST_HEADER = struct.Struct('>BHBH')
+RESPONSE_HEADER = struct.Struct('>B')
+OK = 0
+SERVICE_SPECIFIC_ERROR = 1
+INVALID_VERSION = 2
+INVALID_SERVICE = 3
+INVALID_REQUEST = 4
+STATUS_NAMES = {
+    OK: 'OK',
+    SERVICE_SPECIFIC_ERROR: 'SERVICE_SPECIFIC_ERROR',
+    INVALID_VERSION: 'INVALID_VERSION',
+    INVALID_SERVICE: 'INVALID_SERVICE',
+    INVALID_REQUEST: 'INVALID_REQUEST'
+}
+
+class RPCError(Exception):
+    """
+    An RPC that did not complete: the connection failed or timed out, or the server rejected the
+    request.
+    """
+
+class RequestRejected(RPCError):
+    """
+    An RPC that reached the server but that it did not carry out; retrying would not help.
+    """
+
+class ServiceSpecificError(RequestRejected):
+    """
+    An RPC that the service failed in its own way; payload is the serialized error, for the
+    caller to parse with the service's Error message.
+    """
+
+    def __init__(self, payload):
+        RequestRejected.__init__(self, 'Service-specific error')
+        self.payload = payload
+
+def frame(message_id, payload):
+    """
+    Return a message as MessageSocket sends it.
+    """
+
+    if len(payload) > MAX_MESSAGE_LENGTH:
+        raise ValueError('Message of %d bytes is longer than the limit of %d' % (
+            len(payload), MAX_MESSAGE_LENGTH))
+    return HEADER.pack(MAGIC, FRAMING_VERSION, len(payload), message_id) + payload
+
+def parse_header(data):
+    """
+    Return the payload length and message id of a MessageSocket header.
+    """
+
+    fixed, version, length, message_id = HEADER.unpack(data)
+    if fixed != MAGIC:
+        raise RPCError('Bad message framing: 0x%04x instead of 0x%04x' % (fixed, MAGIC))
+    if version != FRAMING_VERSION:
+        raise RPCError('Message framing version %d, only %d is understood' % (
+            version, FRAMING_VERSION))
+    if length > MAX_MESSAGE_LENGTH:
+        raise RPCError('Message of %d bytes is longer than the limit of %d' % (
+            length, MAX_MESSAGE_LENGTH))
+    return length, message_id
+
+def request_payload(service, op_code, request, service_specific_error_version=1):
+    """
+    Return the payload of an RPC request, given the serialized request.
+    """
+
+    return REQUEST_HEADER.pack(1, service, service_specific_error_version, op_code) + request
+
+def response_body(payload):
+    """
+    Return the serialized response in the payload of an RPC response. ServiceSpecificError is
+    raised with the serialized error for SERVICE_SPECIFIC_ERROR, and RequestRejected for the other
+    statuses.
+    """
+
+    if len(payload) < RESPONSE_HEADER.size:
+        raise RPCError('Response of %d bytes is too short' % len(payload))
+    status, = RESPONSE_HEADER.unpack(payload[:RESPONSE_HEADER.size])
+    body = payload[RESPONSE_HEADER.size:]
+    if status == OK:
+        return body
+    if status == SERVICE_SPECIFIC_ERROR:
+        raise ServiceSpecificError(body)
+    raise RequestRejected('Server replied %s' % STATUS_NAMES.get(status,
+                                                                 'unknown status %d' % status))
+
+def split_address(address, default_port=DEFAULT_PORT):
+    """
+    Return the (host, port) of a host[:port] address, as LogCabin takes them.
+    """
+
+    m = re.match(r'^\[(.*)\](?::(\d+))?$', address) or re.match(r'^([^:]*)(?::(\d+))?$', address)
+    if m is None:
+        # An IPv6 address without brackets
+        return address, default_port
+    return m.group(1), int(m.group(2) or default_port)
+
+# Core/Time.cc parseSignedDuration units, in seconds
+DURATION_UNITS = {
+    'ns': 1e-9, 'nanosecond': 1e-9, 'nanoseconds': 1e-9,
+    'us': 1e-6, 'microsecond': 1e-6, 'microseconds': 1e-6,
+    'ms': 1e-3, 'millisecond': 1e-3, 'milliseconds': 1e-3,
+    's': 1, 'second': 1, 'seconds': 1, '': 1,
+    'min': 60, 'minute': 60, 'minutes': 60,
+    'h': 3600, 'hr': 3600, 'hour': 3600, 'hours': 3600
+}
+
+def parse_duration(description):
+    """
+    Return the seconds of a duration as LogCabin's tools take them, e.g. 250ms or 10s.
+    """
+
+    m = re.match(r'^\s*([\d.]+)\s*([a-z]*)\s*$', str(description))
+    if m is None or m.group(2) not in DURATION_UNITS:
+        raise ValueError('Invalid time description: %r' % description)
+    return float(m.group(1)) * DURATION_UNITS[m.group(2)]
+
+class Connection(object):
+    """
+    A blocking MessageSocket connection, for one RPC at a time.
+    """
+
+    def __init__(self, address, timeout):
+        self.address = address
+        try:
+            self.socket = socket.create_connection(split_address(address), timeout)
+        except (socket.error, socket.timeout) as e:
+            raise RPCError('Could not connect to %s: %s' % (address, e))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.next_message_id = 0
+
+    def _receive(self, length):
+        chunks = []
+        while length > 0:
+            chunk = self.socket.recv(length)
+            if not chunk:
+                raise RPCError('Connection to %s closed' % self.address)
+            chunks.append(chunk)
+            length -= len(chunk)
+        return b''.join(chunks)
+
+    def call(self, service, op_code, request, timeout):
+        """
+        Send a serialized request and return the serialized response (see response_body).
+        """
+
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        try:
+            self.socket.settimeout(timeout)
+            self.socket.sendall(frame(message_id, request_payload(service, op_code, request)))
+            while True:
+                length, reply_id = parse_header(self._receive(HEADER.size))
+                payload = self._receive(length)
+                # Anything else (e.g. a reply to a ping) is not for us
+                if reply_id == message_id:
+                    return response_body(payload)
+        except socket.timeout:
+            raise RPCError('Timed out waiting for %s' % self.address)
+        except socket.error as e:
+            raise RPCError('Connection to %s failed: %s' % (self.address, e))
+
+    def close(self):
+        self.socket.close()
+
+_ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+def protocol(name):
+    """
+    Return the generated module of Protocol/<name>.proto, e.g. protocol('ServerControl'). The
+    .proto files import each other as build/Protocol/..., so the modules live in the build.Protocol
+    package of the top of the repository. ImportError is raised if they have not been built or the
+    protobuf package is missing.
+    """
+
+    if _ROOT not in sys.path:
+        sys.path.insert(0, _ROOT)
+    return importlib.import_module('build.Protocol.%s_pb2' % name)
+
+def available():
+    """
+    Return whether the protocol buffer modules can be used, and so ControlClient.
+    """
+
+    try:
+        protocol('ServerControl')
+        return True
+    except ImportError:
+        return False
+
+def _op_code_name(rpc):
+    # DebugFilenameGet to DEBUG_FILENAME_GET
+    return re.sub(r'(?<!^)(?=[A-Z])', '_', rpc).upper()
+
+class ControlClient(object):
+    """
+    Calls the ControlService of one server. The connection is opened on the first call and kept;
+    if it fails, the call is retried on a new one until the timeout, as ServerControl does.
+    """
+
+    def __init__(self, address, timeout=10):
+        self.address = address
+        self.timeout = timeout
+        self.connection = None
+        self.messages = protocol('ServerControl')
+        # One call at a time on the connection
+        self.lock = threading.Lock()
+
+    def call(self, rpc, **fields):
+        """
+        Call the named RPC of Protocol/ServerControl.proto (e.g. ServerStatsGet) with a request of
+        the given fields, and return its response. RPCError is raised if it fails, including with
+        the error the response carries, if any.
+        """
+
+        messages = getattr(self.messages, rpc)
+        op_code = self.messages.OpCode.Value(_op_code_name(rpc))
+        request = messages.Request(**fields).SerializeToString()
+
+        with self.lock:
+            body = self._call(op_code, request)
+
+        response = messages.Response()
+        response.ParseFromString(body)
+        if 'error' in response.DESCRIPTOR.fields_by_name and response.HasField('error'):
+            raise RPCError('%s on %s: %s' % (rpc, self.address, response.error))
+        return response
+
+    def _call(self, op_code, request):
+        deadline = time.time() + self.timeout
+        error = RPCError('Timed out calling %s' % self.address)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # With why the last attempt failed
+                raise error
+            try:
+                if self.connection is None:
+                    self.connection = Connection(self.address, remaining)
+                return self.connection.call(CONTROL_SERVICE, op_code, request,
+                                            max(deadline - time.time(), 1e-3))
+            except RequestRejected:
+                raise
+            except RPCError as e:
+                self.close()
+                error = e
+                # As ClientImpl's session creation backoff, more or less
+                time.sleep(min(.01, max(deadline - time.time(), 0)))
+
+    def server_info(self):
+        """
+        Return the ServerInfoGet response of the server: its id, addresses and process id.
+        """
+
+        return self.call('ServerInfoGet')
+
+    def server_stats(self):
+        """
+        Return the ServerStats message of the server.
+        """
+
+        return self.call('ServerStatsGet').server_stats
+
+    def snapshot_inhibit(self, nanoseconds=None):
+        """
+        Keep the server from snapshotting for the given time: forever with None, and not at all
+        with 0 (as snapshot inhibit set and clear).
+        """
+
+        if nanoseconds is None:
+            self.call('SnapshotInhibitSet')
+        else:
+            self.call('SnapshotInhibitSet', nanoseconds=nanoseconds)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,214 @@
+"""
+Runs the points of an experiment's parameter grid in parallel, each on a cluster of its own.
+
+The hosts in localconfig.py are split into disjoint clusters (e.g. twelve 5-server clusters out of
+60 hosts), or, on a single machine, several loopback clusters are run side by side. Each cluster is
+served by a worker thread that takes the next point off the queue and runs it. A point that fails
+is retried, on whichever cluster frees up next, and the results of all points are merged in the
+order of the grid.
+"""
+
+from __future__ import print_function
+
+import collections
+import threading
+import time
+import traceback
+
+from common import spawn, gather, hosts
+from TestFramework import TestFramework, ClusterFixture
+
+def partition_hosts(cluster_hosts, cluster_size):
+    """
+    Split the hosts into as many disjoint clusters of cluster_size hosts as possible. Leftover
+    hosts are not used.
+    """
+
+    return [cluster_hosts[i:i + cluster_size]
+            for i in range(0, len(cluster_hosts) - cluster_size + 1, cluster_size)]
+
+class Slot(object):
+    """
+    One cluster of the scheduler, with the fixture that keeps it running between points.
+    """
+
+    def __init__(self, index, factory, cluster_hosts, local_servers, server_command, reconf_opts,
+                 debug):
+        self.index = index
+        self.cluster_hosts = cluster_hosts
+        self.local_servers = local_servers
+        self.factory = factory
+        self.fixture = ClusterFixture(self._create, server_command, reconf_opts, debug)
+        # Failures since the last point that succeeded on this cluster
+        self.failures = 0
+
+    def servers(self):
+        """
+        Number of servers in the cluster.
+        """
+
+        if self.cluster_hosts is None:
+            return self.local_servers
+        return len(self.cluster_hosts)
+
+    def _create(self, **params):
+        params = dict(params)
+        if self.cluster_hosts is None:
+            params.setdefault('local_servers', self.local_servers)
+        else:
+            params['cluster_hosts'] = self.cluster_hosts
+        return self.factory(**params)
+
+class Scheduler(object):
+    """
+    Runs points of a parameter grid concurrently on disjoint clusters.
+
+    Each point is run by run_point(fixture, point), which gets the cluster through
+    fixture.acquire(**params) (see TestFramework.ClusterFixture), so that consecutive points with
+    the same restart parameters reuse the running cluster. It returns the rows of results of the
+    point, e.g. the metadata of the experiments it ran.
+    """
+
+    def __init__(
+        self,
+        factory = TestFramework,
+        clusters = 1,
+        cluster_size = None,
+        local_servers = None,
+        retries = 2,
+        server_command = "build/LogCabin",
+        reconf_opts = "",
+        debug = False
+    ):
+        """
+        With local_servers, clusters loopback clusters of that many servers are run on this
+        machine. Otherwise the hosts in localconfig.py are split into clusters of cluster_size
+        hosts, by default into the given number of clusters of equal size.
+
+        A point that raises an exception is retried up to retries times. A cluster that fails
+        twice in a row is cleaned up and retired, as long as another one is left. With debug, the
+        debug files of every cluster are kept on cleanup, including when a cluster is replaced by
+        one with other parameters; those of a cluster a point failed on are always kept.
+        """
+
+        if local_servers:
+            self.slots = [Slot(i, factory, None, local_servers, server_command, reconf_opts,
+                               debug)
+                          for i in range(clusters)]
+        else:
+            if cluster_size is None:
+                cluster_size = len(hosts) // clusters
+            partitions = partition_hosts(hosts, cluster_size)
+            if cluster_size < 1 or not partitions:
+                raise Exception('Cannot make clusters of %d servers out of %d hosts' % (
+                    cluster_size, len(hosts)))
+            self.slots = [Slot(i, factory, cluster_hosts, None, server_command, reconf_opts,
+                               debug)
+                          for i, cluster_hosts in enumerate(partitions)]
+
+        self.retries = retries
+        self.debug = debug
+
+        # Points run, retried and given up on, along with the error of their last attempt
+        self.completed = 0
+        self.retried = 0
+        self.failures = []
+        self.run_time = None
+
+    def servers(self):
+        """
+        Number of servers in the smallest cluster, i.e. the largest cluster a point can use.
+        """
+
+        return min([slot.servers() for slot in self.slots])
+
+    def run(self, points, run_point):
+        """
+        Run every point and return the rows of all points that succeeded, in the order of the
+        points. The clusters are cleaned up once all points have finished.
+        """
+
+        print('\nScheduling %d points on %d clusters of %d servers' % (
+            len(points), len(self.slots), self.servers()))
+
+        start_time = time.time()
+
+        # (index, point, attempt) of the points left to run
+        queue = collections.deque([(index, point, 1) for index, point in enumerate(points)])
+        # Index to rows of the points that succeeded
+        results = {}
+        state = {"running": 0, "workers": len(self.slots)}
+        condition = threading.Condition()
+
+        def work(slot):
+            while True:
+                with condition:
+                    # A running point may fail and come back to the queue
+                    while not queue and state["running"]:
+                        condition.wait()
+                    if not queue:
+                        condition.notify_all()
+                        return
+                    index, point, attempt = queue.popleft()
+                    state["running"] += 1
+
+                print('\n[cluster %d] Running point %s (attempt %d)' % (slot.index, point, attempt))
+
+                try:
+                    rows = run_point(slot.fixture, point)
+                    error = None
+                except Exception as e:
+                    traceback.print_exc()
+                    error = e
+                    # The cluster may be in any state; start over on the next point
+                    slot.fixture.release(debug=True)
+
+                with condition:
+                    state["running"] -= 1
+                    if error is None:
+                        slot.failures = 0
+                        results[index] = rows
+                        self.completed += 1
+                    else:
+                        slot.failures += 1
+                        if attempt <= self.retries:
+                            self.retried += 1
+                            queue.append((index, point, attempt + 1))
+                        else:
+                            print('\n[cluster %d] Giving up on point %s: %s' % (
+                                slot.index, point, error))
+                            self.failures.append((point, error))
+                    condition.notify_all()
+
+                    if slot.failures >= 2 and state["workers"] > 1:
+                        print('\n[cluster %d] Retiring cluster after %d failures in a row' % (
+                            slot.index, slot.failures))
+                        state["workers"] -= 1
+                        return
+
+        try:
+            gather([spawn(work, slot) for slot in self.slots])
+        finally:
+            gather([spawn(slot.fixture.release) for slot in self.slots])
+
+        self.run_time = time.time() - start_time
+        print('\n%s' % self.report())
+
+        rows = []
+        for index in sorted(results.keys()):
+            rows.extend(results[index])
+        return rows
+
+    def report(self):
+        """
+        Summary of the last run.
+        """
+
+        lines = ['Points completed: %d, retried: %d, failed: %d, in %.1f s on %d clusters' % (
+            self.completed, self.retried, len(self.failures), self.run_time or 0,
+            len(self.slots))]
+        for slot in self.slots:
+            lines.append('  cluster %d: %s' % (slot.index, slot.fixture.report()))
+        for point, error in self.failures:
+            lines.append('  failed %s: %s' % (point, error))
+        return '\n'.join(lines)
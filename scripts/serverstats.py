@@ -0,0 +1,403 @@
+"""
+Server statistics as structured data. ServerControl stats get prints the ServerStats of a server
+(see Protocol/ServerStats.proto) in the protobuf text format; parse() turns that into Message
+objects, typed by the .proto file itself, so that every field is there to read instead of the few
+that used to be scraped from stats dump lines in the debug logs:
+
+    stats = parse(output)
+    stats.raft.commit_index                         # an int
+    stats.raft.state                                # 'LEADER', the name of the enum value
+    [peer.server_id for peer in stats.raft.peer]    # repeated fields are lists
+    stats.storage.metadata_write_nanos.average      # a float, from a RollingStat
+    stats.state_machine.tree.num_write_success
+
+As with protobuf messages, a field that is not set reads as its default (0, False, '', the first
+value of its enum or an empty message) and has() tells whether it is set.
+
+Where the stats come as a protocol buffer instead (see rpc.ControlClient), ProtobufMessage gives
+them the same interface, without going through the text format.
+"""
+
+from __future__ import print_function
+
+import codecs
+import os
+import re
+
+PROTO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Protocol')
+SERVER_STATS_PROTO = os.path.join(PROTO_DIR, 'ServerStats.proto')
+
+def _to_bool(token):
+    if token in ('true', 't', '1', 'True'):
+        return True
+    if token in ('false', 'f', '0', 'False'):
+        return False
+    raise ValueError('Not a bool: %s' % token)
+
+def _to_float(token):
+    lower = token.lower().rstrip('f')
+    if lower in ('inf', 'infinity'):
+        return float('inf')
+    if lower in ('-inf', '-infinity'):
+        return float('-inf')
+    if lower == 'nan':
+        return float('nan')
+    return float(lower)
+
+# Scalar type to (conversion from a text format token, default value)
+SCALARS = dict(
+    [(name, (lambda token: int(token, 0), 0)) for name in
+     ('int32', 'int64', 'uint32', 'uint64', 'sint32', 'sint64',
+      'fixed32', 'fixed64', 'sfixed32', 'sfixed64')] +
+    [(name, (_to_float, 0.0)) for name in ('double', 'float')] +
+    [('bool', (_to_bool, False)), ('string', (None, '')), ('bytes', (None, b''))])
+
+class Field(object):
+    """
+    A field of a message type: its label (optional, required or repeated), type name and number.
+    """
+
+    def __init__(self, label, type_name, name, number):
+        self.label = label
+        self.type_name = type_name
+        self.name = name
+        self.number = number
+        # The MessageType or EnumType, for fields that are not scalars; set by Schema
+        self.type = None
+
+    @property
+    def repeated(self):
+        return self.label == 'repeated'
+
+class EnumType(object):
+    def __init__(self, name):
+        self.name = name
+        # Value names in the order declared, and to their numbers
+        self.names = []
+        self.values = {}
+
+class MessageType(object):
+    def __init__(self, name):
+        self.name = name
+        self.fields = {}
+        # Nested message and enum types by name
+        self.nested = {}
+
+_PROTO_TOKEN = re.compile(r'\s*(?:(?P<word>[\w.]+)|(?P<string>"[^"]*")|(?P<punct>[{}=;<>,\[\]()]))')
+_PROTO_COMMENTS = re.compile(r'//[^\n]*|/\*.*?\*/', re.DOTALL)
+
+class Schema(object):
+    """
+    The message and enum types of .proto files, by full name (e.g.
+    LogCabin.Protocol.ServerStats.Raft).
+    """
+
+    def __init__(self, *paths):
+        self.types = {}
+        for path in paths:
+            with open(path) as f:
+                self._parse(f.read())
+
+    def _parse(self, text):
+        tokens = []
+        text = _PROTO_COMMENTS.sub(' ', text)
+        for m in _PROTO_TOKEN.finditer(text):
+            tokens.append(m.group('word') or m.group('string') or m.group('punct'))
+
+        package = ''
+        scopes = []
+        fields = []
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token == 'package':
+                package = tokens[i + 1]
+                i += 3
+            elif token in ('message', 'enum'):
+                prefix = scopes[-1].name if scopes else package
+                name = '%s.%s' % (prefix, tokens[i + 1]) if prefix else tokens[i + 1]
+                declared = MessageType(name) if token == 'message' else EnumType(name)
+                if scopes:
+                    scopes[-1].nested[tokens[i + 1]] = declared
+                self.types[name] = declared
+                scopes.append(declared)
+                i += 3
+            elif token == '}':
+                scopes.pop()
+                i += 1
+            elif token in ('optional', 'required', 'repeated'):
+                # label type name = number [options] ;
+                field = Field(token, tokens[i + 1], tokens[i + 2], int(tokens[i + 4]))
+                scopes[-1].fields[field.name] = field
+                fields.append((scopes[-1], field))
+                i = tokens.index(';', i) + 1
+            elif scopes and isinstance(scopes[-1], EnumType) and tokens[i + 1] == '=':
+                scopes[-1].names.append(token)
+                scopes[-1].values[token] = int(tokens[i + 2])
+                i = tokens.index(';', i) + 1
+            elif token in ('import', 'option', 'syntax'):
+                i = tokens.index(';', i) + 1
+            else:
+                # Stray ';' after a closing brace, or something that does not matter here
+                i += 1
+
+        for message, field in fields:
+            if field.type_name not in SCALARS:
+                field.type = self._resolve(message.name, field.type_name)
+
+    def _resolve(self, scope, name):
+        """
+        Find a type by the name it is referred to with from within the given scope, as protoc
+        does: in the innermost enclosing scope first.
+        """
+
+        if name.startswith('.'):
+            return self.types[name[1:]]
+        while True:
+            candidate = '%s.%s' % (scope, name) if scope else name
+            if candidate in self.types:
+                return self.types[candidate]
+            if not scope:
+                raise KeyError('Unknown type %s' % name)
+            scope = scope.rpartition('.')[0]
+
+    def message(self, name):
+        """
+        Return an empty Message of the given type.
+        """
+
+        return Message(self.types[name])
+
+class Message(object):
+    """
+    A message, with a Python value per field: an int, float, bool or str for scalars, the name of
+    the value for enums, a Message for messages and a list of those for repeated fields.
+    """
+
+    def __init__(self, type):
+        self._type = type
+        self._values = {}
+
+    def has(self, name):
+        """
+        Return whether a field is set (non-empty for repeated fields).
+        """
+
+        self._field(name)
+        return name in self._values
+
+    def _field(self, name):
+        try:
+            return self._type.fields[name]
+        except KeyError:
+            raise AttributeError('%s has no field %s' % (self._type.name, name))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        field = self._field(name)
+        if name in self._values:
+            return self._values[name]
+        if field.repeated:
+            return []
+        if isinstance(field.type, MessageType):
+            return Message(field.type)
+        if isinstance(field.type, EnumType):
+            return field.type.names[0]
+        return SCALARS[field.type_name][1]
+
+    def _set(self, name, value):
+        if self._field(name).repeated:
+            self._values.setdefault(name, []).append(value)
+        else:
+            self._values[name] = value
+
+    def to_dict(self):
+        """
+        Return the fields that are set as nested dictionaries and lists.
+        """
+
+        def plain(value):
+            if isinstance(value, Message):
+                return value.to_dict()
+            if isinstance(value, list):
+                return [plain(v) for v in value]
+            return value
+        return dict([(name, plain(value)) for name, value in self._values.items()])
+
+    def __eq__(self, other):
+        return (isinstance(other, Message) and self._type is other._type and
+                self._values == other._values)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self._type.name.rpartition('.')[2], ', '.join(
+            ['%s=%r' % (name, self._values[name]) for name in sorted(self._values)]))
+
+_TEXT_TOKEN = re.compile(r'\s*(?:(?P<string>"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')'
+                         r'|(?P<word>[-+\w.]+)|(?P<punct>[{}<>:\[\],;]))')
+
+def _unquote(token):
+    # TextFormat escapes strings as C does
+    data = codecs.escape_decode(token[1:-1])[0]
+    return data if isinstance(data, str) else data.decode('utf-8', 'replace')
+
+def _tokenize(text):
+    tokens = []
+    position = 0
+    text = text.rstrip()
+    while position < len(text):
+        m = _TEXT_TOKEN.match(text, position)
+        if m is None or m.end() == position:
+            raise ValueError('Cannot parse text format at: %r' % text[position:position + 40])
+        tokens.append(m)
+        position = m.end()
+    return tokens
+
+def parse_text(text, message):
+    """
+    Merge the protobuf text format (as printed by protobuf's TextFormat, e.g. by ServerControl)
+    into message, and return it.
+    """
+
+    tokens = _tokenize(text)
+
+    def value(field, i):
+        """Return the value at token i and the index of the token after it."""
+        m = tokens[i]
+        if isinstance(field.type, MessageType):
+            close = {'{': '}', '<': '>'}[m.group('punct')]
+            return fields(Message(field.type), i + 1, close)
+        if m.group('string') is not None:
+            # Adjacent strings are concatenated
+            parts = []
+            while i < len(tokens) and tokens[i].group('string') is not None:
+                parts.append(_unquote(tokens[i].group('string')))
+                i += 1
+            return ''.join(parts), i
+        token = m.group('word')
+        if isinstance(field.type, EnumType):
+            if token not in field.type.values:
+                number = int(token)
+                token = [name for name in field.type.names
+                         if field.type.values[name] == number][0]
+            return token, i + 1
+        return SCALARS[field.type_name][0](token), i + 1
+
+    def fields(message, i, close):
+        while i < len(tokens):
+            m = tokens[i]
+            if close is not None and m.group('punct') == close:
+                return message, i + 1
+            if m.group('punct') in (',', ';'):
+                i += 1
+                continue
+            field = message._field(m.group('word'))
+            i += 1
+            if tokens[i].group('punct') == ':':
+                i += 1
+            if tokens[i].group('punct') == '[':
+                # Short form of a repeated field
+                i += 1
+                while tokens[i].group('punct') != ']':
+                    if tokens[i].group('punct') == ',':
+                        i += 1
+                        continue
+                    item, i = value(field, i)
+                    message._set(field.name, item)
+                i += 1
+            else:
+                item, i = value(field, i)
+                message._set(field.name, item)
+        if close is not None:
+            raise ValueError('Text format ends inside a %s' % message._type.name)
+        return message, i
+
+    return fields(message, 0, None)[0]
+
+_server_stats_schema = None
+
+def server_stats_schema():
+    """
+    Return the Schema of Protocol/ServerStats.proto, read on first use.
+    """
+
+    global _server_stats_schema
+    if _server_stats_schema is None:
+        _server_stats_schema = Schema(SERVER_STATS_PROTO)
+    return _server_stats_schema
+
+def parse(text):
+    """
+    Return the ServerStats Message printed by ServerControl stats get.
+    """
+
+    return parse_text(text, server_stats_schema().message('LogCabin.Protocol.ServerStats'))
+
+class ProtobufMessage(object):
+    """
+    A protocol buffer message (e.g. the ServerStats of rpc.ControlClient.server_stats) read as a
+    Message is: enums as the names of their values, repeated fields as lists, and has() and
+    to_dict().
+    """
+
+    def __init__(self, message):
+        self._message = message
+
+    def _field(self, name):
+        try:
+            return self._message.DESCRIPTOR.fields_by_name[name]
+        except KeyError:
+            raise AttributeError('%s has no field %s' % (self._message.DESCRIPTOR.full_name, name))
+
+    def has(self, name):
+        """
+        Return whether a field is set (non-empty for repeated fields).
+        """
+
+        if self._field(name).label == self._field(name).LABEL_REPEATED:
+            return len(getattr(self._message, name)) > 0
+        return self._message.HasField(name)
+
+    @staticmethod
+    def _value(field, value):
+        if field.type == field.TYPE_MESSAGE:
+            return ProtobufMessage(value)
+        if field.type == field.TYPE_ENUM:
+            return field.enum_type.values_by_number[value].name
+        return value
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        field = self._field(name)
+        value = getattr(self._message, name)
+        if field.label == field.LABEL_REPEATED:
+            return [self._value(field, v) for v in value]
+        return self._value(field, value)
+
+    def to_dict(self):
+        """
+        Return the fields that are set as nested dictionaries and lists.
+        """
+
+        def plain(value):
+            if isinstance(value, ProtobufMessage):
+                return value.to_dict()
+            if isinstance(value, list):
+                return [plain(v) for v in value]
+            return value
+        return dict([(field.name, plain(getattr(self, field.name)))
+                     for field, _ in self._message.ListFields()])
+
+    def __eq__(self, other):
+        return isinstance(other, ProtobufMessage) and self._message == other._message
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (self._message.DESCRIPTOR.name, ', '.join(
+            ['%s=%r' % (name, value) for name, value in sorted(self.to_dict().items())]))
@@ -10,13 +10,26 @@ Options:
   --binary=<cmd>                    Server binary to execute [default: build/LogCabin]
   --reconf=<opts>                   Additional options to pass through to the Reconfigure
                                     binary. [default: '']
+  --storage=<specs>                 Comma-separated storage configurations to sweep, each a
+                                    storage module optionally followed by :<path> (e.g.
+                                    Segmented:shm for a log in /dev/shm, see
+                                    TestFramework). [default: Segmented]
 """
 
-import re
-import time
-
 from docopt import docopt
-from TestFramework import TestFramework, run_shell_command
+from TestFramework import TestFramework, ClusterFixture, run_shell_command
+
+# ServerStats counters reported for each experiment: label, csv column and how to read it
+COUNTERS = [
+    ("Snapshots attempted", "snapshots_attempted",
+     lambda stats: stats.state_machine.num_snapshots_attempted),
+    ("Snapshots failed", "snapshots_failed",
+     lambda stats: stats.state_machine.num_snapshots_failed),
+    ("Write attempted", "writes_attempted",
+     lambda stats: stats.state_machine.tree.num_write_attempted),
+    ("Write succeded", "writes_succeeded",
+     lambda stats: stats.state_machine.tree.num_write_success),
+]
 
 class SnapshotTest(TestFramework):
     # Experiment metadata
@@ -31,119 +44,136 @@ class SnapshotTest(TestFramework):
         self, 
         snapshotMinLogSize = 67108864,
         snapshotRatio = 4,
-        snapshotWatchdogMilliseconds = 10000
+        snapshotWatchdogMilliseconds = 10000,
+        snapshotting = True,
+        **kwargs
     ):
+        """
+        snapshotting is whether the experiments on this cluster let the servers snapshot. It is
+        only set at runtime (see allowSnapshotting), but it is a constructor parameter so that a
+        ClusterFixture builds a fresh cluster for each setting: a log grown with snapshotting
+        inhibited would otherwise be compacted during the first experiment that allows it.
+        """
+
+        self.snapshotting = snapshotting
+        self.stats_baseline = {}
+
         TestFramework.__init__(
             self,
             snapshotMinLogSize,
             snapshotRatio,
             snapshotWatchdogMilliseconds,
+            **kwargs
         )
 
-        # Test stats
+    def new_experiment(self):
+        """
+        Start collecting stats for a new experiment on this cluster. The servers' counters run
+        from when they started, so printStats reports them relative to their values now.
+        """
+
         SnapshotTest.experiment_number += 1
         SnapshotTest.stats[SnapshotTest.experiment_number] = {}
+        self.stats_baseline = self.server_stats()
 
     def allowSnapshotting(self):
         SnapshotTest.stats[SnapshotTest.experiment_number]["snapshotting"] = 1
 
-        for _, server_ip in self.server_ids_ips:
-            self.execute_client_command(
-                client_executable = "build/Client/ServerControl",
-                conf = {
-                    "options": "--timeout=10",
-                    "command": "snapshot inhibit clear",
-                    "server_ip": server_ip,
-                },
-                onCluster = False,
-            )
+        if self.native_control:
+            for _, server_ip in self.server_ids_ips:
+                self.control_client(server_ip).snapshot_inhibit(0)
+            return
+
+        self.execute_client_command_on_servers(
+            client_executable = "build/Client/ServerControl",
+            conf = {
+                "options": "--timeout=10",
+                "command": "snapshot inhibit clear",
+            },
+        )
 
     def disallowSnapshotting(self):
         SnapshotTest.stats[SnapshotTest.experiment_number]["snapshotting"] = 0
 
-        for _, server_ip in self.server_ids_ips:
-            self.execute_client_command(
-                client_executable = "build/Client/ServerControl",
-                conf = {
-                    "options": "--timeout=10",
-                    "command": "snapshot inhibit set",
-                    "server_ip": server_ip,
-                },
-                onCluster = False,
-            )
+        if self.native_control:
+            for _, server_ip in self.server_ids_ips:
+                self.control_client(server_ip).snapshot_inhibit()
+            return
+
+        self.execute_client_command_on_servers(
+            client_executable = "build/Client/ServerControl",
+            conf = {
+                "options": "--timeout=10",
+                "command": "snapshot inhibit set",
+            },
+        )
 
     def executeBenchmark(self, size, writes, run):
         SnapshotTest.stats[SnapshotTest.experiment_number]["size"] = size
         SnapshotTest.stats[SnapshotTest.experiment_number]["writes"] = writes
         SnapshotTest.stats[SnapshotTest.experiment_number]["run"] = run
 
-        start_time = time.time()
-
-        self.execute_client_command(
+        timing = self.execute_client_command(
             client_executable = "build/Examples/Benchmark",
             conf = {
-                "options": "--size=%s --writes=%s" % (size, writes),
+                "options": "--size=%s --writes=%s --phases" % (size, writes),
                 "command": "",
-            }
+            },
+            timed = True
         )
 
-        end_time = time.time()
+        # The time Benchmark spent writing, after it found the leader, rather than the time of the
+        # whole process
+        duration = timing.took
+        if duration is None:
+            duration = timing.total()
 
-        SnapshotTest.stats[SnapshotTest.experiment_number]["time"] = end_time - start_time
-
-    def dumpStats(self):
-        for _, server_ip in self.server_ids_ips:
-            self.execute_client_command(
-                client_executable = "build/Client/ServerControl",
-                conf = {
-                    "options": "--timeout=10",
-                    "command": "stats dump",
-                    "server_ip": server_ip,
-                },
-                onCluster = False,
-            )
+        SnapshotTest.stats[SnapshotTest.experiment_number]["time"] = duration
 
     def printStats(self):
-        for server_id, _ in self.server_ids_ips:
+        """
+        Print each server's counters for the current experiment (since new_experiment), and
+        record their sums over the servers with its other stats.
+        """
+
+        totals = dict([(column, 0) for _, column, _ in COUNTERS])
+        for server_id, stats in sorted(self.server_stats().items()):
             self._print_string("\nServer %d stats" % server_id)
 
-            for line in open('debug/server_%d' % server_id):
-                m = re.search('num_snapshots_attempted: (\d+)', line)
-                if m is not None:
-                    print "Snapshots attempted: %s" % m.group(1)
-
-                m = re.search('num_snapshots_failed: (\d+)', line)
-                if m is not None:
-                    print "Snapshots failed: %s" % m.group(1)
-                
-                m = re.search('num_write_attempted: (\d+)', line)
-                if m is not None:
-                    print "Write attempted: %s" % m.group(1)
-
-                m = re.search('num_write_success: (\d+)', line)
-                if m is not None:
-                    print "Write succeded: %s" % m.group(1)
+            baseline = self.stats_baseline.get(server_id)
+            for label, column, counter in COUNTERS:
+                value = counter(stats)
+                if baseline is not None:
+                    value -= counter(baseline)
+                print("%s: %d" % (label, value))
+                totals[column] += value
+
+        SnapshotTest.stats[SnapshotTest.experiment_number].update(totals)
     
 def run_test(
-    server_command,
-    reconf_opts,
+    fixture,
     snapshotting,
     size,
     writes,
-    run
+    run,
+    storage = "Segmented"
 ):
-    snapshotTest = SnapshotTest(
+    # The cluster is only built once per storage and snapshotting setting, and reset (the Tree
+    # is emptied) in between. The Raft log is not reset, but it only carries the earlier writes
+    # of the same setting, so the comparison of the two settings is not skewed by what the other
+    # one left behind; the counters are taken relative to the start of each combination.
+    snapshotTest = fixture.acquire(
         snapshotMinLogSize = 1024,
         snapshotRatio = 4,
-        snapshotWatchdogMilliseconds = 1000
+        snapshotWatchdogMilliseconds = 1000,
+        snapshotting = snapshotting,
+        **storage_params(storage)
     )
 
     snapshotTest._print_attr()
 
-    snapshotTest.create_configs()
-    snapshotTest.create_folders()
-
-    snapshotTest.initialize_cluster(server_command, reconf_opts)
+    snapshotTest.new_experiment()
+    SnapshotTest.stats[SnapshotTest.experiment_number]["storage"] = storage
 
     if snapshotting:
         snapshotTest.allowSnapshotting()
@@ -152,10 +182,19 @@ def run_test(
 
     snapshotTest.executeBenchmark(size, writes, run)
 
-    snapshotTest.dumpStats()
     snapshotTest.printStats()
 
-    snapshotTest.cleanup()
+def storage_params(storage):
+    """
+    Return the TestFramework storage parameters for a storage spec: a storage module,
+    optionally followed by :<path>.
+    """
+
+    module, _, path = storage.partition(':')
+    params = {"storageModule": module}
+    if path:
+        params["storagePath"] = path
+    return params
 
 def write_csv(
     file,
@@ -196,29 +235,37 @@ def execute_experiment(
     reconf_opts,
     size_array,
     writes_array,
-    runs=5
+    runs=5,
+    storage_array=["Segmented"]
 ):
-
-    for run in range(runs):
-        print("\n\n=============================================")
-        print("Run %d" % run)
-        print("=============================================\n\n")
-        for size in size_array:
-            for writes in writes_array:
-                for snapshotting in [True, False]:
-                    print("\n\n=============================================")
-                    print("size: %d, writes: %d, snapshotting: %s" % (size, writes, snapshotting))
-                    print("=============================================\n\n")
-
-                    # Run the test
-                    run_test(
-                        server_command,
-                        reconf_opts,
-                        snapshotting,
-                        size,
-                        writes,
-                        run
-                    )
+    fixture = ClusterFixture(SnapshotTest, server_command, reconf_opts)
+
+    # Storage and snapshotting are the outer loops, as changing either takes a new cluster
+    for storage in storage_array:
+        for snapshotting in [True, False]:
+            for run in range(runs):
+                print("\n\n=============================================")
+                print("Storage %s, snapshotting %s, run %d" % (storage, snapshotting, run))
+                print("=============================================\n\n")
+                for size in size_array:
+                    for writes in writes_array:
+                        print("\n\n=============================================")
+                        print("size: %d, writes: %d, snapshotting: %s" % (
+                            size, writes, snapshotting))
+                        print("=============================================\n\n")
+
+                        # Run the test
+                        run_test(
+                            fixture,
+                            snapshotting,
+                            size,
+                            writes,
+                            run,
+                            storage
+                        )
+
+    fixture.release()
+    print(fixture.report())
     
     write_csv(
         file = SnapshotTest.csv_file,
@@ -248,6 +295,7 @@ def main():
         reconf_opts = reconf_opts,
         size_array = size_array,
         writes_array = writes_array,
+        storage_array = arguments['--storage'].split(','),
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,353 @@
+"""
+Declarative sweeps over the server configuration. A sweep file (JSON) names the configuration keys
+to vary, the values each may take and how to sample them, and the workload to run at every point.
+Each point gets a cluster of its own configuration, and the results of all points are written to
+one tidy table: a row per measurement, with the point's settings in columns.
+
+Example sweep file:
+
+    {
+        "mode": "lhs",
+        "samples": 20,
+        "seed": 1,
+        "parameters": {
+            "electionTimeoutMilliseconds": {"min": 50, "max": 1000, "log": true},
+            "heartbeatPeriodMilliseconds": {"min": 10, "max": 250},
+            "rpcFailureBackoffMilliseconds": [50, 100, 250]
+        },
+        "fixed": {"raftDebug": false},
+        "workload": {"name": "election", "repeat": 20}
+    }
+
+Modes:
+  grid      Every combination of the values. Ranges need a count, of evenly spaced values.
+  random    samples points, each value drawn independently.
+  lhs       samples points of a Latin hypercube: the range of every key is split into samples
+            strata, and each stratum is used by exactly one point.
+
+A parameter is either a list of values or a range {"min", "max"}, optionally with "log": true to
+sample on a log scale and "count" for grid. A range is of integers if both ends are. Keys that are
+TestFramework parameters (e.g. electionTimeoutMilliseconds or storageModule) are passed to it as
+such; any other key goes into the server configuration through serverConfig. fixed settings are
+used at every point.
+
+Workloads:
+  election   Kill the leader repeat times and time each election (see electionperf.py).
+  stall      Freeze the leader for stall ms (default 300) repeat times (see electionperf.py).
+  benchmark  Run Benchmark repeat times with the given options, and record its steady-state
+             throughput and phases (see timing.py).
+
+Usage:
+  sweep.py <sweep-file> [options]
+  sweep.py (-h | --help)
+
+Options:
+  -h --help            Show this help message and exit
+  --local=<servers>    Run loopback clusters of this many servers on this machine, instead of
+                       the hosts in localconfig.py. Overrides "servers" in the sweep file.
+  --parallel=<n>       Run this many points at once, each on its own cluster [default: 1]
+  --out=<csv>          Where to write the results [default: scripts/plot/csv/sweep.csv]
+  --dry-run            Print the points and exit.
+"""
+
+from __future__ import print_function
+
+import inspect
+import itertools
+import json
+import math
+import random
+
+from docopt import docopt
+
+from TestFramework import TestFramework
+from electionperf import ElectionTest
+from scheduler import Scheduler
+from timing import PHASES
+
+MODES = ['grid', 'random', 'lhs']
+
+def _is_range(spec):
+    return isinstance(spec, dict)
+
+def _from_unit(spec, q):
+    """
+    Map q in [0, 1) to the parameter's range (or its values).
+    """
+
+    if not _is_range(spec):
+        return spec[min(int(q * len(spec)), len(spec) - 1)]
+
+    low, high = spec["min"], spec["max"]
+    if spec.get("log"):
+        value = math.exp(math.log(low) + q * (math.log(high) - math.log(low)))
+    else:
+        value = low + q * (high - low)
+    if isinstance(low, int) and isinstance(high, int):
+        return min(int(round(value)), high)
+    return value
+
+def _grid_values(spec):
+    if not _is_range(spec):
+        return list(spec)
+    if "count" not in spec:
+        raise ValueError("A range needs a count for grid sweeps: %s" % spec)
+    count = spec["count"]
+    if count == 1:
+        return [_from_unit(spec, 0)]
+    # Both ends included
+    return [_from_unit(spec, float(i) / (count - 1)) if i < count - 1 else spec["max"]
+            for i in range(count)]
+
+def grid(parameters):
+    """
+    Return every combination of the values of the parameters, as dictionaries.
+    """
+
+    keys = sorted(parameters.keys())
+    return [dict(zip(keys, values))
+            for values in itertools.product(*[_grid_values(parameters[key]) for key in keys])]
+
+def random_points(parameters, samples, rng):
+    """
+    Return samples points with each value drawn independently and uniformly.
+    """
+
+    keys = sorted(parameters.keys())
+    return [dict([(key, _from_unit(parameters[key], rng.random())) for key in keys])
+            for i in range(samples)]
+
+def latin_hypercube(parameters, samples, rng):
+    """
+    Return samples points such that, for every parameter, each of samples equal strata of its
+    range holds exactly one point.
+    """
+
+    keys = sorted(parameters.keys())
+    points = [{} for i in range(samples)]
+    for key in keys:
+        strata = list(range(samples))
+        rng.shuffle(strata)
+        for point, stratum in zip(points, strata):
+            point[key] = _from_unit(parameters[key], (stratum + rng.random()) / samples)
+    return points
+
+class Sweep(object):
+    """
+    A sweep, as read from a sweep file.
+    """
+
+    def __init__(self, parameters, mode='grid', samples=None, seed=None, fixed=None,
+                 workload='election', servers=None):
+        if mode not in MODES:
+            raise ValueError('Unknown sweep mode %s, not one of %s' % (mode, MODES))
+        if mode != 'grid' and not samples:
+            raise ValueError('The %s mode needs a number of samples' % mode)
+
+        # As for faults.FaultSchedule, so that a sweep can be repeated from its results
+        if seed is None:
+            seed = random.randrange(2 ** 31)
+
+        if not isinstance(workload, dict):
+            workload = {"name": workload}
+        if workload["name"] not in WORKLOADS:
+            raise ValueError('Unknown workload %s, not one of %s' % (
+                workload["name"], sorted(WORKLOADS.keys())))
+
+        self.parameters = parameters
+        self.mode = mode
+        self.samples = samples
+        self.seed = seed
+        self.fixed = fixed or {}
+        self.workload = workload
+        self.servers = servers
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(**dict([(str(key), value) for key, value in spec.items()]))
+
+    def points(self):
+        """
+        Return the settings of every point, as dictionaries.
+        """
+
+        rng = random.Random(self.seed)
+        if self.mode == 'grid':
+            points = grid(self.parameters)
+        elif self.mode == 'random':
+            points = random_points(self.parameters, self.samples, rng)
+        else:
+            points = latin_hypercube(self.parameters, self.samples, rng)
+
+        for point in points:
+            point.update(self.fixed)
+        return points
+
+    def spec(self):
+        """
+        Return the sweep as a sweep file would describe it.
+        """
+
+        return {"parameters": self.parameters, "mode": self.mode, "samples": self.samples,
+                "seed": self.seed, "fixed": self.fixed, "workload": self.workload,
+                "servers": self.servers}
+
+    def keys(self):
+        return sorted(set(self.parameters.keys()) | set(self.fixed.keys()))
+
+# The TestFramework parameters a setting can be passed as; any other key goes in serverConfig
+FRAMEWORK_PARAMETERS = inspect.getargspec(TestFramework.__init__).args[1:]
+
+def framework_params(settings):
+    """
+    Split the settings of a point into the TestFramework parameters that apply them.
+    """
+
+    params = {}
+    server_config = {}
+    for key, value in settings.items():
+        key = str(key)
+        if key in FRAMEWORK_PARAMETERS:
+            params[key] = value
+        else:
+            server_config[key] = value
+    if server_config:
+        params["serverConfig"] = server_config
+    return params
+
+def _pop_election_metadata(test):
+    with ElectionTest.metadata_lock:
+        return ElectionTest.experiment_metadata.pop(test.experiment_id)
+
+def run_election(test, workload):
+    """
+    Kill the leader repeat times; a row per election.
+    """
+
+    test.new_experiment()
+    try:
+        test.election_performance(repeat=workload.get("repeat", 20))
+    finally:
+        metadata = _pop_election_metadata(test)
+
+    return [{"election": i, "time": duration, "terms": terms}
+            for i, (duration, terms) in enumerate(zip(metadata["duration"], metadata["terms"]))]
+
+def run_stall(test, workload):
+    """
+    Freeze the leader repeat times; a row per stall.
+    """
+
+    test.new_experiment()
+    try:
+        test.stall_performance(repeat=workload.get("repeat", 20),
+                               stall=workload.get("stall", 300))
+    finally:
+        metadata = _pop_election_metadata(test)
+
+    return [{"stall": i, "terms": terms, "leaderChanged": int(leader_changed),
+             "unavailable": unavailable, "retries": retries}
+            for i, (terms, leader_changed, unavailable, retries) in enumerate(zip(
+                metadata["terms"], metadata["leader_changed"], metadata["unavailable"],
+                metadata["retries"]))]
+
+def run_benchmark(test, workload):
+    """
+    Run Benchmark repeat times; a row per run, with its phases in ms.
+    """
+
+    rows = []
+    for run in range(workload.get("repeat", 5)):
+        timing = test.execute_client_command(
+            client_executable="build/Examples/Benchmark",
+            conf={
+                "options": "%s --phases" % workload.get("options", ""),
+                "command": ""
+            },
+            timed=True
+        )
+        row = {"run": run, "throughput": timing.throughput()}
+        for phase, duration in timing.phases().items():
+            row[phase] = None if duration is None else duration * 1000
+        rows.append(row)
+    return rows
+
+# Workload name to (TestFramework class, function running it on a cluster and returning its rows)
+WORKLOADS = {
+    "election": (ElectionTest, run_election),
+    "stall": (ElectionTest, run_stall),
+    "benchmark": (TestFramework, run_benchmark)
+}
+
+# The measurement columns of each workload, in order
+COLUMNS = {
+    "election": ["election", "time", "terms"],
+    "stall": ["stall", "terms", "leaderChanged", "unavailable", "retries"],
+    "benchmark": ["run", "throughput"] + PHASES
+}
+
+def run_sweep(sweep, local_servers=None, parallel=1):
+    """
+    Run every point of the sweep, up to parallel at once, and return the rows of the tidy table.
+    """
+
+    factory, workload = WORKLOADS[sweep.workload["name"]]
+    points = list(enumerate(sweep.points()))
+
+    def run_point(fixture, point):
+        index, settings = point
+        test = fixture.acquire(**framework_params(settings))
+
+        rows = workload(test, sweep.workload)
+        for row in rows:
+            row["point"] = index
+            row.update(settings)
+        return rows
+
+    scheduler = Scheduler(
+        factory = factory,
+        clusters = parallel,
+        local_servers = local_servers,
+        debug = True
+    )
+    return scheduler.run(points, run_point)
+
+def write_csv(sweep, rows, path):
+    """
+    Write the rows as a table: the point, its settings, then the measurements. The sweep, with its
+    seed, is saved next to it (in <path>.json), so that it can be run again.
+    """
+
+    columns = ["point"] + sweep.keys() + COLUMNS[sweep.workload["name"]]
+    with open(path, 'w') as f:
+        f.write(';'.join(columns) + '\n')
+        for row in rows:
+            f.write(';'.join(['' if row.get(column) is None else str(row[column])
+                              for column in columns]) + '\n')
+
+    with open('%s.json' % path, 'w') as f:
+        json.dump(sweep.spec(), f, indent=4, sort_keys=True)
+
+def main():
+    arguments = docopt(__doc__)
+
+    sweep = Sweep.load(arguments['<sweep-file>'])
+
+    local_servers = sweep.servers
+    if arguments['--local']:
+        local_servers = int(arguments['--local'])
+
+    if arguments['--dry-run']:
+        print('Sweep of %s points, seed %d:' % (sweep.mode, sweep.seed))
+        for index, settings in enumerate(sweep.points()):
+            print('%d: %s' % (index, framework_params(settings)))
+        return
+
+    rows = run_sweep(sweep, local_servers, int(arguments['--parallel']))
+    write_csv(sweep, rows, arguments['--out'])
+    print('\nResults written to %s' % arguments['--out'])
+
+if __name__ == '__main__':
+    main()
@@ -38,43 +38,51 @@ class TimeoutConfiguration(TestFramework):
         """
         Ping all servers in the cluster from all servers in the cluster. The ping command is configured to exchange number_of_bytes data, whereas the number_of_pings pings are executed.
 
-        Important: Before executing the pings the debug/ folder is cleared. The output of the ping commands is stored in files with the format: debug/client_command_<command_number>_out.
+        The pings run in rounds: in each round every server pings a different server, all of them
+        concurrently.
+
+        Important: Before executing the pings the debug/ folder of the run is cleared. The output of the ping commands is stored in files with the format: debug/client_command_<command_number>_out.
         """
 
         # Due to appending to the same files in debug/
-        run_shell_command('rm -f debug/*')
+        run_shell_command('rm -f "%s"/*' % self.run_path('debug'))
 
         try:
-            bytes_sent = number_of_bytes - self.icmp_header
-
-            for from_server_id, from_server_ip in self.server_ids_ips:
-                header = "\nPinging from server %s (%s)" % (from_server_id, from_server_ip)
-                self._print_string(header)
-
-                # Change stdout and stderr file whenever ssh-ing to different server
-                self.client_commands += 1
-
-                for _, to_server_ip in self.server_ids_ips:
-                    # Skip pinging yourself
-                    if from_server_ip == to_server_ip:
-                        continue
-
+            # Each server keeps its own output files, numbered as if it were its own client
+            # command.
+            first_command = self.client_commands + 1
+            self.client_commands += len(self.server_ids_ips)
+
+            # In round r, server i pings server i + r, so that every server pings a different
+            # server at the same time and each host runs one ping at a time.
+            servers_num = len(self.server_ids_ips)
+            for r in range(1, servers_num):
+                self._print_string("\nPinging round %d of %d" % (r, servers_num - 1))
+
+                from_hosts = []
+                commands = []
+                for i, (from_server_id, _) in enumerate(self.server_ids_ips):
+                    _, to_server_ip = self.server_ids_ips[(i + r) % servers_num]
+
+                    # ping takes no port
                     command = "ping -c %s -s %s %s" % (
-                        number_of_pings, number_of_bytes, to_server_ip
+                        number_of_pings, number_of_bytes, to_server_ip.split(':')[0]
                     )
 
-                    print(command)
+                    print("%s: %s" % (self.server_hosts[from_server_id], command))
 
-                    self.sandbox.rsh(
-                        '%s' % (from_server_ip),
-                        command,
-                        bg=False,
-                        stdout=open('debug/client_command_%d_out' % self.client_commands, 'a'),
-                        stderr=open('debug/client_command_%d' % self.client_commands, 'a')
-                    )
+                    from_hosts.append(self.server_hosts[from_server_id])
+                    commands.append(command)
+
+                results = self.sandbox.rsh_many(from_hosts, commands)
+                print(results.report())
 
-                    with open('debug/client_command_%d_out' % self.client_commands, 'a') as f:
+                for i, result in enumerate(results):
+                    with open(self.debug_path('client_command_%d_out' % (first_command + i)), 'a') as f:
+                        f.write(result.stdout)
                         f.write('~' * 60 + '\n')
+                    with open(self.debug_path('client_command_%d' % (first_command + i)), 'a') as f:
+                        f.write(result.stderr)
         except Exception as e:
             print("Client command error: ", e)
             self.cleanup()
@@ -104,7 +112,7 @@ class TimeoutConfiguration(TestFramework):
     def parse_ping_stats(self):
         """
         Parse ping stats from ping output files. The ping output files are stored in the debug/
-        folder with the format: debug/client_command_<command_number>_out.
+        folder of the run with the format: debug/client_command_<command_number>_out.
 
         The history of ping rtts is stored in the ping_sample_rtts array.
 
@@ -117,7 +125,7 @@ class TimeoutConfiguration(TestFramework):
         """
 
         for i, from_server_id_ip in enumerate(self.server_ids_ips, 1):
-            with open('debug/client_command_%d_out' % i, 'r') as f:
+            with open(self.debug_path('client_command_%d_out' % i), 'r') as f:
                 for to_server_id_ip in self.server_ids_ips:
                     for line in f:
                         # Skip to the next ping command
@@ -0,0 +1,120 @@
+"""
+Phase timing of client runs. Every client run is split into phases, measured on the monotonic
+clock in nanoseconds (see common.monotonicNanos), from the time the harness launched it until the
+Reaper saw it exit:
+
+  spawn     From the launch until the client's main function ran
+  connect   Until it had connected and found the leader
+  first     Until its first write completed
+  steady    From when every writer thread had completed a write until the last write
+  exit      From the last write until the process exited
+
+The boundaries inside the client come from the line Benchmark prints with --phases. Clients run on
+the machine of the harness, so their monotonic clock is the same one. Without that line, only the
+"Benchmark took X ms to write N objects" line is used, which covers connect, first and steady
+together.
+"""
+
+from __future__ import print_function
+
+import re
+
+PHASES = ['spawn', 'connect', 'first', 'steady', 'exit']
+
+PHASES_LINE = re.compile(r'Phases: main=(\d+) connected=(\d+) first=(\d+) steady=(\d+) '
+                         r'end=(\d+) steadyWrites=(\d+)')
+TOOK_LINE = re.compile(r'Benchmark took ([\d.e+-]+) ms to write (\d+) objects')
+
+class ClientTiming(object):
+    """
+    The phases of one client run.
+    """
+
+    def __init__(self, launch, exit, output=''):
+        """
+        launch and exit are the monotonic times in nanoseconds at which the client was launched and
+        exited, and output is what it printed on stdout.
+        """
+
+        self.launch = launch
+        self.exit = exit
+        # Phase to its end on the monotonic clock, or None if the client did not report it
+        self.marks = dict([(phase, None) for phase in PHASES])
+        self.marks['exit'] = exit
+        # Start of the steady phase, which is not the end of the first one with several threads
+        self.steady_start = None
+        self.steady_writes = None
+        # From the "Benchmark took" line
+        self.took = None
+        self.writes = None
+
+        for line in output.splitlines():
+            m = PHASES_LINE.search(line)
+            if m is not None:
+                main, connected, first, steady, end, steady_writes = [int(g) for g in m.groups()]
+                self.marks['spawn'] = main
+                # Zero where the client never got that far
+                self.marks['connect'] = connected or None
+                self.marks['first'] = first or None
+                self.steady_start = steady or None
+                self.marks['steady'] = end
+                self.steady_writes = steady_writes
+                continue
+
+            m = TOOK_LINE.search(line)
+            if m is not None:
+                self.took = float(m.group(1)) / 1000
+                self.writes = int(m.group(2))
+
+    def phases(self):
+        """
+        Return the seconds each phase took, None for those that cannot be told apart.
+        """
+
+        durations = {}
+        start = self.launch
+        for phase in PHASES:
+            end = self.marks[phase]
+            if phase == 'steady':
+                start = self.steady_start
+            if start is None or end is None:
+                durations[phase] = None
+            else:
+                durations[phase] = (end - start) / 1e9
+            start = end
+        return durations
+
+    def total(self):
+        """
+        Return the seconds from the launch until the exit.
+        """
+
+        return (self.exit - self.launch) / 1e9
+
+    def throughput(self):
+        """
+        Return the writes per second in the steady phase, or, for clients that do not report their
+        phases or wrote nothing after the steady mark (e.g. with one write per thread), over the
+        whole "Benchmark took" time. None if the client reported neither.
+        """
+
+        steady = self.phases()['steady']
+        if steady and self.steady_writes:
+            return self.steady_writes / steady
+        if self.took:
+            return self.writes / self.took
+        return None
+
+    def report(self):
+        """
+        Return a one-line summary of the phases, in milliseconds.
+        """
+
+        phases = self.phases()
+        parts = ['%s %s' % (phase, '-' if phases[phase] is None else
+                            '%.3f ms' % (phases[phase] * 1000))
+                 for phase in PHASES]
+        throughput = self.throughput()
+        return 'Client phases: %s, total %.3f ms, %s' % (
+            ', '.join(parts), self.total() * 1000,
+            'no throughput' if throughput is None else '%.1f writes/s' % throughput)